@@ -0,0 +1,97 @@
+# Benchmark of the chunking of long texts. This checks that the time to cut
+# tokens into chunks grows linearly with the size of the text and compares it
+# with the original recursive implementation.
+import argparse
+import glob
+import logging
+import os
+import time
+from papers_extractor.openai_parsers import \
+    custom_word_tokenize, find_chunk_boundaries
+
+logging.basicConfig(level=logging.INFO)
+
+
+def legacy_break_up_tokens_in_chunks(tokens, chunk_size):
+    """The original recursive chunker, kept as a reference."""
+
+    def find_sentence_boundary(tokens, start_idx):
+        current_length = start_idx
+        for idx, token in enumerate(tokens[start_idx::-1]):
+            if token in {".", "!", "?"}:
+                current_length = start_idx - idx
+                break
+        return current_length
+
+    if len(tokens) <= chunk_size:
+        yield tokens
+    else:
+        end_idx = find_sentence_boundary(tokens, chunk_size)
+        yield tokens[:end_idx + 1]
+        yield from legacy_break_up_tokens_in_chunks(tokens[end_idx + 1:],
+                                                    chunk_size)
+
+
+def time_function(function, repeats):
+    """Returns the best time per call over a number of repeats."""
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    script_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--example_folder",
+        help="Folder with the *_raw.txt example texts",
+        type=str,
+        default=os.path.join(script_path, "../example"),
+    )
+    parser.add_argument(
+        "--chunk_size",
+        help="Number of tokens in each chunk",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of repeats for each measurement",
+        type=int,
+        default=3,
+    )
+    args = parser.parse_args()
+
+    text = ""
+    for path in sorted(glob.glob(os.path.join(args.example_folder,
+                                              "*_raw.txt"))):
+        with open(path, "r") as f:
+            text += f.read()
+    if not text:
+        raise Exception(f"No *_raw.txt file in {args.example_folder}")
+
+    base_tokens = custom_word_tokenize(text)
+    logging.info(f"{len(text)} characters, {len(base_tokens)} tokens")
+
+    # We grow the text up to the 1M characters allowed for a fulltext
+    for nb_copies in [1, 2, 4, 8]:
+        tokens = base_tokens * nb_copies
+        new_time = time_function(
+            lambda: find_chunk_boundaries(tokens, args.chunk_size),
+            args.repeats)
+        try:
+            legacy_time = time_function(
+                lambda: list(legacy_break_up_tokens_in_chunks(
+                    tokens, args.chunk_size)), args.repeats)
+            legacy_result = f"{legacy_time * 1000:10.2f} ms"
+        except RecursionError:
+            legacy_result = "RecursionError"
+        logging.info(
+            f"{len(text) * nb_copies:>9} chars: "
+            f"linear {new_time * 1000:10.2f} ms "
+            f"({new_time * 1e9 / len(tokens):6.1f} ns/token), "
+            f"recursive {legacy_result}")
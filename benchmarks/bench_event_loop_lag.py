@@ -0,0 +1,130 @@
+# Benchmark of the lag of the event loop while batches of long prompts are
+# sent to a local mock server. Tokens used to be counted inside the loop, so
+# encoding a long prompt or response delayed every other request in flight.
+# They are now counted in a thread pool and the tokens of the responses are
+# read from the usage reported by the API. The lag is the delay of a ticker
+# that wakes up every millisecond in the loop of the requests.
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import statistics
+import time
+from papers_extractor import openai_parsers
+from papers_extractor.async_runner import get_async_runner, \
+    shutdown_async_runner
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, \
+    build_chunk_prompt, count_tokens, CHAT_MODEL
+from papers_extractor.rate_limiter import configure_rate_limiter
+from papers_extractor.token_counter import get_token_counter
+
+logging.basicConfig(level=logging.INFO)
+# The log of each request would slow down the loop being measured
+logging.getLogger("openai").setLevel(logging.WARNING)
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+# The interval of the ticker in seconds.
+TICK_INTERVAL = 0.001
+
+
+async def count_tokens_in_loop(texts, model="gpt-3.5-turbo-0301"):
+    """Counts tokens inside the event loop, as it was done before."""
+    return count_tokens(texts, model)
+
+
+async def count_tokens_batch_in_loop(texts, model="gpt-3.5-turbo-0301"):
+    """Counts tokens of each text inside the event loop."""
+    return get_token_counter(model).count_batch(texts)
+
+
+def measure_lag(parser, prompts):
+    """Sends a batch of prompts and returns the delays of the ticker."""
+    delays = []
+
+    async def tick(done):
+        while not done.is_set():
+            start_time = time.perf_counter()
+            await asyncio.sleep(TICK_INTERVAL)
+            delays.append(time.perf_counter() - start_time - TICK_INTERVAL)
+
+    async def run_batch():
+        done = asyncio.Event()
+        ticker = asyncio.create_task(tick(done))
+        try:
+            await parser.async_call_chatGPT(prompts, 0, 0, 0)
+        finally:
+            done.set()
+            await ticker
+
+    # Prompts that were counted before would be found in the cache
+    get_token_counter().clear_cache()
+    get_async_runner().run(run_batch())
+    return delays
+
+
+def summarize_lag(delays):
+    """Returns the p50, p99 and largest delays in milliseconds."""
+    quantiles = statistics.quantiles(delays, n=100)
+    return 1000 * quantiles[49], 1000 * quantiles[98], 1000 * max(delays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--concurrency",
+        help="Numbers of concurrent workers to measure",
+        type=int,
+        nargs="+",
+        default=[8, 32, 64],
+    )
+    parser.add_argument(
+        "--chunk_size",
+        help="Number of words in each prompt",
+        type=int,
+        default=1400,
+    )
+    parser.add_argument(
+        "--nb_prompts",
+        help="Number of prompts in each batch",
+        type=int,
+        default=256,
+    )
+    args = parser.parse_args()
+
+    example_folder = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "example")
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(example_folder,
+                                              "*_raw.txt"))):
+        with open(path, "r") as f:
+            chunks.extend(OpenaiLongParser(
+                f.read(), chunk_size=args.chunk_size).chunks)
+    # The prompts are all different so none of them is coalesced
+    prompts = [build_chunk_prompt(f"Clean up part {index}:",
+                                  chunks[index % len(chunks)])
+               for index in range(args.nb_prompts)]
+
+    # Only the concurrency limits the requests sent to the mock server
+    configure_rate_limiter(CHAT_MODEL, max_concurrency=max(args.concurrency))
+    thread_pool_functions = (openai_parsers.async_count_tokens,
+                             openai_parsers.async_count_tokens_batch)
+    with MockOpenaiServer(latency=0.05, token_latency=0.0001):
+        for concurrency in args.concurrency:
+            openai_long_parser = OpenaiLongParser(
+                "Test prompt", max_concurrent_calls=concurrency)
+            openai_parsers.async_count_tokens = count_tokens_in_loop
+            openai_parsers.async_count_tokens_batch = \
+                count_tokens_batch_in_loop
+            in_loop = summarize_lag(measure_lag(openai_long_parser, prompts))
+            (openai_parsers.async_count_tokens,
+             openai_parsers.async_count_tokens_batch) = thread_pool_functions
+            in_pool = summarize_lag(measure_lag(openai_long_parser, prompts))
+            for name, (p50, p99, largest) in [("in loop", in_loop),
+                                              ("thread pool", in_pool)]:
+                logging.info(f"{concurrency} workers, counting {name}: "
+                             f"lag p50 {p50:.2f} ms, p99 {p99:.2f} ms, "
+                             f"max {largest:.2f} ms")
+        shutdown_async_runner()
@@ -0,0 +1,77 @@
+# Benchmark of the start-up cost of the package and of the tokenizer
+# backends. Importing openai_parsers used to import nltk and call
+# nltk.download("punkt"), which needs network access.
+import argparse
+import glob
+import logging
+import os
+import subprocess
+import sys
+import time
+from papers_extractor.openai_parsers import custom_word_tokenize
+
+logging.basicConfig(level=logging.INFO)
+
+
+def time_import(code, repeats):
+    """Returns the best wall time to run some code in a fresh interpreter."""
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       capture_output=True)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    script_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--example_folder",
+        help="Folder with the example texts",
+        type=str,
+        default=os.path.join(script_path, "../example"),
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of repeats for each measurement",
+        type=int,
+        default=3,
+    )
+    args = parser.parse_args()
+
+    imports = {
+        "python alone": "pass",
+        "openai_parsers": "import papers_extractor.openai_parsers",
+        "nltk word_tokenize (previously imported by openai_parsers)":
+            "from nltk.tokenize import word_tokenize",
+        "nltk.download('punkt') (previously run at import)":
+            "import nltk; nltk.download('punkt', quiet=True)",
+    }
+    for name, code in imports.items():
+        try:
+            elapsed_time = time_import(code, args.repeats)
+            logging.info(f"{name:<60} {elapsed_time * 1000:10.1f} ms")
+        except subprocess.CalledProcessError:
+            logging.info(f"{name:<60} {'failed':>10}")
+
+    text = ""
+    for path in sorted(glob.glob(os.path.join(args.example_folder,
+                                              "*_raw.txt"))):
+        with open(path, "r") as f:
+            text += f.read()
+
+    for backend in ["regex", "nltk"]:
+        try:
+            # The first call loads the backend
+            custom_word_tokenize("Warm up.", backend=backend)
+            start_time = time.perf_counter()
+            tokens = custom_word_tokenize(text, backend=backend)
+            elapsed_time = time.perf_counter() - start_time
+            logging.info(f"Tokenizing {len(text)} characters with {backend}: "
+                         f"{len(tokens)} tokens in "
+                         f"{elapsed_time * 1000:.1f} ms")
+        except LookupError:
+            logging.info(f"The {backend} backend is not available")
@@ -0,0 +1,82 @@
+# Benchmark of the overhead of each batch of chat calls. Batches used to be
+# run with asyncio.run and one HTTP session per request. They are now run in
+# the shared runner loop with a pooled session. The calls go to a local mock
+# server so only the overhead is measured. The mock server does not use TLS
+# so the savings against the real API are larger than measured here.
+import argparse
+import asyncio
+import logging
+import time
+from papers_extractor.async_runner import shutdown_async_runner
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser
+
+logging.basicConfig(level=logging.INFO)
+
+
+def time_function(function, repeats):
+    """Returns the best time per call over a number of repeats."""
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def call_with_new_loop(parser, prompts):
+    """Runs a batch of calls the way it was done before the runner."""
+
+    async def collect():
+        return [result async for result in parser.iter_chat_results(
+            prompts, temperature=0)]
+
+    return asyncio.run(collect())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--nb_batches",
+        help="Number of batches of calls in a measurement",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="Number of prompts in each batch",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of repeats for each measurement",
+        type=int,
+        default=3,
+    )
+    args = parser.parse_args()
+
+    prompts = [f"Repeat:\n\nThis is the test prompt number {index}."
+               for index in range(args.batch_size)]
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=args.batch_size)
+
+    with MockOpenaiServer():
+        # We warm up the mock server and the runner
+        openai_long_parser.multi_call_chatGPT(prompts, temperature=0)
+
+        new_loop_time = time_function(
+            lambda: [call_with_new_loop(openai_long_parser, prompts)
+                     for _ in range(args.nb_batches)], args.repeats)
+        runner_time = time_function(
+            lambda: [openai_long_parser.multi_call_chatGPT(
+                prompts, temperature=0) for _ in range(args.nb_batches)],
+            args.repeats)
+        shutdown_async_runner()
+
+    logging.info(f"asyncio.run per batch: "
+                 f"{1000 * new_loop_time / args.nb_batches:.2f} ms/batch")
+    logging.info(f"shared runner: "
+                 f"{1000 * runner_time / args.nb_batches:.2f} ms/batch")
+    saved_time = (new_loop_time - runner_time) / args.nb_batches
+    logging.info(f"Overhead saved per batch: {1000 * saved_time:.2f} ms")
@@ -0,0 +1,98 @@
+# Micro-benchmark of token counting on the example texts. This compares the
+# original count_tokens, which built a tiktoken encoder on every call, with
+# the shared TokenCounter service.
+import argparse
+import glob
+import logging
+import os
+import time
+import tiktoken
+from papers_extractor.openai_parsers import count_tokens
+from papers_extractor.token_counter import get_token_counter
+
+logging.basicConfig(level=logging.INFO)
+
+
+def legacy_count_tokens(texts, model="gpt-3.5-turbo-0301"):
+    """The original implementation of count_tokens, kept as a reference."""
+    encoding = tiktoken.encoding_for_model(model)
+    num_tokens = 0
+
+    for message in texts:
+        num_tokens += 4
+        num_tokens += len(encoding.encode(message))
+
+    return num_tokens
+
+
+def time_function(function, repeats):
+    """Returns the best time per call over a number of repeats."""
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    script_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--example_folder",
+        help="Folder with the *_raw.txt example texts",
+        type=str,
+        default=os.path.join(script_path, "../example"),
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of repeats for each measurement",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--paragraph_length",
+        help="Number of characters in each paragraph of the batch test",
+        type=int,
+        default=2000,
+    )
+    args = parser.parse_args()
+
+    texts = []
+    for path in sorted(glob.glob(os.path.join(args.example_folder,
+                                              "*_raw.txt"))):
+        with open(path, "r") as f:
+            texts.append(f.read())
+    if not texts:
+        raise Exception(f"No *_raw.txt file in {args.example_folder}")
+
+    # Paragraphs mimic the chunks and prompts sent in a real run.
+    paragraphs = [text[index:index + args.paragraph_length]
+                  for text in texts
+                  for index in range(0, len(text), args.paragraph_length)]
+
+    counter = get_token_counter()
+    assert count_tokens(texts) == legacy_count_tokens(texts)
+
+    results = {}
+    results["legacy, full texts"] = time_function(
+        lambda: legacy_count_tokens(texts), args.repeats)
+    counter.clear_cache()
+    results["cached counter, full texts, cold"] = time_function(
+        lambda: (counter.clear_cache(), count_tokens(texts)), args.repeats)
+    results["cached counter, full texts, warm"] = time_function(
+        lambda: count_tokens(texts), args.repeats)
+    results["legacy, one call per paragraph"] = time_function(
+        lambda: [legacy_count_tokens([p]) for p in paragraphs],
+        args.repeats)
+    results["counter, one call per paragraph, cold"] = time_function(
+        lambda: (counter.clear_cache(),
+                 [count_tokens([p]) for p in paragraphs]), args.repeats)
+    results["counter, batch of paragraphs, cold"] = time_function(
+        lambda: (counter.clear_cache(), count_tokens(paragraphs)),
+        args.repeats)
+
+    logging.info(f"{len(texts)} texts, {len(paragraphs)} paragraphs")
+    for name, elapsed_time in results.items():
+        logging.info(f"{name:<45} {elapsed_time * 1000:10.2f} ms")
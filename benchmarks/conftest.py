@@ -0,0 +1,66 @@
+# Fixtures of the end-to-end benchmark suite. The suite runs the request
+# machinery against the local mock OpenAI server so it needs no key or
+# network access. Run it with:
+#   pytest benchmarks
+# Results are printed at the end of the run and appended as JSON lines to the
+# file set in the BENCHMARK_RESULTS environment variable, if any.
+import glob
+import json
+import os
+import pytest
+from papers_extractor.mock_openai_server import MockOpenaiServer, \
+    lognormal_latency
+
+example_folder = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example")
+
+# The median latency of the mock server in seconds. The distribution has a
+# long tail like the real API.
+MEDIAN_LATENCY = float(os.environ.get("BENCHMARK_MEDIAN_LATENCY", 0.05))
+
+_results = []
+
+
+@pytest.fixture
+def example_texts():
+    """The raw texts of the example papers."""
+    texts = []
+    for path in sorted(glob.glob(os.path.join(example_folder,
+                                              "*_raw.txt"))):
+        with open(path, "r") as f:
+            texts.append(f.read())
+    return texts
+
+
+@pytest.fixture
+def mock_server():
+    """A mock OpenAI server with a log-normal latency."""
+    with MockOpenaiServer(latency=lognormal_latency(MEDIAN_LATENCY, seed=0),
+                          seed=0) as server:
+        yield server
+
+
+@pytest.fixture
+def record_benchmark(request):
+    """Records the metrics of a benchmark."""
+    def record(**metrics):
+        _results.append({"benchmark": request.node.name, **metrics})
+    return record
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section("benchmark results")
+    for result in _results:
+        metrics = ", ".join(
+            f"{key}={value:.3f}" if isinstance(value, float)
+            else f"{key}={value}"
+            for key, value in result.items() if key != "benchmark")
+        terminalreporter.write_line(f"{result['benchmark']}: {metrics}")
+
+    results_path = os.environ.get("BENCHMARK_RESULTS")
+    if results_path:
+        with open(results_path, "a") as f:
+            for result in _results:
+                f.write(json.dumps(result) + "\n")
@@ -0,0 +1,135 @@
+# End-to-end throughput and latency benchmarks of the OpenAI calls on the
+# example texts. See conftest.py for how to run them.
+import asyncio
+import statistics
+import time
+from papers_extractor.async_runner import get_async_runner
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.long_text import LongText
+from papers_extractor.mock_openai_server import MockOpenaiServer, \
+    lognormal_latency
+from papers_extractor.openai_parsers import OpenaiLongParser, \
+    build_chunk_prompt, CHAT_MODEL
+from papers_extractor.pdf_parser import PdfParser, CLEANUP_PROMPT
+from papers_extractor.rate_limiter import configure_rate_limiter, \
+    DEFAULT_RATE_LIMITS
+
+
+def latency_percentiles(latencies):
+    """Returns the p50 and p95 of a list of latencies."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return quantiles[49], quantiles[94]
+
+
+def test_chat_throughput(example_texts, mock_server, record_benchmark):
+    openai_long_parser = OpenaiLongParser(example_texts[0], chunk_size=200,
+                                          max_concurrent_calls=16)
+    prompts = ["Summarize:\n\n" + chunk for chunk in openai_long_parser.chunks]
+
+    start_time = time.perf_counter()
+    results = asyncio.run(openai_long_parser.async_call_chatGPT(
+        prompts, 0, 0, 0))
+    elapsed_time = time.perf_counter() - start_time
+
+    assert len(results) == len(prompts)
+    record_benchmark(calls=len(prompts), seconds=elapsed_time,
+                     calls_per_second=len(prompts) / elapsed_time)
+
+
+def test_chat_latency_with_failures(example_texts, record_benchmark):
+    openai_long_parser = OpenaiLongParser(example_texts[0], chunk_size=200,
+                                          max_concurrent_calls=16)
+    prompts = ["Summarize:\n\n" + chunk for chunk in openai_long_parser.chunks]
+    arrival_times = []
+
+    async def collect():
+        start_time = time.perf_counter()
+        async for _ in openai_long_parser.iter_chat_results(
+                prompts, temperature=0, timeout=1, max_retries=5):
+            arrival_times.append(time.perf_counter() - start_time)
+
+    # A few requests are throttled or never answered
+    with MockOpenaiServer(latency=lognormal_latency(0.05, seed=1),
+                          throttle_rate=0.02, timeout_rate=0.02,
+                          injected_retry_after=0.05, seed=1) as server:
+        get_async_runner().run(collect())
+
+    p50, p95 = latency_percentiles(arrival_times)
+    record_benchmark(calls=len(prompts), throttled=server.nb_throttled,
+                     hung=server.nb_hung, p50_arrival=p50, p95_arrival=p95,
+                     total_seconds=arrival_times[-1])
+
+
+def test_longest_first_makespan(example_texts, record_benchmark):
+    # The cleanup prompts of each example paper are sent in one batch as in
+    # PdfParser.get_clean_text. Replies take time in proportion to their
+    # length so the longest chunks set the end of the batch.
+    prompts = []
+    for text in example_texts:
+        openai_long_parser = OpenaiLongParser(text, chunk_size=1400)
+        prompts.extend(build_chunk_prompt(CLEANUP_PROMPT, chunk)
+                       for chunk in openai_long_parser.chunks)
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=8)
+
+    def makespan(longest_first):
+        start_time = time.perf_counter()
+        results = openai_long_parser.multi_call_chatGPT(
+            prompts, temperature=0, longest_first=longest_first)
+        assert len(results) == len(prompts)
+        return time.perf_counter() - start_time
+
+    # The token budget is lifted so only the order of the calls matters
+    configure_rate_limiter(CHAT_MODEL, max_concurrency=8)
+    try:
+        with MockOpenaiServer(latency=0.01, token_latency=0.0005):
+            document_order = makespan(False)
+            longest_first = makespan(True)
+    finally:
+        configure_rate_limiter(CHAT_MODEL, **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+
+    record_benchmark(calls=len(prompts), document_order_seconds=document_order,
+                     longest_first_seconds=longest_first,
+                     reduction=1 - longest_first / document_order)
+
+
+def test_embedding_throughput(example_texts, mock_server, record_benchmark):
+    openai_long_parser = OpenaiLongParser("\n".join(example_texts),
+                                          chunk_size=100,
+                                          max_concurrent_calls=8)
+
+    start_time = time.perf_counter()
+    embeddings, chunks = openai_long_parser.process_chunks_through_embedding()
+    elapsed_time = time.perf_counter() - start_time
+
+    assert len(embeddings) == len(chunks)
+    record_benchmark(chunks=len(chunks), requests=mock_server.nb_requests,
+                     seconds=elapsed_time,
+                     chunks_per_second=len(chunks) / elapsed_time)
+
+
+def test_pdf_clean_text(example_texts, mock_server, record_benchmark):
+    # The raw text is loaded from a database so no PDF file is needed.
+    local_database = LocalDatabase()
+    local_database.save_to_database("benchmark_pdf",
+                                    {"raw_text": example_texts[0]})
+    pdf_parser = PdfParser("benchmark.pdf", local_database=local_database,
+                           database_id="benchmark_pdf")
+
+    start_time = time.perf_counter()
+    cleaned_text = pdf_parser.get_clean_text()
+    elapsed_time = time.perf_counter() - start_time
+
+    assert cleaned_text
+    record_benchmark(calls=mock_server.nb_requests, seconds=elapsed_time)
+
+
+def test_summarize_longtext(example_texts, mock_server, record_benchmark):
+    long_text = LongText(example_texts[0], chunk_size=400)
+
+    start_time = time.perf_counter()
+    summary = long_text.summarize_longtext_into_chunks(final_chunk_length=2)
+    elapsed_time = time.perf_counter() - start_time
+
+    assert summary
+    record_benchmark(calls=mock_server.nb_requests, seconds=elapsed_time)
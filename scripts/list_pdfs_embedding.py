@@ -5,6 +5,8 @@ from papers_extractor.pdf_parser import PdfParser
 from papers_extractor.long_text import LongText
 from papers_extractor.database_parser import LocalDatabase
 from papers_extractor.multi_paper import MultiPaper
+from papers_extractor.pipeline_planner import PipelinePlanner, format_plan
+import sys
 import logging
 
 # Import the dotenv module to load the environment variables
@@ -44,6 +46,13 @@ if __name__ == "__main__":
         default="../../database",
     )
 
+    parser.add_argument(
+        "--dry_run",
+        help="Only print the calls, tokens and time the embeddings are \
+            expected to take, without calling the API.",
+        action="store_true",
+    )
+
     args = parser.parse_args()
 
     def get_list_pdf_files(path_folder):
@@ -65,6 +74,12 @@ if __name__ == "__main__":
     else:
         database_obj = None
 
+    if args.dry_run:
+        planner = PipelinePlanner(local_database=database_obj)
+        plan = planner.plan_pdfs(pdf_files, summarize=False, embed=True)
+        print(format_plan(plan))
+        sys.exit(0)
+
     all_legends = []
     all_long_papers = []
 
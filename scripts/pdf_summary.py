@@ -5,6 +5,8 @@ import argparse
 from papers_extractor.pdf_parser import PdfParser
 from papers_extractor.long_text import LongText
 from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.pipeline_planner import PipelinePlanner, format_plan
+import sys
 
 import logging
 
@@ -55,6 +57,29 @@ if __name__ == "__main__":
         default=1,
     )
 
+    parser.add_argument(
+        "--chunk_unit",
+        help="Unit of the chunk size used to cut the document. 'words' \
+            counts word tokens while 'model_tokens' packs chunks up to the \
+            number of tokens of the model, which makes fewer API calls.",
+        type=str,
+        default="words",
+        choices=["words", "model_tokens"],
+    )
+
+    parser.add_argument(
+        "--stream",
+        help="Print the final summary as it is being written.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--dry_run",
+        help="Only print the calls, tokens and time the summary is \
+            expected to take, without calling the API.",
+        action="store_true",
+    )
+
     parser.add_argument(
         "--database_path",
         help="Path to the database file. This is an optional argument. \
@@ -78,15 +103,26 @@ if __name__ == "__main__":
     else:
         database_obj = None
 
+    if args.dry_run:
+        planner = PipelinePlanner(local_database=database_obj,
+                                  chunk_unit=args.chunk_unit,
+                                  cut_bibliography=args.cut_bibliography)
+        plan = planner.plan_pdf(pdf_path, final_chunk_length=chunk_length)
+        print(format_plan(plan))
+        sys.exit(0)
+
     # We load the pdf parser to extract and clean the content
     pdf_parser = PdfParser(
         pdf_path,
         cut_bibliography=args.cut_bibliography,
         local_database=database_obj)
-    cleaned_text = pdf_parser.get_clean_text()
+    # A single paper is waited on so it goes before any bulk job
+    cleaned_text = pdf_parser.get_clean_text(chunk_unit=args.chunk_unit,
+                                             priority="interactive")
 
     # We then use the long text parser to summarize the content
-    paper_parser = LongText(cleaned_text, local_database=database_obj)
+    paper_parser = LongText(cleaned_text, local_database=database_obj,
+                            chunk_unit=args.chunk_unit)
 
     # We save the summary in a txt file
     if save_summary:
@@ -94,9 +130,23 @@ if __name__ == "__main__":
     else:
         summary_path = None
 
+    if args.stream:
+        printed_length = 0
+
+        def print_partial(index, text):
+            # We only print the part of the text that is new
+            global printed_length
+            print(text[printed_length:], end="", flush=True)
+            printed_length = len(text)
+    else:
+        print_partial = None
+
     summary = paper_parser.summarize_longtext_into_chunks(
-        final_chunk_length=chunk_length, save_path_summary=summary_path
+        final_chunk_length=chunk_length, save_path_summary=summary_path,
+        partial_callback=print_partial, priority="interactive"
     )
+    if args.stream:
+        print()
 
     # We print the final summary
     print(summary)
@@ -0,0 +1,191 @@
+# This file contains a long-lived event loop that runs the calls to the OpenAI
+# API. Running each batch of calls with asyncio.run builds a new event loop
+# and opens new connections every time. The runner keeps one loop in a
+# background thread with a shared HTTP session so connections are kept alive
+# and reused by all the calls of the process.
+import asyncio
+import atexit
+import logging
+import threading
+import aiohttp
+import openai
+
+# The runner is shared by every object of the process.
+_runner = None
+_runner_lock = threading.Lock()
+
+
+class AsyncRunner:
+    """This class runs coroutines in an event loop living in a background
+    thread. The coroutines are run with openai.aiosession set to a shared
+    aiohttp session with a keep-alive connection pool.
+    """
+
+    def __init__(self, connection_limit=100, keepalive_timeout=30):
+        """Initializes the runner. The loop is started on first use.
+        Args:
+            connection_limit (int): The largest number of connections open
+            at once. Defaults to 100.
+            keepalive_timeout (float): The time in seconds an idle connection
+            is kept open. Defaults to 30.
+        Returns:
+            None
+        """
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        """True if the loop of the runner is running."""
+        return self._loop is not None
+
+    def start(self):
+        """Starts the loop of the runner in a background thread."""
+        with self._lock:
+            if self._loop is not None:
+                return
+            started = threading.Event()
+
+            def run():
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+                started.set()
+                self._loop.run_forever()
+                self._loop.close()
+
+            self._thread = threading.Thread(
+                target=run, name="papers-extractor-runner", daemon=True)
+            self._thread.start()
+            started.wait()
+            logging.debug("Started the OpenAI runner loop")
+
+    def in_runner_loop(self):
+        """Checks if the caller runs in the loop of the runner."""
+        return self._thread is not None and \
+            threading.current_thread() is self._thread
+
+    async def _get_session(self):
+        # The session is created in the loop that uses it.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _run_with_session(self, coroutine):
+        # The session is set in the context of this task so every task it
+        # creates inherits it.
+        openai.aiosession.set(await self._get_session())
+        return await coroutine
+
+    def submit(self, coroutine):
+        """Schedules a coroutine in the loop of the runner.
+        Args:
+            coroutine (coroutine): The coroutine to run.
+        Returns:
+            concurrent.futures.Future: The future of the result.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            self._run_with_session(coroutine), self._loop)
+
+    def run(self, coroutine):
+        """Runs a coroutine in the loop of the runner and waits for its
+        result. This can be called from any thread except the one of the
+        runner, whose loop would wait for itself. Coroutines running in the
+        runner loop await the async versions of the calls instead.
+        Args:
+            coroutine (coroutine): The coroutine to run.
+        Returns:
+            object: The result of the coroutine.
+        """
+        if self.in_runner_loop():
+            coroutine.close()
+            raise RuntimeError(
+                "A blocking call, like multi_call_chatGPT or embed_texts, "
+                "was made from the loop that runs the API calls, which "
+                "would wait for itself. Await its async version, like "
+                "async_call_chatGPT or async_embed_texts, instead.")
+        future = self.submit(coroutine)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    async def run_async(self, coroutine):
+        """Runs a coroutine in the loop of the runner from another event
+        loop.
+        Args:
+            coroutine (coroutine): The coroutine to run.
+        Returns:
+            object: The result of the coroutine.
+        """
+        if self.in_runner_loop():
+            return await coroutine
+        future = self.submit(coroutine)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _close(self):
+        # We cancel the calls still pending and wait for them to end so no
+        # task is destroyed while pending when the loop is closed.
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self._loop.shutdown_asyncgens()
+
+    def shutdown(self):
+        """Cancels the pending calls, closes the shared session and stops
+        the loop of the runner."""
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(
+                self._close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+            self._thread = None
+            logging.debug("Stopped the OpenAI runner loop")
+
+
+def get_async_runner():
+    """Returns the runner shared by the process.
+    Returns:
+        AsyncRunner: The shared runner.
+    """
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = AsyncRunner()
+    return _runner
+
+
+def shutdown_async_runner():
+    """Stops the shared runner and closes its connections. A new runner is
+    started if calls are made afterwards. This is called when the process
+    exits.
+    """
+    global _runner
+    with _runner_lock:
+        runner, _runner = _runner, None
+    if runner is not None:
+        runner.shutdown()
+
+
+atexit.register(shutdown_async_runner)
@@ -0,0 +1,76 @@
+# This file contains checkpoints of the chunks of a job sent to the OpenAI
+# API. The result of each chunk is saved in the local database as soon as it
+# arrives, so a job that fails part way through only sends the missing chunks
+# when it is run again. A checkpoint is cleared once its job is complete.
+import logging
+from papers_extractor.database_parser import hash_variable
+
+# All the keys of the checkpoints start with this prefix so they can be told
+# apart from the papers and texts saved in the same database.
+CHECKPOINT_KEY_PREFIX = "chunk_checkpoint_"
+
+
+class ChunkCheckpoint:
+    """This class saves the result of each chunk of a job in a
+    LocalDatabase. Results are addressed by the job and the hash of the
+    prompt of the chunk.
+    """
+
+    def __init__(self, local_database, job_id):
+        """Initializes the checkpoint.
+        Args:
+            local_database (LocalDatabase): The database to save the results
+            in.
+            job_id (str): The key of the job, for example the database key of
+            the text being processed and the name of the step.
+        Returns:
+            None
+        """
+        self.database = local_database
+        self.job_id = job_id
+        self.key_prefix = CHECKPOINT_KEY_PREFIX + hash_variable(job_id) + "_"
+
+    def make_key(self, prompt):
+        """Creates the database key of a chunk.
+        Args:
+            prompt (str): The prompt of the chunk.
+        Returns:
+            str: The key of the chunk.
+        """
+        return self.key_prefix + hash_variable(prompt)
+
+    def get(self, prompt):
+        """Returns the saved result of a chunk.
+        Args:
+            prompt (str): The prompt of the chunk.
+        Returns:
+            str: The saved result or None if the chunk was not done yet.
+        """
+        key = self.make_key(prompt)
+        if self.database.check_in_database(key):
+            logging.debug("Chunk found in checkpoint")
+            return self.database.load_from_database(key)
+        return None
+
+    def save(self, prompt, content):
+        """Saves the result of a chunk.
+        Args:
+            prompt (str): The prompt of the chunk.
+            content (str): The result of the chunk.
+        Returns:
+            None
+        """
+        self.database.save_to_database(self.make_key(prompt), content)
+
+    def get_saved_keys(self):
+        """Returns the keys of all the chunks saved for the job."""
+        return [key for key in self.database.get_list_keys()
+                if isinstance(key, str) and key.startswith(self.key_prefix)]
+
+    def clear(self):
+        """Removes all the saved chunks of the job."""
+        keys = self.get_saved_keys()
+        logging.debug(f"Clearing {len(keys)} chunks of job {self.job_id}")
+        with self.database.transaction():
+            for key in keys:
+                self.database.reset_key(key)
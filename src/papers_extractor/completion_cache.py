@@ -0,0 +1,279 @@
+# This file contains a cache of chat completions stored in the local database.
+# Completions are addressed by the model, the prompt and the sampling
+# parameters of the call so an identical call is never paid for twice. The
+# number of cached completions is bounded and the least recently used ones
+# are evicted first.
+import logging
+import threading
+import weakref
+from papers_extractor.database_parser import LocalDatabase, hash_variable
+
+# All the keys of the cache start with this prefix so they can be told apart
+# from the papers and texts saved in the same database.
+CACHE_KEY_PREFIX = "completion_cache_"
+
+# Each use of a completion is appended to a queue saved under this prefix, so
+# the least recently used completions are at its front and eviction never
+# scans the keys of the database.
+CACHE_LOG_PREFIX = CACHE_KEY_PREFIX + "log"
+
+# This key holds the number of entries of the queue of uses.
+CACHE_LOG_SIZE_KEY = CACHE_KEY_PREFIX + "log_size"
+
+# The key of the last use of each completion in the queue is saved under this
+# prefix. Older entries of the same completion in the queue are stale.
+CACHE_ACCESS_PREFIX = CACHE_KEY_PREFIX + "access_"
+
+# This key holds the number of cached completions.
+CACHE_SIZE_KEY = CACHE_KEY_PREFIX + "size"
+
+# When the cache is full, this fraction of max_entries is evicted on top of
+# the completions over the limit, so eviction runs in batches instead of on
+# every new completion.
+CACHE_CULL_FRACTION = 0.1
+
+# The queue of uses is rebuilt without its stale entries once it holds this
+# many times max_entries entries.
+CACHE_LOG_COMPACT_FACTOR = 2
+
+# The caches shared by all the users of a database.
+_shared_caches = weakref.WeakKeyDictionary()
+_shared_caches_lock = threading.Lock()
+
+
+def get_completion_cache(local_database):
+    """Returns the completion cache shared by all the users of a database.
+    Args:
+        local_database (LocalDatabase): The database of the cache.
+    Returns:
+        CompletionCache: The cache, created on first use.
+    """
+    with _shared_caches_lock:
+        if local_database not in _shared_caches:
+            _shared_caches[local_database] = CompletionCache(local_database)
+        return _shared_caches[local_database]
+
+
+class CompletionCache:
+    """This class caches the text generated by chat completions in a
+    LocalDatabase. By default only calls at temperature 0 are cached as other
+    calls are expected to give a different answer each time. Each completion
+    is saved under its own key with the time it was last used, so several
+    caches can share a database.
+    """
+
+    def __init__(self, local_database=None, max_entries=10000,
+                 cache_all_temperatures=False):
+        """Initializes the cache.
+        Args:
+            local_database (LocalDatabase): The database to store the
+            completions in. If None, a temporary database is used.
+            Defaults to None.
+            max_entries (int): The largest number of completions kept.
+            Defaults to 10000.
+            cache_all_temperatures (bool): If True, calls at any temperature
+            are cached. Defaults to False.
+        Returns:
+            None
+        """
+        if local_database is None:
+            local_database = LocalDatabase()
+        self.database = local_database
+        self.max_entries = max_entries
+        self.cache_all_temperatures = cache_all_temperatures
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, prompt, temperature, presence_penalty,
+                 frequency_penalty):
+        """Creates the database key of a call.
+        Args:
+            model (str): The model of the call.
+            prompt (str): The prompt of the call.
+            temperature (float): The temperature of the call.
+            presence_penalty (float): The presence penalty of the call.
+            frequency_penalty (float): The frequency penalty of the call.
+        Returns:
+            str: The key of the call.
+        """
+        # Parameters are normalized so 0 and 0.0 give the same key
+        parameters = (model, float(temperature), float(presence_penalty),
+                      float(frequency_penalty))
+        return CACHE_KEY_PREFIX + hash_variable(parameters) + \
+            hash_variable(prompt)
+
+    @staticmethod
+    def make_access_key(key):
+        """Returns the key of the last access time of a completion."""
+        return CACHE_ACCESS_PREFIX + key[len(CACHE_KEY_PREFIX):]
+
+    def _record_access(self, key):
+        """Appends a use of a completion to the queue of uses. This is
+        called within a transaction.
+        Returns:
+            int: The number of entries in the queue.
+        """
+        log_key = self.database.push_to_queue(CACHE_LOG_PREFIX, key)
+        self.database.save_to_database(self.make_access_key(key), log_key)
+        return self.database.increment(CACHE_LOG_SIZE_KEY)
+
+    def _touch(self, key):
+        """Marks a completion as the most recently used. This is called
+        within a transaction."""
+        if self._record_access(key) > \
+                CACHE_LOG_COMPACT_FACTOR * max(self.max_entries, 1):
+            self._compact_log()
+
+    def _pull_oldest(self):
+        """Removes the least recently used completion from the queue of
+        uses, skipping the stale entries. This is called within a
+        transaction.
+        Returns:
+            str: The key of the completion or None if the queue is empty.
+        """
+        while True:
+            log_key, key = self.database.pull_from_queue(CACHE_LOG_PREFIX)
+            if log_key is None:
+                return None
+            self.database.increment(CACHE_LOG_SIZE_KEY, -1)
+            access_key = self.make_access_key(key)
+            if self.database.check_in_database(access_key) and \
+                    self.database.load_from_database(access_key) == log_key:
+                return key
+
+    def _compact_log(self):
+        """Rebuilds the queue of uses with only the last use of each
+        completion, in the same order. This is called within a
+        transaction."""
+        keys = []
+        while True:
+            key = self._pull_oldest()
+            if key is None:
+                break
+            keys.append(key)
+        self.database.save_to_database(CACHE_LOG_SIZE_KEY, 0)
+        for key in keys:
+            self._record_access(key)
+        logging.debug(f"Compacted the cache log to {len(keys)} entries")
+
+    def is_cacheable(self, temperature):
+        """Checks if calls at a given temperature are cached."""
+        return self.cache_all_temperatures or temperature == 0
+
+    def get(self, model, prompt, temperature=0, presence_penalty=0.0,
+            frequency_penalty=0.0):
+        """Returns the cached completion of a call.
+        Args:
+            model (str): The model of the call.
+            prompt (str): The prompt of the call.
+            temperature (float): The temperature of the call.
+            presence_penalty (float): The presence penalty of the call.
+            frequency_penalty (float): The frequency penalty of the call.
+        Returns:
+            str: The cached completion or None if it is not cached.
+        """
+        if not self.is_cacheable(temperature):
+            return None
+        key = self.make_key(model, prompt, temperature, presence_penalty,
+                            frequency_penalty)
+        with self._lock, self.database.transaction():
+            if not self.database.check_in_database(key):
+                self.misses += 1
+                return None
+            # We save the access so the completion is evicted last
+            self._touch(key)
+            self.hits += 1
+            logging.debug("Completion found in cache")
+            return self.database.load_from_database(key)
+
+    def peek(self, model, prompt, temperature=0, presence_penalty=0.0,
+             frequency_penalty=0.0):
+        """Returns the cached completion of a call without counting a hit
+        or a miss, for example to plan work.
+        Args:
+            model (str): The model of the call.
+            prompt (str): The prompt of the call.
+            temperature (float): The temperature of the call.
+            presence_penalty (float): The presence penalty of the call.
+            frequency_penalty (float): The frequency penalty of the call.
+        Returns:
+            str: The cached completion or None if it is not cached.
+        """
+        if not self.is_cacheable(temperature):
+            return None
+        key = self.make_key(model, prompt, temperature, presence_penalty,
+                            frequency_penalty)
+        try:
+            return self.database.load_from_database(key)
+        except KeyError:
+            return None
+
+    def set(self, model, prompt, completion, temperature=0,
+            presence_penalty=0.0, frequency_penalty=0.0):
+        """Saves the completion of a call.
+        Args:
+            model (str): The model of the call.
+            prompt (str): The prompt of the call.
+            completion (str): The text generated by the call.
+            temperature (float): The temperature of the call.
+            presence_penalty (float): The presence penalty of the call.
+            frequency_penalty (float): The frequency penalty of the call.
+        Returns:
+            None
+        """
+        if not self.is_cacheable(temperature) or self.max_entries <= 0:
+            return
+        key = self.make_key(model, prompt, temperature, presence_penalty,
+                            frequency_penalty)
+        with self._lock, self.database.transaction():
+            is_new = not self.database.check_in_database(key)
+            self.database.save_to_database(key, completion)
+            self._touch(key)
+            if is_new:
+                size = self.database.increment(CACHE_SIZE_KEY)
+                if size > self.max_entries:
+                    self._evict(size)
+
+    def _evict(self, size):
+        """Removes the least recently used completions until the cache is a
+        fraction below max_entries. This is called within a transaction.
+        Args:
+            size (int): The number of cached completions.
+        Returns:
+            None
+        """
+        nb_to_evict = size - self.max_entries + \
+            int(self.max_entries * CACHE_CULL_FRACTION)
+        nb_evicted = 0
+        while nb_evicted < nb_to_evict:
+            key = self._pull_oldest()
+            if key is None:
+                break
+            self.database.reset_key(key)
+            self.database.reset_key(self.make_access_key(key))
+            nb_evicted += 1
+        self.database.increment(CACHE_SIZE_KEY, -nb_evicted)
+        logging.debug(f"Evicted {nb_evicted} completions from the cache")
+
+    def stats(self):
+        """Returns statistics about the cache.
+        Returns:
+            dict: The number of hits, misses and cached completions.
+        """
+        size = 0
+        if self.database.check_in_database(CACHE_SIZE_KEY):
+            size = self.database.load_from_database(CACHE_SIZE_KEY)
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": size, "max_entries": self.max_entries}
+
+    def clear(self):
+        """Removes all the cached completions and resets the statistics."""
+        with self._lock, self.database.transaction():
+            for key in self.database.get_list_keys():
+                if isinstance(key, str) and key.startswith(CACHE_KEY_PREFIX):
+                    self.database.reset_key(key)
+            self.hits = 0
+            self.misses = 0
@@ -4,10 +4,23 @@
 # It also stores the embeddings of the papers to avoid recomputing them.
 # The intent is to allow changing its storage scheme without having to change
 # the rest of the code.
+import asyncio
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from diskcache import Cache
 import hashlib
 
+# The writes made from an event loop are sent to this number of threads so
+# the loop keeps serving other requests while the database is written. A
+# single thread also keeps the writes in order.
+DATABASE_THREADS = 1
+
+# The thread pool is shared by every database of the process.
+_executor = None
+_executor_lock = threading.Lock()
+
 
 def hash_variable(var):
     """This function hashes a variable to use it as a key for the database.
@@ -30,6 +43,33 @@ def hash_file(file_path, algorithm='sha256'):
     return hasher.hexdigest()
 
 
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=DATABASE_THREADS,
+                    thread_name_prefix="database")
+    return _executor
+
+
+async def run_in_database_thread(function, *args, **kwargs):
+    """Runs a function that writes to a database in the thread of the
+    databases, so the event loop is not blocked while it runs.
+    Args:
+        function (callable): The function to run, for example
+        LocalDatabase.save_to_database or CompletionCache.set.
+        *args: The arguments of the function.
+        **kwargs: The keyword arguments of the function.
+    Returns:
+        object: What the function returns.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(function, *args, **kwargs))
+
+
 class LocalDatabase:
     """This class is used to handle accesses to our local database."""
 
@@ -102,6 +142,14 @@ class LocalDatabase:
         """
         self.database[key] = value
 
+    def transaction(self):
+        """Returns a context manager that groups all the writes made within
+        it in a single transaction. This is much faster to save many values.
+        Returns:
+            contextmanager: The transaction context manager.
+        """
+        return self.database.transact()
+
     def load_from_database(self, key):
         """Loads a value from the database.
         Args:
@@ -111,6 +159,36 @@ class LocalDatabase:
         """
         return self.database[key]
 
+    def increment(self, key, delta=1):
+        """Adds to a number saved in the database in a single operation.
+        Args:
+            key (str): The key to use for the database.
+            delta (int): The number to add. Defaults to 1.
+        Returns:
+            int: The new value, starting from 0 if the key was not saved.
+        """
+        return self.database.incr(key, delta, default=0)
+
+    def push_to_queue(self, prefix, value):
+        """Appends a value to the back of a queue saved in the database.
+        Args:
+            prefix (str): The prefix of the keys of the queue.
+            value (object): The value to append.
+        Returns:
+            str: The key of the value, larger than the keys before it.
+        """
+        return self.database.push(value, prefix=prefix)
+
+    def pull_from_queue(self, prefix):
+        """Removes the value at the front of a queue saved in the database.
+        Args:
+            prefix (str): The prefix of the keys of the queue.
+        Returns:
+            tuple: The key and the value, or (None, None) if the queue is
+            empty.
+        """
+        return self.database.pull(prefix=prefix)
+
     def reset_key(self, key):
         """Resets data associated with a key."""
         logging.debug("Resetting key")
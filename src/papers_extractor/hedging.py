@@ -0,0 +1,117 @@
+# This file contains the policy of hedged chat requests. A few calls to the
+# API take much longer than the others and a single stuck call sets the
+# latency of a whole batch. When a call runs past a percentile of the recent
+# latencies, a duplicate request is sent and the first response wins. The
+# extra requests are capped to a fraction of all the requests.
+import threading
+from collections import deque
+from papers_extractor.telemetry import percentile
+
+
+class HedgingPolicy:
+    """This class decides when a duplicate of a slow request is sent and
+    counts how often the duplicates win. A policy can be shared by several
+    parsers so they learn the latency of the API together.
+    """
+
+    def __init__(self, latency_percentile=0.95, window=200, min_samples=20,
+                 min_delay=1.0, max_extra_fraction=0.05):
+        """Initializes the policy.
+        Args:
+            latency_percentile (float): The percentile of the recent
+            latencies after which a duplicate is sent. Defaults to 0.95.
+            window (int): The number of recent latencies kept. Defaults to
+            200.
+            min_samples (int): The number of latencies needed before any
+            duplicate is sent. Defaults to 20.
+            min_delay (float): The shortest time in seconds before a
+            duplicate is sent. Defaults to 1.
+            max_extra_fraction (float): The largest number of duplicates as
+            a fraction of the requests. Defaults to 0.05.
+        Returns:
+            None
+        """
+        self.latency_percentile = latency_percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_extra_fraction = max_extra_fraction
+        self.nb_requests = 0
+        self.nb_hedges = 0
+        self.nb_hedge_wins = 0
+        self.nb_skipped = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_latency(self, latency):
+        """Adds the time taken to get a response.
+        Args:
+            latency (float): The time in seconds.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._latencies.append(latency)
+
+    def record_timeout(self, timeout):
+        """Adds a request that timed out as a censored latency. Its real
+        latency is unknown but at least the timeout, so the timeout is kept
+        in its place. Leaving it out would only keep the fast requests and
+        lower the hedge delay.
+        Args:
+            timeout (float): The timeout in seconds.
+        Returns:
+            None
+        """
+        self.record_latency(timeout)
+
+    def get_hedge_delay(self):
+        """Returns how long to wait for a response before sending a
+        duplicate, and counts a request.
+        Returns:
+            float: The delay in seconds or None if there are not enough
+            latencies yet.
+        """
+        with self._lock:
+            self.nb_requests += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            delay = percentile(sorted(self._latencies),
+                               self.latency_percentile)
+            return max(self.min_delay, delay)
+
+    def try_hedge(self):
+        """Takes a duplicate from the budget of extra requests.
+        Returns:
+            bool: True if the duplicate can be sent.
+        """
+        with self._lock:
+            if self.nb_hedges + 1 > self.max_extra_fraction * \
+                    self.nb_requests:
+                self.nb_skipped += 1
+                return False
+            self.nb_hedges += 1
+            return True
+
+    def record_hedge_win(self):
+        """Counts a duplicate that answered before the original request."""
+        with self._lock:
+            self.nb_hedge_wins += 1
+
+    def stats(self):
+        """Returns statistics about the hedges.
+        Returns:
+            dict: The number of requests, of duplicates sent, of duplicates
+            that answered first and of duplicates not sent because of the
+            budget, and the current hedge delay.
+        """
+        with self._lock:
+            delay = None
+            if len(self._latencies) >= self.min_samples:
+                delay = max(self.min_delay,
+                            percentile(sorted(self._latencies),
+                                       self.latency_percentile))
+            return {"nb_requests": self.nb_requests,
+                    "nb_hedges": self.nb_hedges,
+                    "nb_hedge_wins": self.nb_hedge_wins,
+                    "nb_skipped": self.nb_skipped,
+                    "hedge_delay": delay}
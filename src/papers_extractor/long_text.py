@@ -4,17 +4,34 @@
 import logging
 from papers_extractor.openai_parsers import OpenaiLongParser
 from papers_extractor.database_parser import hash_variable
+from papers_extractor.completion_cache import get_completion_cache
+from papers_extractor.request_scheduler import DEFAULT_PRIORITY
+from papers_extractor.summary_tree import SummaryTree
 from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
 import numpy as np
 
+# The largest text that can be cleaned up in a single call. The cleaned up
+# text is about as long as its input so both have to fit in the 4k context.
+CLEANUP_CHUNK_SIZE = {'words': 2000, 'model_tokens': 1800}
+
+# These prompts are used to summarize the chunks of a text and to clean up
+# the final summary. Both are sent with SUMMARY_PARAMETERS.
+SUMMARY_PROMPT = "Write a long, very detailed summary for a " + \
+    "technical expert of the following paragraph, from" + \
+    " a paper, refering to the text as -This publication-:"
+SUMMARY_CLEANUP_PROMPT = "Can you clean up this publication summary to " + \
+    "make it flow logically. Keep this summary very " + \
+    "technical and detailed:"
+SUMMARY_PARAMETERS = {'temperature': 0, 'presence_penalty': -0.5}
+
 
 class LongText:
     """This class is used to process a long text through Large Language Models.
     It will be processed in chunks of a given size if needed."""
 
     def __init__(self, longtext, chunk_size=1400, local_database=None,
-                 database_id='auto'):
+                 database_id='auto', chunk_unit='words'):
         """Initializes the class with the long text.
         Args:
             longtext (str): The long text to summarize.
@@ -26,13 +43,19 @@ class LongText:
             it will be generated from the long text and the chunk size.
             We recommend using the DOI of the paper. Defaults
             to auto.
+            chunk_unit (str): The unit of chunk_size. Can be 'words' or
+            'model_tokens' to pack chunks up to chunk_size tokens of the
+            model, which gives fewer and fuller chunks. Defaults to 'words'.
         Returns:
             None
         """
         self.longtext = longtext
         self.chunk_size = chunk_size
+        self.chunk_unit = chunk_unit
         self.database = local_database
         self.summary = None
+        # The summaries are kept for each final_chunk_length requested
+        self.summaries = {}
         self.embedding = None
         self.database_id = database_id
 
@@ -42,6 +65,9 @@ class LongText:
             if database_id == 'auto':
                 self.database_id = hash_variable(self.longtext) + \
                     hash_variable(self.chunk_size)
+                # Keys of texts chunked in words are kept as they were
+                if self.chunk_unit != 'words':
+                    self.database_id += hash_variable(self.chunk_unit)
             else:
                 self.database_id = database_id
             logging.debug("Database key for long text: {}"
@@ -61,6 +87,22 @@ class LongText:
             logging.debug("Saving long text to database")
             self.database.save_class_to_database(self.database_id, self)
 
+    def get_saved_summary(self, final_chunk_length):
+        """Returns the summary already made for a final number of chunks.
+        Args:
+            final_chunk_length (int): The final number of chunks.
+        Returns:
+            list: The summary or None if it was not made yet.
+        """
+        if final_chunk_length in self.summaries:
+            return self.summaries[final_chunk_length]
+        # Summaries saved before they were kept per final_chunk_length are
+        # only reused when they have the requested number of chunks.
+        if not self.summaries and self.summary is not None \
+                and len(self.summary) == final_chunk_length:
+            return self.summary
+        return None
+
     def get_average_embedding(self):
         """Returns the average embedding of the long text."""
         if self.embedding is None:
@@ -130,7 +172,8 @@ class LongText:
             logging.debug("Calculating embedding for long text")
             if parser == "GPT":
                 local_openai = OpenaiLongParser(self.longtext,
-                                                chunk_size=self.chunk_size)
+                                                chunk_size=self.chunk_size,
+                                                chunk_unit=self.chunk_unit)
                 self.embedding, self.chunks = \
                     local_openai.process_chunks_through_embedding()
                 self.save_database()
@@ -142,7 +185,9 @@ class LongText:
             self,
             final_chunk_length=2,
             save_path_summary=None,
-            max_concurrent_calls=10):
+            max_concurrent_calls=10,
+            partial_callback=None,
+            priority=DEFAULT_PRIORITY):
         """This function summarizes a long text into chunks.
         Args:
             final_chunk_length (int): The final number of chunks to have.
@@ -151,36 +196,46 @@ class LongText:
             Defaults to None.
             max_concurrent_calls (int): The maximum number of concurrent calls
             to the Openai API. Defaults to 10.
+            partial_callback (callable): If given, the final clean up is
+            streamed and this is called with the index of the chunk and the
+            text received so far. Defaults to None.
+            priority (str): The priority class of the calls in the shared
+            scheduler. Defaults to DEFAULT_PRIORITY.
         Returns:
             final_text (list): A list of the summary for each chunk.
         """
 
-        openai_prompt = "Write a long, very detailed summary for a " + \
-            "technical expert of the following paragraph, from" + \
-            " a paper, refering to the text as -This publication-:"
-
         # We check if the summary is already available
-        if self.summary is None:
-            current_text = self.longtext
-
-            # we initialize the number of chunks to a large number
-            nb_chunks = final_chunk_length + 1
+        saved_summary = self.get_saved_summary(final_chunk_length)
+        if saved_summary is not None:
+            self.summary = saved_summary
+        else:
+            # Completions already made with the same prompt are reused, for
+            # example the clean up of the same top level of the tree.
+            completion_cache = None
+            if self.database is not None:
+                completion_cache = get_completion_cache(self.database)
 
+            # The chunks are summarized in a tree where each node starts as
+            # soon as its children are done. Nodes and levels are saved in the
+            # database so another final_chunk_length reuses the levels below.
             logging.debug("Summarizing the text in chunks")
-            while True:
-                local_openai = OpenaiLongParser(
-                    current_text,
-                    chunk_size=self.chunk_size,
-                    max_concurrent_calls=max_concurrent_calls)
-                nb_chunks = len(local_openai.chunks)
-                if nb_chunks <= final_chunk_length:
-                    break
-                logging.debug(f"Summarizing chunks:{nb_chunks}")
-
-                summarized_chunks = local_openai.process_chunks_through_prompt(
-                    openai_prompt, temperature=0, presence_penalty=-0.5
-                )
-                current_text = "\n".join(summarized_chunks)
+            summary_tree = SummaryTree(
+                SUMMARY_PROMPT,
+                chunk_size=self.chunk_size,
+                chunk_unit=self.chunk_unit,
+                final_chunk_length=final_chunk_length,
+                max_concurrent_calls=max_concurrent_calls,
+                local_database=self.database,
+                completion_cache=completion_cache,
+                priority=priority,
+                **SUMMARY_PARAMETERS)
+            top_texts = summary_tree.summarize(self.longtext)
+            logging.debug(f"Summary tree: {summary_tree.stats()}")
+            if summary_tree.depth == 0:
+                current_text = self.longtext
+            else:
+                current_text = "\n".join(top_texts)
 
             # This is in case the text is too long to fit in a single chunk
             final_text = current_text
@@ -189,16 +244,18 @@ class LongText:
             # Here the chunk size is fixed to maximize the number of tokens
             final_long = OpenaiLongParser(
                 current_text,
-                chunk_size=2000,
-                max_concurrent_calls=max_concurrent_calls)
+                chunk_size=CLEANUP_CHUNK_SIZE[self.chunk_unit],
+                max_concurrent_calls=max_concurrent_calls,
+                chunk_unit=self.chunk_unit,
+                completion_cache=completion_cache,
+                priority=priority)
             if final_long.num_chunks == 1:
                 logging.debug("Cleaning up the summary")
 
-                prompt = "Can you clean up this publication summary to " + \
-                    "make it flow logically. Keep this summary very " + \
-                    "technical and detailed:"
                 final_text = final_long.process_chunks_through_prompt(
-                    prompt, temperature=0, presence_penalty=-0.5
+                    SUMMARY_CLEANUP_PROMPT, **SUMMARY_PARAMETERS,
+                    stream=partial_callback is not None,
+                    partial_callback=partial_callback
                 )
 
             # We save the summary in a txt file
@@ -207,6 +264,7 @@ class LongText:
                     f.write("/n".join(final_text))
 
             self.summary = final_text
+            self.summaries[final_chunk_length] = final_text
             self.save_database()
 
         return self.summary
@@ -0,0 +1,343 @@
+# This file contains a local stand-in for the OpenAI API. It answers the chat
+# completion and embeddings endpoints without a key or network access so
+# the request machinery can be tested and benchmarked offline. Its latency
+# can follow a distribution and it can inject the failures of the real API:
+# 429 errors, requests that never answer and truncated replies.
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+import openai
+from aiohttp import web
+
+
+def _make_reply(prompt, reply_ratio):
+    """Builds a deterministic reply from the last paragraph of a prompt. If
+    the last paragraph is a JSON object of texts, as in a packed prompt, the
+    reply is a JSON object with the reply to each text."""
+    last_paragraph = prompt.split("\n\n")[-1]
+    if last_paragraph.startswith("{"):
+        try:
+            items = json.loads(last_paragraph)
+        except ValueError:
+            items = None
+        if isinstance(items, dict):
+            return json.dumps({key: _make_reply(str(value), reply_ratio)
+                               for key, value in items.items()})
+    words = last_paragraph.split()
+    nb_words = max(1, int(len(words) * reply_ratio))
+    return " ".join(words[:nb_words])
+
+
+def make_mock_embedding(text, dimension=1536):
+    """Builds a deterministic unit vector from a text. The same text always
+    gets the same vector.
+    Args:
+        text (str): The embedded text.
+        dimension (int): The size of the vector. Defaults to 1536.
+    Returns:
+        list: The embedding.
+    """
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest(), "big")
+    generator = random.Random(seed)
+    vector = [generator.gauss(0, 1) for _ in range(dimension)]
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+def lognormal_latency(median, sigma=0.5, seed=None):
+    """Returns a latency sampler following a log-normal distribution, which
+    has the long tail of the latencies of the real API.
+    Args:
+        median (float): The median latency in seconds.
+        sigma (float): The standard deviation of the log of the latency.
+        Defaults to 0.5.
+        seed (int): The seed of the random generator. Defaults to None.
+    Returns:
+        callable: A function without arguments that returns a latency.
+    """
+    generator = random.Random(seed)
+    return lambda: generator.lognormvariate(math.log(median), sigma)
+
+
+def uniform_latency(low, high, seed=None):
+    """Returns a latency sampler following a uniform distribution.
+    Args:
+        low (float): The smallest latency in seconds.
+        high (float): The largest latency in seconds.
+        seed (int): The seed of the random generator. Defaults to None.
+    Returns:
+        callable: A function without arguments that returns a latency.
+    """
+    generator = random.Random(seed)
+    return lambda: generator.uniform(low, high)
+
+
+class MockOpenaiServer:
+    """This class runs a fake OpenAI API server in a background thread.
+    Use it as a context manager to point the openai library to it.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0,
+                 reply_ratio=0.5, requests_per_window=None,
+                 rate_window=60.0, token_latency=0.0, throttle_rate=0.0,
+                 timeout_rate=0.0, length_rate=0.0, hang_time=30.0,
+                 injected_retry_after=0.1, seed=None):
+        """Initializes the server.
+        Args:
+            host (str): The host to listen on. Defaults to 127.0.0.1.
+            port (int): The port to listen on. If 0, a free port is picked.
+            Defaults to 0.
+            latency (float or callable): The time in seconds to answer a
+            request, or a function without arguments that draws it, like
+            lognormal_latency. Defaults to 0.
+            reply_ratio (float): The length of the reply relative to the last
+            paragraph of the prompt. Defaults to 0.5.
+            requests_per_window (int): The number of requests accepted per
+            rate window. Requests above are refused with a 429 error and a
+            Retry-After header. If None, there is no limit. Defaults to None.
+            rate_window (float): The duration of the rate window in seconds.
+            Defaults to 60.
+            token_latency (float): The time in seconds to generate each word
+            of a reply. A streamed reply sends its first word after latency
+            and the next ones every token_latency, while other replies are
+            sent once all the words are generated. Defaults to 0.
+            throttle_rate (float): The fraction of requests refused with a
+            429 error at random. Defaults to 0.
+            timeout_rate (float): The fraction of requests that do not
+            answer before hang_time, so the client times out. Defaults to 0.
+            length_rate (float): The fraction of chat replies that stop with
+            finish_reason 'length'. Defaults to 0.
+            hang_time (float): The time in seconds a request selected by
+            timeout_rate waits before answering. Defaults to 30.
+            injected_retry_after (float): The Retry-After delay in seconds of
+            the 429 errors injected by throttle_rate. Defaults to 0.1.
+            seed (int): The seed of the random generator of the injected
+            failures. Defaults to None.
+        Returns:
+            None
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.reply_ratio = reply_ratio
+        self.requests_per_window = requests_per_window
+        self.rate_window = rate_window
+        self.token_latency = token_latency
+        self.throttle_rate = throttle_rate
+        self.timeout_rate = timeout_rate
+        self.length_rate = length_rate
+        self.hang_time = hang_time
+        self.injected_retry_after = injected_retry_after
+        self._random = random.Random(seed)
+
+        self.nb_requests = 0
+        self.nb_throttled = 0
+        self.nb_embedded_inputs = 0
+        self.nb_hung = 0
+        self.nb_truncated = 0
+        self._request_times = deque()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._previous_api = None
+
+    @property
+    def url(self):
+        """The base url of the API served."""
+        return f"http://{self.host}:{self.port}/v1"
+
+    def _check_rate(self):
+        """Returns the Retry-After delay if the request is over the limit."""
+        if self.requests_per_window is None:
+            return None
+        now = time.monotonic()
+        while self._request_times and \
+                now - self._request_times[0] >= self.rate_window:
+            self._request_times.popleft()
+        if len(self._request_times) >= self.requests_per_window:
+            return self.rate_window - (now - self._request_times[0])
+        self._request_times.append(now)
+        return None
+
+    def _throttled_response(self, retry_after):
+        self.nb_throttled += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached", "type": "requests",
+                       "param": None, "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"Retry-After": str(math.ceil(retry_after * 100) / 100)})
+
+    def _sample_latency(self):
+        if callable(self.latency):
+            return max(0.0, self.latency())
+        return self.latency
+
+    async def _inject_failure(self):
+        """Returns a 429 response or waits for hang_time, at random. Returns
+        None if the request should be answered."""
+        retry_after = self._check_rate()
+        if retry_after is not None:
+            return self._throttled_response(retry_after)
+        if self._random.random() < self.throttle_rate:
+            return self._throttled_response(self.injected_retry_after)
+        if self._random.random() < self.timeout_rate:
+            self.nb_hung += 1
+            await asyncio.sleep(self.hang_time)
+        return None
+
+    async def _chat_completions(self, request):
+        self.nb_requests += 1
+        failure = await self._inject_failure()
+        if failure is not None:
+            return failure
+
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]
+        await asyncio.sleep(self._sample_latency())
+        content = _make_reply(prompt, self.reply_ratio)
+        finish_reason = "stop"
+        if self._random.random() < self.length_rate:
+            self.nb_truncated += 1
+            finish_reason = "length"
+        if body.get("stream"):
+            return await self._stream_reply(request, body, content,
+                                            finish_reason)
+        # Longer replies take longer to generate, as with the real API
+        await asyncio.sleep(self.token_latency * len(content.split()))
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(content.split())
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant",
+                                     "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    async def _stream_reply(self, request, body, content, finish_reason):
+        """Sends a reply as server-sent events, one word per event."""
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        words = content.split(" ")
+        deltas = [{"role": "assistant"}] + [
+            {"content": word if index == 0 else " " + word}
+            for index, word in enumerate(words)]
+        for index, delta in enumerate(deltas):
+            if index > 1:
+                await asyncio.sleep(self.token_latency)
+            await self._send_event(response, completion_id, body, delta, None)
+        await self._send_event(response, completion_id, body, {},
+                               finish_reason)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    async def _send_event(response, completion_id, body, delta,
+                          finish_reason):
+        event = {"id": completion_id,
+                 "object": "chat.completion.chunk",
+                 "created": int(time.time()),
+                 "model": body.get("model", "gpt-3.5-turbo"),
+                 "choices": [{"index": 0, "delta": delta,
+                              "finish_reason": finish_reason}]}
+        await response.write(f"data: {json.dumps(event)}\n\n".encode())
+
+    async def _embeddings(self, request):
+        self.nb_requests += 1
+        failure = await self._inject_failure()
+        if failure is not None:
+            return failure
+
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.nb_embedded_inputs += len(inputs)
+        await asyncio.sleep(self._sample_latency())
+        prompt_tokens = sum(len(text.split()) for text in inputs)
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model", "text-embedding-ada-002"),
+            "data": [{"object": "embedding", "index": index,
+                      "embedding": make_mock_embedding(text)}
+                     for index, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "total_tokens": prompt_tokens},
+        })
+
+    def _make_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        app.router.add_post("/v1/embeddings", self._embeddings)
+        return app
+
+    def start(self):
+        """Starts the server in a background thread."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            # Requests left hanging do not delay the shutdown
+            self._runner = web.AppRunner(self._make_app(),
+                                         shutdown_timeout=0.1)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            self.port = self._runner.addresses[0][1]
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        logging.debug(f"Mock OpenAI server listening on {self.url}")
+
+    async def _shutdown(self):
+        # We cancel the requests left hanging and wait for them to end before
+        # the server is cleaned up, so no task is destroyed while pending.
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._runner.cleanup()
+
+    def stop(self):
+        """Stops the server."""
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        self.start()
+        self._previous_api = (openai.api_base, openai.api_key)
+        openai.api_base = self.url
+        if openai.api_key is None:
+            openai.api_key = "mock-key"
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        openai.api_base, openai.api_key = self._previous_api
+        self.stop()
+        return False
@@ -5,6 +5,8 @@ import logging
 from sklearn.manifold import TSNE
 import colorsys
 from papers_extractor.unique_paper import UniquePaper
+from papers_extractor.openai_parsers import OpenaiLongParser, embed_texts, \
+    process_items_through_prompt
 from bokeh.plotting import figure, show, output_file
 from bokeh.models import HoverTool, ColumnDataSource
 from bokeh.models import Scatter
@@ -45,23 +47,120 @@ class MultiPaper:
         self.papers_list = papers_list
         self.papers_embedding = None
 
-    def get_embedding_all_papers(self, field='abstract'):
-        """This is used to extract all paper embedding to make comparisons"""
+    def get_embedding_all_papers(self, field='abstract',
+                                 max_concurrent_calls=8):
+        """This is used to extract all paper embedding to make comparisons.
+        Papers that do not have an embedding yet are embedded together in
+        large concurrent requests.
+        Args:
+            field (str): The field to use for the embedding. Defaults to
+            'abstract'.
+            max_concurrent_calls (int): The maximum number of concurrent
+            calls to the OpenAI API. Defaults to 8.
+        Returns:
+            list: The embedding of each paper.
+        """
         if not self.papers_embedding:
+            missing_papers = [
+                indiv_paper for indiv_paper in self.papers_list
+                if getattr(indiv_paper, f"{field}_embedding") is None]
+            logging.info(("Papers missing an embedding: " +
+                          f"{len(missing_papers)} / {len(self.papers_list)}"))
+            if missing_papers:
+                self.calculate_missing_embeddings(
+                    missing_papers, field=field,
+                    max_concurrent_calls=max_concurrent_calls)
+
             # We set the embedding
-            self.papers_embedding = []
-
-            for index, indiv_paper in enumerate(self.papers_list):
-                paper_embedding = indiv_paper.calculate_embedding(field=field)
-                # We save the database after each paper embedding is calculated
-                indiv_paper.save_database()
-                self.papers_embedding.append(paper_embedding)
-                logging.debug(
-                    f"Embedding for paper {indiv_paper.identifier} calculated")
-                logging.info(("Papers embedding processed: " +
-                              f"{index} / {len(self.papers_list)}"))
+            self.papers_embedding = [
+                getattr(indiv_paper, f"{field}_embedding")
+                for indiv_paper in self.papers_list]
         return self.papers_embedding
 
+    def calculate_missing_embeddings(self, missing_papers, field='abstract',
+                                     max_concurrent_calls=8):
+        """Calculates the embedding of many papers at once. The chunks of all
+        the papers are sent together and the papers are saved in a single
+        transaction per database.
+        Args:
+            missing_papers (list): The list of UniquePaper to embed.
+            field (str): The field to use for the embedding. Defaults to
+            'abstract'.
+            max_concurrent_calls (int): The maximum number of concurrent
+            calls to the OpenAI API. Defaults to 8.
+        Returns:
+            None
+        """
+        # We keep where the chunks of each paper are in the list of texts
+        submit_texts = []
+        chunk_ranges = []
+        for indiv_paper in missing_papers:
+            local_text = indiv_paper.get_field_text(field)
+            chunks = OpenaiLongParser(local_text).chunks
+            start_idx = len(submit_texts)
+            # As in process_chunks_through_embedding, chunks end with a "."
+            submit_texts.extend(chunk + "." for chunk in chunks)
+            chunk_ranges.append((start_idx, len(submit_texts)))
+
+        def log_progress(nb_done, nb_total):
+            logging.info(("Papers embedding chunks processed: " +
+                          f"{nb_done} / {nb_total}"))
+
+        # Embedding a corpus is bulk work that gives way to interactive jobs
+        embeddings = embed_texts(submit_texts,
+                                 max_concurrent_calls=max_concurrent_calls,
+                                 progress_callback=log_progress,
+                                 priority="bulk")
+        for indiv_paper, (start_idx, end_idx) in zip(missing_papers,
+                                                     chunk_ranges):
+            setattr(indiv_paper, f"{field}_embedding",
+                    embeddings[start_idx:end_idx])
+            logging.debug(
+                f"Embedding for paper {indiv_paper.identifier} calculated")
+
+        self.save_papers_database(missing_papers)
+
+    def process_papers_through_prompt(self, prompt, field='abstract',
+                                      max_concurrent_calls=8, **kwargs):
+        """Applies a prompt to a field of each paper, for example to extract
+        the methods of each abstract of a PubMed query. The fields are short
+        so several of them are packed in each request.
+        Args:
+            prompt (str): The prompt to apply to the field of each paper.
+            field (str): The field to process. Defaults to 'abstract'.
+            max_concurrent_calls (int): The maximum number of concurrent
+            calls to the OpenAI API. Defaults to 8.
+            **kwargs: The options of process_items_through_prompt.
+        Returns:
+            list: The generated text of each paper.
+        """
+        items = [indiv_paper.get_field_text(field)
+                 for indiv_paper in self.papers_list]
+        return process_items_through_prompt(
+            items, prompt, max_concurrent_calls=max_concurrent_calls,
+            **kwargs)
+
+    def save_papers_database(self, papers):
+        """Saves many papers to their database with one transaction per
+        database.
+        Args:
+            papers (list): The list of UniquePaper to save.
+        Returns:
+            None
+        """
+        papers_per_database = {}
+        for indiv_paper in papers:
+            if indiv_paper.database is not None:
+                papers_per_database.setdefault(
+                    id(indiv_paper.database),
+                    (indiv_paper.database, []))[1].append(indiv_paper)
+
+        for database, database_papers in papers_per_database.values():
+            with database.transaction():
+                for indiv_paper in database_papers:
+                    indiv_paper.save_database()
+            logging.info(f"Saved {len(database_papers)} papers to database")
+
     def plot_paper_embedding_map(
         self,
         save_path=None,
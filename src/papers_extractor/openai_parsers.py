@@ -2,15 +2,54 @@
 # Some functions will enable processing a prompt in chunks to bypass the
 # tokens limit.
 import asyncio
+import bisect
+import contextlib
+import functools
+import itertools
+import json
 import logging
 import os
 import time
-import nltk
 import openai
-import tiktoken
-from nltk.tokenize import word_tokenize
+from papers_extractor.async_runner import get_async_runner
+from papers_extractor.database_parser import run_in_database_thread
+from papers_extractor.rate_limiter import get_rate_limiter, get_retry_after
+from papers_extractor.request_scheduler import get_scheduler, \
+    DEFAULT_PRIORITY, DeadlineExceededError
+from papers_extractor.single_flight import get_single_flight
+from papers_extractor.telemetry import emit_event, telemetry_enabled
+from papers_extractor.text_tokenizers import get_tokenizer_backend
+from papers_extractor.token_counter import (async_count_tokens_batch,
+                                            get_encoder, get_token_counter)
 
-nltk.download("punkt")
+# These are the models used for text generation and embeddings.
+CHAT_MODEL = "gpt-3.5-turbo"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# The number of times a request refused with a 429 error is sent again.
+MAX_RATE_LIMIT_RETRIES = 10
+
+# The embeddings endpoint accepts up to 2048 inputs per request. We also cap
+# the tokens of each request so a resent request stays cheap.
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_TOKENS_PER_REQUEST = 20000
+
+# Short texts, like abstracts, are packed in one chat request up to these
+# limits. The reply is about as long as the prompt so a pack stays well
+# within the context of the model.
+PACKED_ITEMS_PER_REQUEST = 20
+PACKED_TOKENS_PER_REQUEST = 1500
+
+# This is added to the prompt of a pack of texts so the reply can be split
+# back into one result per text.
+PACKED_PROMPT = ("Apply the instructions above to each value of the JSON " +
+                 "object below on its own. Reply only with a JSON object " +
+                 "with the same keys and the result of each value as a " +
+                 "string.")
+
+# What a batch of chat calls does when a prompt fails. 'raise' stops the
+# batch while 'partial' returns the results of the other prompts.
+ON_ERROR_POLICIES = ("raise", "partial")
 
 # Below are methods that can be called outside of the class and
 # therefore have a broader scope.
@@ -24,32 +63,96 @@ def count_tokens(texts, model="gpt-3.5-turbo-0301"):
     Returns:
         int: The number of tokens.
     """
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = 0
+    # Each message carries 4 tokens of overhead in the chat format.
+    counts = get_token_counter(model).count_batch(texts)
+    return sum(counts) + 4 * len(counts)
 
-    for message in texts:
-        num_tokens += 4
-        num_tokens += len(encoding.encode(message))
 
-    return num_tokens
+async def async_count_tokens(texts, model="gpt-3.5-turbo-0301"):
+    """Counts the number of tokens in the long texts without blocking the
+    event loop.
+    Args:
+        texts (list): A list of texts.
+        model (str): The model to use.
+    Returns:
+        int: The number of tokens.
+    """
+    counts = await async_count_tokens_batch(texts, model)
+    return sum(counts) + 4 * len(counts)
 
 
-def custom_word_tokenize(text):
-    """Tokenizes a string. Currently using a simpler version of the nltk
-    word_tokenize function.
+def custom_word_tokenize(text, backend=None):
+    """Tokenizes a string. By default this uses a regex tokenizer that
+    follows the nltk word_tokenize function.
     Args:
         text (str): The text to tokenize.
+        backend (str): The tokenizer backend to use, 'regex' or 'nltk'. If
+        None, the default backend is used. Defaults to None.
     Returns:
         list: A list of tokens.
     """
+    tokenizer = get_tokenizer_backend(backend)
+    tokens = []
+    # We tokenize each line separately to keep the line breaks as tokens.
+    for line in text.splitlines():
+        tokens.extend(tokenizer.tokenize(line.strip()))
+        tokens.append("\n")
+    # Remove the last newline token
+    return tokens[:-1]
+
+
+def custom_word_tokenize_with_spans(text, backend=None):
+    """Tokenizes a string and records where each token is in the string.
+    Args:
+        text (str): The text to tokenize.
+        backend (str): The tokenizer backend to use, 'regex' or 'nltk'. If
+        None, the default backend is used. Defaults to None.
+    Returns:
+        tuple: A list of tokens and a list of their (start, end) character
+        offsets in the text.
+    """
+    tokenizer = get_tokenizer_backend(backend)
     lines = text.splitlines(True)
     tokens = []
+    spans = []
+    line_start = 0
     # We tokenize each line separately to keep the line breaks as tokens.
     for line in lines:
-        line_tokens = word_tokenize(line.strip())
+        content = line.splitlines()[0]
+        content_start = line_start + len(content) - len(content.lstrip())
+        line_tokens, line_spans = tokenizer.tokenize_with_spans(
+            content.strip())
         tokens.extend(line_tokens)
+        spans.extend((content_start + start, content_start + end)
+                     for start, end in line_spans)
         tokens.append("\n")
-    return tokens[:-1]  # Remove the last newline token
+        spans.append((line_start + len(content), line_start + len(line)))
+        line_start += len(line)
+    # Remove the last newline token
+    return tokens[:-1], spans[:-1]
+
+
+def find_chunk_span(text, spans, start_idx, end_idx):
+    """Finds the part of a text covered by a range of tokens.
+    Args:
+        text (str): The text that was tokenized.
+        spans (list): The (start, end) character offsets of each token.
+        start_idx (int): The index of the first token of the chunk.
+        end_idx (int): The index after the last token of the chunk.
+    Returns:
+        tuple: The (start, end) character offsets of the chunk.
+    """
+    if start_idx >= end_idx:
+        return (0, 0)
+    char_start = spans[start_idx][0]
+    char_end = spans[end_idx - 1][1]
+
+    # Chunks do not start or end with white spaces or line breaks
+    while char_start < char_end and text[char_start].isspace():
+        char_start += 1
+    while char_end > char_start and text[char_end - 1].isspace():
+        char_end -= 1
+    return char_start, char_end
 
 
 def custom_word_detokenize(tokenized_text):
@@ -82,6 +185,514 @@ def custom_word_detokenize(tokenized_text):
 
     return prompt_text
 
+
+# Tokens at which a chunk is allowed to end.
+SENTENCE_BOUNDARY_TOKENS = frozenset({".", "!", "?"})
+
+# The units in which chunk sizes can be measured. 'words' counts the tokens
+# of custom_word_tokenize while 'model_tokens' counts the BPE tokens the API
+# is billed and limited on.
+CHUNK_UNITS = ("words", "model_tokens")
+
+
+def count_model_tokens_per_word(tokens, model="gpt-3.5-turbo-0301"):
+    """Estimates the number of model tokens of each word token. Each distinct
+    word is only encoded once.
+    Args:
+        tokens (list): A list of word tokens.
+        model (str): The model to count tokens for.
+    Returns:
+        list: The number of model tokens of each word token.
+    """
+    unique_tokens = list(set(tokens))
+    # Words are preceded by a space in running text and tiktoken merges it
+    # with the word.
+    encoded = get_encoder(model).encode_ordinary_batch(
+        [" " + token for token in unique_tokens])
+    weight_per_token = {token: len(token_ids)
+                        for token, token_ids in zip(unique_tokens, encoded)}
+    return [weight_per_token[token] for token in tokens]
+
+
+def find_chunk_boundaries(tokens, chunk_size, token_weights=None):
+    """Finds where to cut a list of tokens into chunks. Chunks end on the last
+    sentence boundary before the chunk size when there is one. The boundaries
+    are found in a single pass so the cost is linear with the number of
+    tokens.
+    Args:
+        tokens (list): A list of tokens.
+        chunk_size (int): The size of each chunk.
+        token_weights (list): The size of each token, for example its number
+        of model tokens. If None, each token counts for one. Defaults to None.
+    Returns:
+        list: A list of (start, end) offsets of each chunk in the tokens.
+    """
+    nb_tokens = len(tokens)
+    if token_weights is None:
+        cumulative_weights = None
+        total_weight = nb_tokens
+    else:
+        cumulative_weights = list(itertools.accumulate(token_weights))
+        total_weight = cumulative_weights[-1] if cumulative_weights else 0
+
+    # last_boundary[idx] is the index of the last sentence boundary at or
+    # before idx, or -1 if there is none.
+    last_boundary = []
+    current_boundary = -1
+    for idx, token in enumerate(tokens):
+        if token in SENTENCE_BOUNDARY_TOKENS:
+            current_boundary = idx
+        last_boundary.append(current_boundary)
+
+    boundaries = []
+    start_idx = 0
+    used_weight = 0
+    while total_weight - used_weight > chunk_size:
+        if cumulative_weights is None:
+            # As before, the token at start + chunk_size can close the chunk.
+            cut_idx = start_idx + chunk_size
+        else:
+            # This is the last token that keeps the chunk within chunk_size.
+            cut_idx = bisect.bisect_right(
+                cumulative_weights, used_weight + chunk_size,
+                lo=start_idx) - 1
+            cut_idx = max(cut_idx, start_idx)
+        end_idx = last_boundary[cut_idx]
+        if end_idx < start_idx:
+            end_idx = cut_idx
+        boundaries.append((start_idx, end_idx + 1))
+        start_idx = end_idx + 1
+        if cumulative_weights is None:
+            used_weight = start_idx
+        else:
+            used_weight = cumulative_weights[end_idx]
+
+    # We do not return an empty chunk when the tokens end on a cut.
+    if start_idx < nb_tokens or nb_tokens == 0:
+        boundaries.append((start_idx, nb_tokens))
+
+    return boundaries
+
+
+def build_chunk_prompt(prompt, chunk):
+    """Builds the text sent to the API to process a chunk with a prompt.
+    Args:
+        prompt (str): The instructions.
+        chunk (str): The chunk of text to process.
+    Returns:
+        str: The text to send.
+    """
+    # ChatGPT has a un-tenable desire to finish sentences so we add a .
+    # at the end of the prompt
+    return prompt + "\n\n" + chunk + "."
+
+
+def estimate_request_tokens(nb_prompt_tokens):
+    """Estimates the tokens used by a chat request, prompt and response.
+    Args:
+        nb_prompt_tokens (int): The number of tokens in the prompt.
+    Returns:
+        int: The estimated number of tokens.
+    """
+    # We expect the response to be about as long as the prompt and the
+    # model cannot use more than 4000 tokens in total.
+    return min(2 * nb_prompt_tokens, 4000)
+
+
+def build_packed_prompt(prompt, items):
+    """Builds the text sent to the API to process several short texts with a
+    prompt in a single request.
+    Args:
+        prompt (str): The instructions.
+        items (list): The texts to process.
+    Returns:
+        str: The text to send.
+    """
+    # The texts are keyed by their position in the pack, starting at 1
+    packed_items = {str(index + 1): item for index, item in enumerate(items)}
+    return prompt + "\n\n" + PACKED_PROMPT + "\n\n" + \
+        json.dumps(packed_items, ensure_ascii=False)
+
+
+def parse_packed_reply(reply, nb_items):
+    """Splits the reply to a packed prompt into the result of each text.
+    Args:
+        reply (str): The reply of the API.
+        nb_items (int): The number of texts in the pack.
+    Returns:
+        list: The result of each text, or None for the texts missing from the
+        reply or if the reply is not a JSON object.
+    """
+    # The model sometimes wraps the JSON object in text or a code block
+    start_idx = reply.find("{")
+    end_idx = reply.rfind("}")
+    try:
+        parsed = json.loads(reply[start_idx:end_idx + 1])
+    except ValueError:
+        parsed = None
+    if start_idx < 0 or not isinstance(parsed, dict):
+        logging.warning("The reply to a packed prompt is not a JSON object")
+        return [None] * nb_items
+
+    results = []
+    for index in range(nb_items):
+        value = parsed.get(str(index + 1))
+        if value is not None and not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        results.append(value)
+    return results
+
+
+def pack_texts_in_batches(token_counts,
+                          max_tokens=EMBEDDING_TOKENS_PER_REQUEST,
+                          max_inputs=EMBEDDING_MAX_INPUTS):
+    """Groups consecutive texts in batches that fit in a single request.
+    Args:
+        token_counts (list): The number of tokens of each text.
+        max_tokens (int): The largest number of tokens in a batch. A text
+        larger than this is sent alone.
+        max_inputs (int): The largest number of texts in a batch.
+    Returns:
+        list: A list of batches, each a list of indices of texts.
+    """
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for index, nb_tokens in enumerate(token_counts):
+        if current_batch and (current_tokens + nb_tokens > max_tokens or
+                              len(current_batch) >= max_inputs):
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(index)
+        current_tokens += nb_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+@contextlib.asynccontextmanager
+async def _attempt_slot(model, estimated_tokens, priority, deadline,
+                        request_event):
+    """Waits until an attempt of a request can be sent. The attempt first
+    waits for the rate limiter of the model, which also holds requests back
+    after a 429 error, and only then for a slot of the shared scheduler. The
+    scheduler slot is therefore only held while the request is sent, so a
+    throttled bulk job does not keep the slots of interactive jobs while it
+    sleeps.
+    Args:
+        model (str): The model the request is sent to.
+        estimated_tokens (int): The tokens the request is expected to use.
+        priority (str): The priority class of the request in the shared
+        scheduler.
+        deadline (float): The time.monotonic() after which the request is
+        not sent anymore, or None.
+        request_event (dict): The telemetry event of the request. It adds up
+        the time waited for the scheduler over the attempts.
+    Yields:
+        tuple: The RequestPermit of the limiter and the time in seconds
+        waited for the limiter.
+    """
+    limiter_start = time.perf_counter()
+    async with get_rate_limiter(model).limit(estimated_tokens) as permit:
+        scheduler_start = time.perf_counter()
+        async with get_scheduler().slot(priority, deadline):
+            request_event["scheduler_wait"] = \
+                request_event.get("scheduler_wait", 0.0) + \
+                time.perf_counter() - scheduler_start
+            yield permit, scheduler_start - limiter_start
+
+
+def _record_attempt(request_event, status, start_time, limiter_wait,
+                    retry_reason=None):
+    """Sends the telemetry event of an attempt of a request.
+    Args:
+        request_event (dict): The telemetry event of the request.
+        status (str): The outcome of the attempt: 'success', 'throttled',
+        'timeout' or 'error'.
+        start_time (float): The perf_counter time the attempt started.
+        limiter_wait (float): The time in seconds the attempt waited for the
+        rate limiter.
+        retry_reason (str): Why the request is sent again, if it is.
+    Returns:
+        None
+    """
+    request_event["nb_attempts"] += 1
+    if telemetry_enabled():
+        emit_event({"event": "attempt", "model": request_event["model"],
+                    "status": status,
+                    "attempt": request_event["nb_attempts"],
+                    "latency": time.perf_counter() - start_time,
+                    "limiter_wait": limiter_wait,
+                    "retry_reason": retry_reason})
+
+
+async def _call_embedding_api(inputs, nb_tokens, timeout, max_retries,
+                              queue_wait=None, priority=DEFAULT_PRIORITY):
+    """Sends a batch of texts to the embeddings endpoint, retrying when it is
+    throttled or times out.
+    Args:
+        inputs (list): The texts to embed.
+        nb_tokens (int): The number of tokens of the texts.
+        timeout (float): The timeout of the first attempt in seconds.
+        Each retry waits half a timeout longer.
+        max_retries (int): The number of retries after a timeout.
+        queue_wait (float): The time in seconds the batch waited to be sent.
+        It is only used for telemetry. Defaults to None.
+        priority (str): The priority class of the request in the shared
+        scheduler. Defaults to DEFAULT_PRIORITY.
+    Returns:
+        list: The embedding of each text, in the order of the inputs.
+    """
+    request_event = {"event": "request", "model": EMBEDDING_MODEL,
+                     "status": "error", "queue_wait": queue_wait,
+                     "nb_attempts": 0, "tokens_in": nb_tokens,
+                     "tokens_out": 0, "nb_inputs": len(inputs)}
+    request_start = time.perf_counter()
+    try:
+        response = await _send_embedding_request(
+            inputs, nb_tokens, timeout, max_retries, request_event, priority)
+        request_event["status"] = "success"
+    except asyncio.CancelledError:
+        request_event["status"] = "cancelled"
+        raise
+    finally:
+        request_event["latency"] = time.perf_counter() - request_start
+        emit_event(request_event)
+
+    # The API gives the index of each input, we do not rely on the order.
+    data = sorted(response["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data]
+
+
+async def _send_embedding_request(inputs, nb_tokens, timeout, max_retries,
+                                  request_event, priority=DEFAULT_PRIORITY):
+    """Sends a batch of texts until it succeeds or runs out of retries. The
+    arguments are the ones of _call_embedding_api. The outcome of each
+    attempt is recorded in request_event."""
+    retry = 0
+    nb_throttled = 0
+    while True:
+        async with _attempt_slot(EMBEDDING_MODEL, nb_tokens, priority, None,
+                                 request_event) as (permit, limiter_wait):
+            start_time = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    openai.Embedding.acreate(input=inputs,
+                                             model=EMBEDDING_MODEL),
+                    timeout=timeout + retry * timeout / 2,
+                )
+                if "usage" in response:
+                    permit.record_usage(response["usage"]["total_tokens"])
+                _record_attempt(request_event, "success", start_time,
+                                limiter_wait)
+                return response
+            except openai.error.RateLimitError as e:
+                permit.record_throttle(get_retry_after(e))
+                _record_attempt(request_event, "throttled", start_time,
+                                limiter_wait, retry_reason="rate_limit")
+                request_event["status"] = "throttled"
+                nb_throttled += 1
+                if nb_throttled > MAX_RATE_LIMIT_RETRIES:
+                    logging.error(
+                        f"Embedding call throttled {nb_throttled} times.")
+                    raise
+                logging.warning(
+                    "Embedding call throttled, retrying... "
+                    f"(attempt {nb_throttled})")
+            except asyncio.TimeoutError:
+                permit.record_failure(timed_out=True)
+                _record_attempt(request_event, "timeout", start_time,
+                                limiter_wait, retry_reason="timeout")
+                request_event["status"] = "timeout"
+                if retry == max_retries:
+                    logging.error(
+                        f"Embedding call timed out after {max_retries} "
+                        "retries.")
+                    raise
+                retry += 1
+                logging.warning(
+                    "Embedding call timed out, retrying... "
+                    f"(attempt {retry})")
+            except Exception:
+                permit.record_failure()
+                _record_attempt(request_event, "error", start_time,
+                                limiter_wait)
+                raise
+
+
+async def async_embed_texts(
+        texts, max_concurrent_calls=8,
+        max_tokens_per_request=EMBEDDING_TOKENS_PER_REQUEST,
+        max_inputs_per_request=EMBEDDING_MAX_INPUTS,
+        timeout=60, max_retries=3, progress_callback=None,
+        priority=DEFAULT_PRIORITY):
+    """Embeds a list of texts. Texts are packed in multi-input requests under
+    a token budget and the requests are sent concurrently.
+    Args:
+        texts (list): The texts to embed.
+        max_concurrent_calls (int): The maximum number of requests in flight.
+        Defaults to 8.
+        max_tokens_per_request (int): The largest number of tokens in a
+        request. Defaults to EMBEDDING_TOKENS_PER_REQUEST.
+        max_inputs_per_request (int): The largest number of texts in a
+        request. Defaults to EMBEDDING_MAX_INPUTS.
+        timeout (float): The timeout of the first attempt in seconds.
+        Defaults to 60.
+        max_retries (int): The number of retries after a timeout. Defaults
+        to 3.
+        progress_callback (callable): If given, it is called with the number
+        of texts embedded so far and the total number of texts after each
+        request. Defaults to None.
+        priority (str): The priority class of the requests in the shared
+        scheduler, for example 'bulk' to embed a corpus. Defaults to
+        DEFAULT_PRIORITY.
+    Returns:
+        list: The embedding of each text, in the order of the texts.
+    """
+    # Line breaks degrade the quality of the embeddings.
+    inputs = [text.replace("\n", " ") for text in texts]
+    token_counts = await async_count_tokens_batch(inputs)
+    batches = pack_texts_in_batches(token_counts, max_tokens_per_request,
+                                    max_inputs_per_request)
+    logging.debug(f"Embedding {len(inputs)} texts in {len(batches)} requests")
+
+    embeddings = [None] * len(inputs)
+    semaphore = asyncio.Semaphore(max_concurrent_calls)
+    nb_done = 0
+
+    async def embed_batch(batch):
+        nonlocal nb_done
+        enqueue_time = time.perf_counter()
+        async with semaphore:
+            batch_embeddings = await _call_embedding_api(
+                [inputs[index] for index in batch],
+                sum(token_counts[index] for index in batch),
+                timeout, max_retries,
+                queue_wait=time.perf_counter() - enqueue_time,
+                priority=priority)
+        for index, embedding in zip(batch, batch_embeddings):
+            embeddings[index] = embedding
+        nb_done += len(batch)
+        if progress_callback is not None:
+            progress_callback(nb_done, len(inputs))
+
+    tasks = [asyncio.create_task(embed_batch(batch)) for batch in batches]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # The first failed request stops the others.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return embeddings
+
+
+def embed_texts(texts, max_concurrent_calls=8, **kwargs):
+    """Wrapper that embeds a list of texts with concurrent batched requests.
+    It blocks until the texts are embedded, so coroutines running in the loop
+    of the runner await async_embed_texts instead.
+    Args:
+        texts (list): The texts to embed.
+        max_concurrent_calls (int): The maximum number of requests in flight.
+        Defaults to 8.
+        **kwargs: The other arguments of async_embed_texts.
+    Returns:
+        list: The embedding of each text, in the order of the texts.
+    """
+    if not texts:
+        return []
+    return get_async_runner().run(async_embed_texts(
+        texts, max_concurrent_calls=max_concurrent_calls, **kwargs))
+
+
+def process_items_through_prompt(
+        items,
+        prompt,
+        temperature=0.1,
+        presence_penalty=0.0,
+        frequency_penalty=0.0,
+        max_items_per_request=PACKED_ITEMS_PER_REQUEST,
+        max_tokens_per_request=PACKED_TOKENS_PER_REQUEST,
+        on_error="raise",
+        **parser_kwargs):
+    """Processes many short texts, like abstracts or titles, through the
+    API with a given prompt. Several texts are packed in each request as
+    a JSON object and the reply is split back into one result per text.
+    Texts that are missing from a reply, or whose pack failed, are sent
+    again on their own.
+    Args:
+        items (list): The texts to process.
+        prompt (str): The prompt to apply to each text.
+        temperature (float): The temperature to use for the API call.
+        presence penalty (float): The presence penalty to use for
+        the API call.
+        frequency penalty (float): The frequency penalty to use for
+        the API call.
+        max_items_per_request (int): The largest number of texts in a
+        request. Defaults to PACKED_ITEMS_PER_REQUEST.
+        max_tokens_per_request (int): The largest number of tokens of the
+        texts of a request. A longer text is sent alone. Defaults to
+        PACKED_TOKENS_PER_REQUEST.
+        on_error (str): 'raise' to stop when a text sent on its own fails
+        or 'partial' to keep the results of the other texts. Defaults to
+        'raise'.
+        **parser_kwargs: The options of the calls given to OpenaiLongParser,
+        like max_concurrent_calls, completion_cache or priority.
+    Returns:
+        list: The generated text of each item. With on_error='partial',
+        a tuple of the generated texts, with None for the failed items,
+        and a dict of the exception of each failed item.
+    """
+    if on_error not in ON_ERROR_POLICIES:
+        raise ValueError(f"on_error must be one of {ON_ERROR_POLICIES}")
+    # The texts are not chunked, the parser only sends the prompts
+    openai_parser = OpenaiLongParser("", **parser_kwargs)
+    token_counts = get_token_counter().count_batch(items)
+    packs = [pack for pack in pack_texts_in_batches(
+        token_counts, max_tokens_per_request, max_items_per_request)
+        if len(pack) > 1]
+    results = [None] * len(items)
+    packed_indices = set(itertools.chain.from_iterable(packs))
+
+    # A pack that failed is retried item by item below
+    replies, _ = openai_parser.multi_call_chatGPT(
+        [build_packed_prompt(prompt, [items[index] for index in pack])
+         for pack in packs],
+        temperature=temperature,
+        presence_penalty=presence_penalty,
+        frequency_penalty=frequency_penalty,
+        on_error="partial")
+    for pack, reply in zip(packs, replies):
+        if reply is None:
+            continue
+        pack_results = parse_packed_reply(reply, len(pack))
+        for index, result in zip(pack, pack_results):
+            results[index] = result
+
+    remaining = [index for index in range(len(items))
+                 if results[index] is None]
+    logging.info(f"Processed {len(packed_indices)} items in "
+                 f"{len(packs)} packed requests, "
+                 f"{len(remaining)} items sent on their own")
+    single_results = openai_parser.multi_call_chatGPT(
+        [build_chunk_prompt(prompt, items[index]) for index in remaining],
+        temperature=temperature,
+        presence_penalty=presence_penalty,
+        frequency_penalty=frequency_penalty,
+        on_error=on_error)
+    errors = {}
+    if on_error == "partial":
+        single_results, single_errors = single_results
+        errors = {remaining[position]: error
+                  for position, error in single_errors.items()}
+    for index, result in zip(remaining, single_results):
+        results[index] = result
+
+    if on_error == "partial":
+        return results, errors
+    return results
+
 # Below are classes that relates to the OpenAI API.
 
 
@@ -91,24 +702,56 @@ class OpenaiLongParser:
     tokens limit.
     """
 
-    def __init__(self, longtext, chunk_size=1400, max_concurrent_calls=8):
+    def __init__(self, longtext, chunk_size=1400, max_concurrent_calls=8,
+                 chunk_unit="words", keep_formatting=False,
+                 completion_cache=None, checkpoint=None,
+                 priority=DEFAULT_PRIORITY, hedging_policy=None):
         """Initializes the class.
         Args:
             longtext (str): The text to submit to the API.
             chunk_size (int): The number of tokens in each chunk.
             max_concurrent_calls (int): The maximum number of concurrent
             calls to the OpenAI API
+            chunk_unit (str): The unit of chunk_size. Can be 'words' to count
+            word tokens or 'model_tokens' to pack chunks up to chunk_size
+            tokens of the model. Defaults to 'words'.
+            keep_formatting (bool): If True, chunks are slices of the long
+            text with its original spacing and line breaks and their offsets
+            are kept in chunk_spans. If False, chunks are rebuilt from their
+            tokens. Defaults to False.
+            completion_cache (CompletionCache): If given, completions are
+            looked up in this cache before calling the API and saved to it
+            afterwards. Defaults to None.
+            checkpoint (ChunkCheckpoint): If given, the result of each prompt
+            is saved to this checkpoint as soon as it arrives and prompts
+            already saved are not sent again. Defaults to None.
+            priority (str): The priority class of the requests in the
+            scheduler shared by all the jobs of the process, 'interactive',
+            'normal' or 'bulk'. Defaults to DEFAULT_PRIORITY.
+            hedging_policy (HedgingPolicy): If given, a duplicate of a
+            non-streamed request is sent when it runs past the percentile of
+            the recent latencies of the policy, and the first response wins.
+            Defaults to None.
         """
+        if chunk_unit not in CHUNK_UNITS:
+            raise ValueError(f"chunk_unit must be one of {CHUNK_UNITS}")
 
         self.longtext = longtext
         self.chunk_size = chunk_size
+        self.chunk_unit = chunk_unit
+        self.keep_formatting = keep_formatting
         self.num_tokens = count_tokens([longtext])
         self.break_up_longtext_to_chunks(self.longtext)
         self.num_chunks = len(self.chunks)
         self.max_concurrent_calls = max_concurrent_calls
+        self.completion_cache = completion_cache
+        self.checkpoint = checkpoint
+        self.priority = priority
+        self.hedging_policy = hedging_policy
 
         # We load the API key and send it to OpenAI library
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        if os.getenv("OPENAI_API_KEY") is not None:
+            openai.api_key = os.getenv("OPENAI_API_KEY")
 
     def break_up_tokens_in_chunks(self, tokens):
         """Breaks up a file into chunks of tokens.
@@ -117,183 +760,631 @@ class OpenaiLongParser:
         Returns:
             list: A list of lists of tokens.
         """
+        for start_idx, end_idx in self.find_token_boundaries(tokens):
+            yield tokens[start_idx:end_idx]
 
-        def find_sentence_boundary(tokens, start_idx):
-            # This is to only cut at the end of the last full sentence.
-            current_length = start_idx
-
-            # We go backward until we find a sentence boundary.
-            for idx, token in enumerate(tokens[start_idx::-1]):
-                if token in {".", "!", "?"}:
-                    current_length = start_idx - idx
-                    break
-            return current_length
-
-        if len(tokens) <= self.chunk_size:
-            yield tokens
+    def find_token_boundaries(self, tokens):
+        """Finds where to cut a list of tokens into chunks of chunk_size.
+        Args:
+            tokens (list): A list of tokens.
+        Returns:
+            list: A list of (start, end) offsets of each chunk in the tokens.
+        """
+        if self.chunk_unit == "model_tokens":
+            token_weights = count_model_tokens_per_word(tokens)
         else:
-            end_idx = find_sentence_boundary(tokens, self.chunk_size)
-            chunk = tokens[:end_idx + 1]
-            yield chunk
-            yield from self.break_up_tokens_in_chunks(tokens[end_idx + 1:])
+            token_weights = None
+        return find_chunk_boundaries(tokens, self.chunk_size,
+                                     token_weights=token_weights)
 
     def break_up_longtext_to_chunks(self, text):
-        """Breaks up a file into chunks of tokens.
+        """Breaks up a file into chunks of tokens. With keep_formatting, the
+        character offsets of each chunk in the text are kept in chunk_spans.
+        Otherwise chunk_spans is None.
         Args:
             text (str): The text to break up.
         Returns:
             list: A list of lists of tokens.
         """
-        tokens = custom_word_tokenize(text)
-        self.chunks = [
-            custom_word_detokenize(local_tokens)
-            for local_tokens in self.break_up_tokens_in_chunks(tokens)
-        ]
-
-    async def _worker(self, queue, timeout, max_retries, abort_event,
-                      finished_tasks):
-        """An asynchronous worker that sends the requests to the API."""
-        while not abort_event.is_set():
+        self.chunk_spans = None
+        if self.keep_formatting:
+            tokens, spans = custom_word_tokenize_with_spans(text)
+            token_boundaries = self.find_token_boundaries(tokens)
+            self.chunk_spans = [
+                find_chunk_span(text, spans, start_idx, end_idx)
+                for start_idx, end_idx in token_boundaries
+            ]
+            self.chunks = [text[char_start:char_end]
+                           for char_start, char_end in self.chunk_spans]
+        else:
+            # The offsets of the tokens are only needed to slice the text
+            tokens = custom_word_tokenize(text)
+            token_boundaries = self.find_token_boundaries(tokens)
+            self.chunks = [
+                custom_word_detokenize(tokens[start_idx:end_idx])
+                for start_idx, end_idx in token_boundaries
+            ]
+
+    async def _stream_chat_completion(self, request_kwargs, timeout,
+                                      first_token_timeout, partial_callback):
+        """Sends a request in streaming mode and gathers the token deltas.
+        Args:
+            request_kwargs (dict): The arguments of ChatCompletion.acreate.
+            timeout (float): The time in seconds allowed for the whole
+            response.
+            first_token_timeout (float): The time in seconds allowed before
+            the first token arrives. A stalled stream is detected early this
+            way.
+            partial_callback (callable): If given, it is called with the text
+            received so far after each delta.
+        Returns:
+            OpenAIObject: A response shaped like a non-streamed response.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if first_token_timeout is None:
+            first_token_timeout = timeout
+        first_token_deadline = loop.time() + first_token_timeout
+
+        pieces = []
+        finish_reason = None
+        stream = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(stream=True, **request_kwargs),
+            timeout=max(0, min(deadline, first_token_deadline) - loop.time()))
+        try:
+            while True:
+                if pieces:
+                    wait_time = deadline - loop.time()
+                else:
+                    wait_time = min(deadline, first_token_deadline) - \
+                        loop.time()
+                try:
+                    chunk = await asyncio.wait_for(
+                        stream.__anext__(), timeout=max(0, wait_time))
+                except StopAsyncIteration:
+                    break
+                choice = chunk["choices"][0]
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    pieces.append(delta)
+                    if partial_callback is not None:
+                        partial_callback("".join(pieces))
+                if choice.get("finish_reason") is not None:
+                    finish_reason = choice["finish_reason"]
+        finally:
+            await stream.aclose()
+
+        return openai.util.convert_to_openai_object({
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant",
+                                     "content": "".join(pieces)},
+                         "finish_reason": finish_reason}]})
+
+    async def _send_hedge(self, request_kwargs, estimated_tokens,
+                          request_event, deadline):
+        """Sends the duplicate of a slow request. It is metered by the
+        limiter and takes its own slot of the shared scheduler like any other
+        request."""
+        async with _attempt_slot(CHAT_MODEL, estimated_tokens, self.priority,
+                                 deadline, request_event) as (permit, _):
             try:
-                (prompt, temperature,
-                 presence_penalty, frequency_penalty,
-                 result
-                 ) = await asyncio.wait_for(queue.get(), timeout=10)
-            except asyncio.TimeoutError:
-                continue
-            NbTokensInPrompt = count_tokens([prompt])
-            logging.debug("Calling OpenAI API on a chunk of text.")
-            logging.debug(
-                f"Number of tokens in the prompt: {NbTokensInPrompt}")
-            for retry in range(max_retries + 1):
+                response = await openai.ChatCompletion.acreate(
+                    **request_kwargs)
+            except openai.error.RateLimitError as e:
+                permit.record_throttle(get_retry_after(e))
+                raise
+            if "usage" in response:
+                permit.record_usage(response["usage"]["total_tokens"])
+            return response
+
+    async def _hedged_chat_completion(self, request_kwargs, estimated_tokens,
+                                      request_event, deadline=None):
+        """Sends a request and a duplicate of it if it runs past the hedge
+        delay of the hedging policy. The first response wins and the other
+        request is cancelled.
+        Args:
+            request_kwargs (dict): The arguments of ChatCompletion.acreate.
+            estimated_tokens (int): The tokens the duplicate reserves in the
+            limiter.
+            request_event (dict): The telemetry event of the request. It
+            records if a duplicate was sent and if it won.
+            deadline (float): The time.monotonic() after which the duplicate
+            is not sent anymore, or None. Defaults to None.
+        Returns:
+            OpenAIObject: The first response.
+        """
+        policy = self.hedging_policy
+        start_time = time.perf_counter()
+        primary = asyncio.ensure_future(
+            openai.ChatCompletion.acreate(**request_kwargs))
+        tasks = {primary}
+        try:
+            delay = policy.get_hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and policy.try_hedge():
+                    logging.debug(f"No response after {delay:0.2f} seconds, "
+                                  "sending a duplicate request")
+                    request_event["hedged"] = True
+                    tasks.add(asyncio.ensure_future(self._send_hedge(
+                        request_kwargs, estimated_tokens, request_event,
+                        deadline)))
+
+            # The first response wins. An error only counts if no other
+            # request is left.
+            first_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        policy.record_latency(time.perf_counter() -
+                                              start_time)
+                        if task is not primary:
+                            policy.record_hedge_win()
+                            request_event["hedge_won"] = True
+                        return task.result()
+                    if first_error is None:
+                        first_error = task.exception()
+            raise first_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _call_chat_api(self, prompt, temperature, presence_penalty,
+                             frequency_penalty, timeout, max_retries,
+                             stream=False, first_token_timeout=None,
+                             partial_callback=None, queue_wait=None,
+                             deadline=None):
+        """Sends a single prompt to the API, retrying when it times out.
+        Args:
+            prompt (str): The prompt to send.
+            temperature (float): The temperature to use for the API call.
+            presence_penalty (float): The presence penalty to use for the
+            API call.
+            frequency_penalty (float): The frequency penalty to use for the
+            API call.
+            timeout (float): The timeout of the first attempt in seconds.
+            Each retry waits half a timeout longer.
+            max_retries (int): The number of retries after a timeout.
+            stream (bool): If True, the response is streamed. Defaults to
+            False.
+            first_token_timeout (float): In streaming mode, the time in
+            seconds allowed before the first token arrives. If None, only
+            timeout applies. Defaults to None.
+            partial_callback (callable): In streaming mode, it is called with
+            the text received so far. Defaults to None.
+            queue_wait (float): The time in seconds the prompt waited for a
+            worker. It is only used for telemetry. Defaults to None.
+            deadline (float): The time.monotonic() after which the prompt is
+            not sent anymore. Defaults to None.
+        Returns:
+            str: The generated text.
+        """
+        request_event = {"event": "request", "model": CHAT_MODEL,
+                         "status": "error", "queue_wait": queue_wait,
+                         "nb_attempts": 0, "tokens_in": None,
+                         "tokens_out": None}
+        # The cache and the checkpoint are read and written in the thread of
+        # the databases so the other requests of the loop are not blocked.
+        if self.completion_cache is not None:
+            content = await run_in_database_thread(
+                self.completion_cache.get, CHAT_MODEL, prompt, temperature,
+                presence_penalty, frequency_penalty)
+            if content is not None:
+                request_event.update(status="cache_hit", latency=0.0)
+                emit_event(request_event)
+                return content
+        if self.checkpoint is not None:
+            content = await run_in_database_thread(self.checkpoint.get,
+                                                   prompt)
+            if content is not None:
+                request_event.update(status="checkpoint_hit", latency=0.0)
+                emit_event(request_event)
+                return content
+
+        request_start = time.perf_counter()
+
+        async def send_request():
+            return await self._send_chat_request(
+                prompt, temperature, presence_penalty, frequency_penalty,
+                timeout, max_retries, stream, first_token_timeout,
+                partial_callback, request_event, deadline)
+
+        try:
+            if stream:
+                # The waiters of a shared call would not see its partial text
+                # so streamed calls are always sent
+                content = await send_request()
+                request_event["status"] = "success"
+            else:
+                # Identical calls in flight from any parser of the same
+                # priority class share one request, so a call never waits
+                # behind the place of a call of a lower class. The waiters of
+                # a call dropped at its deadline send their own.
+                key = (CHAT_MODEL, self.priority, prompt, float(temperature),
+                       float(presence_penalty), float(frequency_penalty))
+                content, shared = await get_single_flight().run(
+                    key, send_request, own_errors=(DeadlineExceededError,))
+                request_event["status"] = "coalesced" if shared \
+                    else "success"
+        except asyncio.CancelledError:
+            request_event["status"] = "cancelled"
+            raise
+        finally:
+            request_event["latency"] = time.perf_counter() - request_start
+            emit_event(request_event)
+
+        if self.checkpoint is not None:
+            await run_in_database_thread(self.checkpoint.save, prompt,
+                                         content)
+        if self.completion_cache is not None:
+            await run_in_database_thread(
+                self.completion_cache.set, CHAT_MODEL, prompt, content,
+                temperature, presence_penalty, frequency_penalty)
+        return content
+
+    async def _send_chat_request(self, prompt, temperature, presence_penalty,
+                                 frequency_penalty, timeout, max_retries,
+                                 stream, first_token_timeout,
+                                 partial_callback, request_event,
+                                 deadline=None):
+        """Sends a prompt to the API until it succeeds or runs out of
+        retries. The arguments are the ones of _call_chat_api. The outcome of
+        each attempt is recorded in request_event. Each attempt waits for its
+        turn in the scheduler shared by all the jobs of the process."""
+        # Tokens are counted in a thread pool so the other requests of the
+        # loop are not blocked while a long prompt is encoded.
+        NbTokensInPrompt = await async_count_tokens([prompt])
+        request_event["tokens_in"] = NbTokensInPrompt
+        logging.debug("Calling OpenAI API on a chunk of text.")
+        logging.debug(
+            f"Number of tokens in the prompt: {NbTokensInPrompt}")
+
+        # Requests are metered by the limiter shared by all parsers.
+        estimated_tokens = estimate_request_tokens(NbTokensInPrompt)
+        retry = 0
+        nb_throttled = 0
+        while True:
+            async with _attempt_slot(CHAT_MODEL, estimated_tokens,
+                                     self.priority, deadline,
+                                     request_event) as (permit,
+                                                        limiter_wait):
                 start_time = time.perf_counter()  # Record the start time
+                request_kwargs = dict(
+                    model=CHAT_MODEL,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=4000 - NbTokensInPrompt,
+                    n=1,
+                    stop=None,
+                    temperature=temperature,
+                    presence_penalty=presence_penalty,
+                    frequency_penalty=frequency_penalty,
+                )
                 try:
-                    response = await asyncio.wait_for(
-                        openai.ChatCompletion.acreate(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=4000 - NbTokensInPrompt,
-                            n=1,
-                            stop=None,
-                            temperature=temperature,
-                            presence_penalty=presence_penalty,
-                            frequency_penalty=frequency_penalty,
-                        ),
-                        timeout=timeout + retry * timeout / 2,
-                    )
+                    if stream:
+                        response = await self._stream_chat_completion(
+                            request_kwargs,
+                            timeout + retry * timeout / 2,
+                            first_token_timeout,
+                            partial_callback)
+                    elif self.hedging_policy is not None:
+                        response = await asyncio.wait_for(
+                            self._hedged_chat_completion(
+                                request_kwargs, estimated_tokens,
+                                request_event, deadline),
+                            timeout=timeout + retry * timeout / 2,
+                        )
+                    else:
+                        response = await asyncio.wait_for(
+                            openai.ChatCompletion.acreate(**request_kwargs),
+                            timeout=timeout + retry * timeout / 2,
+                        )
+                    if "usage" in response:
+                        permit.record_usage(response["usage"]["total_tokens"])
+                    elif stream:
+                        # Streamed responses do not report their usage
+                        permit.record_usage(
+                            NbTokensInPrompt + await async_count_tokens(
+                                [response.choices[0].message.content]))
                     logging.debug(
                         f"API call succeeded with {NbTokensInPrompt} \
                             input tokens.")
+                    _record_attempt(request_event, "success", start_time,
+                                    limiter_wait)
                     break
-                except asyncio.TimeoutError as e:
+                except openai.error.RateLimitError as e:
+                    # The limiter pauses all requests for Retry-After
+                    permit.record_throttle(get_retry_after(e))
+                    _record_attempt(request_event, "throttled", start_time,
+                                    limiter_wait, retry_reason="rate_limit")
+                    request_event["status"] = "throttled"
+                    nb_throttled += 1
+                    if nb_throttled > MAX_RATE_LIMIT_RETRIES:
+                        logging.error(
+                            f"API call throttled {nb_throttled} times.")
+                        raise
+                    logging.warning(
+                        "API call throttled, retrying... "
+                        f"(attempt {nb_throttled})")
+                except asyncio.TimeoutError:
+                    permit.record_failure(timed_out=True)
+                    if self.hedging_policy is not None and not stream:
+                        # The latency is at least the timeout
+                        self.hedging_policy.record_timeout(
+                            timeout + retry * timeout / 2)
+                    _record_attempt(request_event, "timeout", start_time,
+                                    limiter_wait, retry_reason="timeout")
+                    request_event["status"] = "timeout"
                     if retry == max_retries:
                         logging.error(
-                            f"API call timed out after {max_retries} retries.")
-                        result.append(e)
-                        abort_event.set()
-                        queue.task_done()
-                    else:
-                        logging.warning(
-                            f"API call timed out with {NbTokensInPrompt} \
-                                input tokens, retrying... \
-                                    (attempt {retry + 1})")
-                        continue
+                            f"API call timed out after {max_retries} "
+                            "retries.")
+                        raise
+                    retry += 1
+                    logging.warning(
+                        f"API call timed out with {NbTokensInPrompt} \
+                            input tokens, retrying... \
+                                (attempt {retry})")
                 except Exception as e:
+                    permit.record_failure()
+                    _record_attempt(request_event, "error", start_time,
+                                    limiter_wait)
+                    request_event["status"] = "error"
                     logging.error(f"API call failed with error: {e}")
-                    result.append(e)
-                    abort_event.set()
-                    queue.task_done()
+                    raise
+
+        try:
+            content = response['choices'][0]['message']['content']
+        except Exception:
+            logging.error("API call failed")
+            raise Exception("API call failed")
+        # The API reports the tokens of the response, so we only count them
+        # when it does not, as with streamed responses.
+        if "usage" in response:
+            NbTokensInResponse = response["usage"]["completion_tokens"]
+        else:
+            NbTokensInResponse = await async_count_tokens([content])
+        request_event["tokens_out"] = NbTokensInResponse
+        logging.debug(
+            f"Number of tokens in the response: {NbTokensInResponse}")
+        # Total number of tokens
+        TotalNbTokens = NbTokensInPrompt + NbTokensInResponse
+        logging.debug(f"Total number of tokens: {TotalNbTokens}")
+
+        # We error out if the response was stopped before the end.
+        if response.choices[0].finish_reason == "length":
+            request_event["status"] = "length"
+            logging.error(
+                "We stopped because we reached the end of the LLM text.")
+            raise Exception(
+                "We stopped because we didn't reach \
+                        the end of the LLM text.")
+
+        elapsed_time = time.perf_counter() - start_time
+        logging.debug(
+            f"Task done for attempt number {retry+1} \
+                in {elapsed_time:0.2f} seconds.")
+        return content
+
+    async def _worker(self, queue, timeout, max_retries, stream=False,
+                      first_token_timeout=None, partial_callback=None,
+                      deadline=None):
+        """An asynchronous worker that sends the requests to the API. Each
+        item of the queue carries a future that receives the generated text
+        or the exception that stopped it."""
+        while True:
+            (index, prompt, temperature,
+             presence_penalty, frequency_penalty,
+             future, enqueue_time
+             ) = await queue.get()
             try:
-                NbTokensInResponse = count_tokens(
-                    [response['choices'][0]['message']['content']])
-            except Exception:
-                logging.error("API call failed")
-                result.append(Exception(
-                    "API call failed"
-                ))
-                abort_event.set()
-                queue.task_done()
-            logging.debug(
-                f"Number of tokens in the response: {NbTokensInResponse}")
-            # Total number of tokens
-            TotalNbTokens = NbTokensInPrompt + NbTokensInResponse
-            logging.debug(f"Total number of tokens: {TotalNbTokens}")
-
-            # We error out if the response was stopped before the end.
-            if response.choices[0].finish_reason == "length":
-                logging.error(
-                    "We stopped because we reached the end of the LLM text.")
-                result.append(Exception(
-                    "We stopped because we didn't reach \
-                            the end of the LLM text."
-                ))
-                abort_event.set()
+                if not future.done():
+                    if partial_callback is not None:
+                        prompt_callback = functools.partial(
+                            partial_callback, index)
+                    else:
+                        prompt_callback = None
+                    content = await self._call_chat_api(
+                        prompt, temperature, presence_penalty,
+                        frequency_penalty, timeout, max_retries,
+                        stream=stream,
+                        first_token_timeout=first_token_timeout,
+                        partial_callback=prompt_callback,
+                        queue_wait=time.perf_counter() - enqueue_time,
+                        deadline=deadline)
+                    if not future.done():
+                        future.set_result(content)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
                 queue.task_done()
 
-            elapsed_time = time.perf_counter() - start_time
-            result.append(response.choices[0]['message']['content'])
-            queue.task_done()
-            finished_tasks.release()
-            logging.debug(
-                f"Task done for attempt number {retry+1} \
-                    in {elapsed_time:0.2f} seconds.")
-
-    async def async_call_chatGPT(self, prompts, temperature, presence_penalty,
-                                 frequency_penalty,
-                                 timeout=140,
-                                 max_retries=3):
-        """Low-level async function that calls chatGPT in parallel."""
+    async def iter_chat_results(self, prompts, temperature=0.1,
+                                presence_penalty=0.0, frequency_penalty=0.0,
+                                timeout=140, max_retries=3, stream=False,
+                                first_token_timeout=20,
+                                partial_callback=None, on_error="raise",
+                                deadline=None, longest_first=False):
+        """Calls chatGPT in parallel and yields each result as soon as it
+        arrives, so downstream work can start before the slowest prompt
+        returns. By default the first failed prompt stops all the others.
+        Args:
+            prompts (List[str]): The prompts to use for the API calls.
+            temperature (float): The temperature to use for the API call.
+            presence_penalty (float): The presence penalty to use for the
+            API call.
+            frequency_penalty (float): The frequency penalty to use for the
+            API call.
+            timeout (float): The timeout of the first attempt in seconds.
+            max_retries (int): The number of retries after a timeout.
+            stream (bool): If True, responses are streamed token by token.
+            Defaults to False.
+            first_token_timeout (float): In streaming mode, the time in
+            seconds allowed before the first token arrives. Defaults to 20.
+            partial_callback (callable): In streaming mode, it is called with
+            the index of a prompt and the text received so far for it.
+            Defaults to None.
+            on_error (str): What to do when a prompt fails. 'raise' stops all
+            the prompts and raises its exception. 'partial' keeps going and
+            yields the exception of the prompt instead of its text. Defaults
+            to 'raise'.
+            deadline (float): The time in seconds allowed for the whole
+            batch. Prompts without a result by then fail with a
+            DeadlineExceededError. If None, there is no deadline. Defaults
+            to None.
+            longest_first (bool): If True, the prompts with the largest
+            estimated cost are sent first so a long prompt does not start
+            last and delay the whole batch. It counts the tokens of all the
+            prompts before the first one is sent, so it only pays off for
+            batches whose prompts differ a lot in size. The results keep the
+            indices of the prompts. Defaults to False.
+        Yields:
+            tuple: The index of the prompt and its generated text.
+        """
+        if on_error not in ON_ERROR_POLICIES:
+            raise ValueError(f"on_error must be one of {ON_ERROR_POLICIES}")
+        loop = asyncio.get_running_loop()
+        if deadline is not None:
+            deadline = time.monotonic() + deadline
         queue = asyncio.Queue()
-        abort_event = asyncio.Event()
-        finished_tasks = asyncio.Semaphore(0)
-
-        workers = [
-            asyncio.create_task(
-                self._worker(
-                    queue,
-                    timeout,
-                    max_retries,
-                    abort_event,
-                    finished_tasks)) for _ in range(
-                self.max_concurrent_calls)]
-
-        results = [list() for _ in range(len(prompts))]
-        for idx, prompt in enumerate(prompts):
+        futures = [loop.create_future() for _ in prompts]
+        order = range(len(prompts))
+        if longest_first:
+            # The cost of a prompt counts its tokens and the expected
+            # response. Prompts of equal cost keep their order.
+            costs = [estimate_request_tokens(nb_tokens + 4)
+                     for nb_tokens in await async_count_tokens_batch(prompts)]
+            order = sorted(order, key=lambda index: -costs[index])
+        for index in order:
             queue.put_nowait(
-                (prompt,
+                (index,
+                 prompts[index],
                  temperature,
                  presence_penalty,
                  frequency_penalty,
-                 results[idx]))
+                 futures[index],
+                 time.perf_counter()))
 
-        while finished_tasks._value != len(prompts):
-            if abort_event.is_set():
-                logging.error("One Task was aborted. Aborting all tasks.")
-                break
-            await asyncio.sleep(1)  # Sleep for a short interval
+        nb_workers = min(self.max_concurrent_calls, len(prompts))
+        workers = [
+            asyncio.create_task(self._worker(
+                queue, timeout, max_retries, stream=stream,
+                first_token_timeout=first_token_timeout,
+                partial_callback=partial_callback, deadline=deadline))
+            for _ in range(nb_workers)]
 
-        for worker in workers:
-            worker.cancel()
+        index_of_future = {future: idx for idx, future in enumerate(futures)}
+        pending = set(futures)
+        try:
+            while pending:
+                wait_time = None
+                if deadline is not None:
+                    wait_time = max(0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(
+                    pending, timeout=wait_time,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The prompts still running are failed at the deadline
+                    for future in pending:
+                        future.set_exception(DeadlineExceededError(
+                            "The prompt was not done before the deadline"))
+                    continue
+                failed = [future for future in done
+                          if future.exception() is not None]
+                if failed and on_error == "raise":
+                    result_index = min(index_of_future[future]
+                                       for future in failed)
+                    logging.error(
+                        f"Aborting due to failed task {result_index}")
+                    # Raise the exception to abort the program
+                    raise futures[result_index].exception()
+                for future in sorted(done, key=index_of_future.get):
+                    if future.exception() is not None:
+                        logging.warning(
+                            f"Task {index_of_future[future]} failed: "
+                            f"{future.exception()!r}")
+                        yield index_of_future[future], future.exception()
+                    else:
+                        yield index_of_future[future], future.result()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-        for result_index, result_item in enumerate(results):
-            if len(result_item) == 0:  # Check if the result is empty
-                logging.error(f"Aborting due to failed task {result_index}")
-                raise Exception("Aborting due to a failed task")
-            # Check if the result contains an exception
-            elif isinstance(result_item[0], BaseException):
-                logging.error(f"Aborting due to failed task {result_index}")
-                # Raise the exception to abort the program
-                raise result_item[0]
+    async def async_call_chatGPT(self, prompts, temperature, presence_penalty,
+                                 frequency_penalty,
+                                 timeout=140,
+                                 max_retries=3,
+                                 on_error="raise",
+                                 **stream_kwargs):
+        """Low-level async function that calls chatGPT in parallel. It
+        returns as soon as the last response arrives. The streaming options
+        and the deadline of iter_chat_results can be passed as keyword
+        arguments. The calls are run in the shared runner loop to reuse its
+        connections. With on_error='partial', it returns the list of texts,
+        with None for the failed prompts, and a dict of the exception of each
+        failed prompt."""
+        runner = get_async_runner()
+        if not runner.in_runner_loop():
+            return await runner.run_async(self.async_call_chatGPT(
+                prompts, temperature, presence_penalty, frequency_penalty,
+                timeout=timeout, max_retries=max_retries, on_error=on_error,
+                **stream_kwargs))
 
-        return [x[0] for x in results]
+        # Identical prompts of the batch are only sent once. We keep the
+        # first position of each prompt to report its partial text.
+        first_indices = {}
+        for index, prompt in enumerate(prompts):
+            first_indices.setdefault(prompt, index)
+        unique_prompts = list(first_indices)
+        if len(unique_prompts) < len(prompts):
+            logging.debug(f"Sending {len(unique_prompts)} unique prompts "
+                          f"out of {len(prompts)}")
+            partial_callback = stream_kwargs.get("partial_callback")
+            if partial_callback is not None:
+                stream_kwargs["partial_callback"] = \
+                    lambda index, text: partial_callback(
+                        first_indices[unique_prompts[index]], text)
+
+        unique_results = [None] * len(unique_prompts)
+        unique_errors = {}
+        async for result_index, content in self.iter_chat_results(
+                unique_prompts, temperature, presence_penalty,
+                frequency_penalty, timeout=timeout, max_retries=max_retries,
+                on_error=on_error, **stream_kwargs):
+            if isinstance(content, Exception):
+                unique_errors[result_index] = content
+            else:
+                unique_results[result_index] = content
+
+        unique_indices = {prompt: index
+                          for index, prompt in enumerate(unique_prompts)}
+        results = [unique_results[unique_indices[prompt]]
+                   for prompt in prompts]
+        if on_error == "partial":
+            errors = {index: unique_errors[unique_indices[prompt]]
+                      for index, prompt in enumerate(prompts)
+                      if unique_indices[prompt] in unique_errors}
+            return results, errors
+        return results
 
     def multi_call_chatGPT(
             self,
             prompts,
             temperature=0.1,
             presence_penalty=0.0,
-            frequency_penalty=0.0):
+            frequency_penalty=0.0,
+            on_error="raise",
+            **stream_kwargs):
         """Wrapper that calls the OpenAI API in parallel to generate text.
+        It blocks until the texts are generated, so coroutines running in the
+        loop of the runner await async_call_chatGPT instead.
         Args:
             prompts (List[str]): The prompt to use for the API call.
             temperature (float): The temperature to use for the API call.
@@ -301,15 +1392,170 @@ class OpenaiLongParser:
             the API call.
             frequency penalty (float): The frequency penalty to use for
             the API call.
+            on_error (str): 'raise' to stop at the first failed prompt or
+            'partial' to keep the results of the other prompts. Defaults to
+            'raise'.
+            **stream_kwargs: The streaming options of iter_chat_results,
+            stream, first_token_timeout and partial_callback, the deadline
+            of the batch and longest_first.
         Returns:
-            str: The generated text.
+            list: The generated texts. With on_error='partial', a tuple of
+            the generated texts, with None for the failed prompts, and a dict
+            of the exception of each failed prompt.
         """
-        return asyncio.run(
+        return get_async_runner().run(
             self.async_call_chatGPT(
                 prompts,
                 temperature,
                 presence_penalty,
-                frequency_penalty))
+                frequency_penalty,
+                on_error=on_error,
+                **stream_kwargs))
+
+    async def iter_chat_stream(self, prompts, temperature=0.1,
+                               presence_penalty=0.0, frequency_penalty=0.0,
+                               timeout=140, max_retries=3, on_error="raise",
+                               max_pending=None):
+        """Calls chatGPT on a stream of prompts and yields each result as
+        soon as it arrives. Unlike iter_chat_results, the prompts are read
+        as the workers need them and at most max_pending prompts are held at
+        any time, queued, in flight or waiting to be yielded, so memory use
+        does not grow with the number of prompts.
+        Args:
+            prompts (iterable): The prompts to use for the API calls. It can
+            be a list, a generator or an async iterable.
+            temperature (float): The temperature to use for the API call.
+            presence_penalty (float): The presence penalty to use for the
+            API call.
+            frequency_penalty (float): The frequency penalty to use for the
+            API call.
+            timeout (float): The timeout of the first attempt in seconds.
+            max_retries (int): The number of retries after a timeout.
+            on_error (str): 'raise' to stop at the first failed prompt or
+            'partial' to yield the exception of a failed prompt instead of
+            its text. Defaults to 'raise'.
+            max_pending (int): The largest number of prompts read but not yet
+            yielded. Defaults to twice max_concurrent_calls.
+        Yields:
+            tuple: The position of the prompt in the stream and its generated
+            text.
+        """
+        if on_error not in ON_ERROR_POLICIES:
+            raise ValueError(f"on_error must be one of {ON_ERROR_POLICIES}")
+        if max_pending is None:
+            max_pending = 2 * self.max_concurrent_calls
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_pending)
+        ready = asyncio.Queue()
+        # A slot is taken when a prompt is read and given back once the
+        # consumer is done with its result, which bounds the prompts held in
+        # memory even while the consumer works on a result.
+        slots = asyncio.Semaphore(max_pending)
+        nb_submitted = 0
+
+        async def submit(index, prompt):
+            await slots.acquire()
+            future = loop.create_future()
+            future.add_done_callback(
+                lambda done_future: ready.put_nowait((index, done_future)))
+            await queue.put((index, prompt, temperature, presence_penalty,
+                             frequency_penalty, future, time.perf_counter()))
+
+        async def produce():
+            nonlocal nb_submitted
+            if hasattr(prompts, "__aiter__"):
+                async for prompt in prompts:
+                    await submit(nb_submitted, prompt)
+                    nb_submitted += 1
+            else:
+                for prompt in prompts:
+                    await submit(nb_submitted, prompt)
+                    nb_submitted += 1
+
+        producer = asyncio.create_task(produce())
+        # The end of the producer wakes up the loop below
+        producer.add_done_callback(lambda _: ready.put_nowait(None))
+        workers = [
+            asyncio.create_task(self._worker(queue, timeout, max_retries))
+            for _ in range(self.max_concurrent_calls)]
+
+        nb_yielded = 0
+        try:
+            while not producer.done() or nb_yielded < nb_submitted:
+                item = await ready.get()
+                if item is None:
+                    if producer.exception() is not None:
+                        raise producer.exception()
+                    continue
+                index, future = item
+                nb_yielded += 1
+                if future.exception() is not None:
+                    if on_error == "raise":
+                        logging.error(f"Aborting due to failed task {index}")
+                        raise future.exception()
+                    logging.warning(
+                        f"Task {index} failed: {future.exception()!r}")
+                    yield index, future.exception()
+                else:
+                    yield index, future.result()
+                slots.release()
+            # The sentinel may have been consumed before the last results
+            # were yielded, so we check the prompt source again here.
+            if not producer.cancelled() and producer.exception() is not None:
+                raise producer.exception()
+        finally:
+            producer.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+
+    def stream_call_chatGPT(
+            self,
+            prompts,
+            result_callback,
+            temperature=0.1,
+            presence_penalty=0.0,
+            frequency_penalty=0.0,
+            on_error="raise",
+            max_pending=None):
+        """Wrapper that calls the OpenAI API on a stream of prompts of any
+        size and hands over each result as it arrives instead of returning
+        them all. For example, the callback can save each result with
+        LocalDatabase.save_to_database. The callback runs in a worker thread
+        so it can call the other wrappers, like multi_call_chatGPT, while
+        the loop of the runner keeps the calls going.
+        Args:
+            prompts (iterable): The prompts to use for the API calls. It can
+            be a list, a generator or an async iterable.
+            result_callback (callable): It is called with the position of a
+            prompt in the stream and its generated text, or its exception
+            with on_error='partial'.
+            temperature (float): The temperature to use for the API call.
+            presence penalty (float): The presence penalty to use for
+            the API call.
+            frequency penalty (float): The frequency penalty to use for
+            the API call.
+            on_error (str): 'raise' to stop at the first failed prompt or
+            'partial' to keep going. Defaults to 'raise'.
+            max_pending (int): The largest number of prompts read but not yet
+            handed over. Defaults to twice max_concurrent_calls.
+        Returns:
+            int: The number of prompts processed.
+        """
+        async def consume():
+            loop = asyncio.get_running_loop()
+            nb_results = 0
+            async for index, content in self.iter_chat_stream(
+                    prompts, temperature, presence_penalty,
+                    frequency_penalty, on_error=on_error,
+                    max_pending=max_pending):
+                # A blocking call from the callback would stop the loop
+                await loop.run_in_executor(None, result_callback, index,
+                                           content)
+                nb_results += 1
+            return nb_results
+
+        return get_async_runner().run(consume())
 
     def call_embeddingGPT(
             self,
@@ -346,14 +1592,25 @@ class OpenaiLongParser:
         temperature=0.1,
         presence_penalty=0.0,
         frequency_penalty=0.0,
+        on_error="raise",
+        **stream_kwargs
     ):
         """Processes all the chunks through the API with a given prompt.
         Args:
             prompt (str): The prompt to use for the API call.
             save_path (str): The path to save the chunks to. This is useful
             for debugging.
+            on_error (str): 'raise' to stop at the first failed chunk or
+            'partial' to keep the results of the other chunks. Defaults to
+            'raise'.
+            **stream_kwargs: The streaming options of iter_chat_results,
+            stream, first_token_timeout and partial_callback, the deadline
+            of the batch and longest_first, which is on unless the chunks
+            are streamed.
         Returns:
-            str: The generated text.
+            list: The generated text of each chunk. With on_error='partial',
+            a tuple of the generated texts, with None for the failed chunks,
+            and a dict of the exception of each failed chunk.
         """
 
         list_chunk = self.chunks
@@ -365,9 +1622,7 @@ class OpenaiLongParser:
         for i, chunk in enumerate(list_chunk):
             logging.debug(f"Processing chunk {i}/ {len(list_chunk)}")
 
-            # ChatGPT has a un-tenable desire to finish sentences so we add a .
-            # at the end of the prompt
-            submit_prompt = prompt + "\n\n" + chunk + "."
+            submit_prompt = build_chunk_prompt(prompt, chunk)
 
             if save_path:
                 # We save the input prompt chunk
@@ -377,46 +1632,49 @@ class OpenaiLongParser:
 
             submit_prompts.append(submit_prompt)
 
+        # The whole batch is awaited so its longest chunks are sent first,
+        # unless the partial texts are streamed as they arrive
+        stream_kwargs.setdefault("longest_first",
+                                 not stream_kwargs.get("stream", False))
         processed_chunks = self.multi_call_chatGPT(
             submit_prompts,
             temperature=temperature,
             presence_penalty=presence_penalty,
             frequency_penalty=frequency_penalty,
+            on_error=on_error,
+            **stream_kwargs
         )
+        if on_error == "partial":
+            processed_chunks, errors = processed_chunks
 
         for i, (chunk, result) in enumerate(zip(list_chunk, processed_chunks)):
-            if save_path:
+            if save_path and result is not None:
                 # We save the output prompt chunk
                 chunk_path = os.path.join(save_path, f"output_chunk_{i}.txt")
                 with open(chunk_path, "w") as f:
                     f.write(result)
 
+        if on_error == "partial":
+            return processed_chunks, errors
         return processed_chunks
 
     def process_chunks_through_embedding(
         self
     ):
         """Processes all the chunks through the API to extract embeddings.
-        Args:
         Returns:
+            tuple: The embedding of each chunk and the list of chunks.
         """
 
         list_chunk = self.chunks
-        processed_chunks = []
         logging.debug(f"Number of chunks to embed: {len(list_chunk)}")
 
-        # We replace this with async calls
-        for i, chunk in enumerate(list_chunk):
-            logging.debug(f"Processing chunk {i}/ {len(list_chunk)}")
-
-            # ChatGPT has a un-tenable desire to finish sentences so we
-            # add a "." at the end of the prompt
-            submit_text = chunk + "."
-
-            result = self.call_embeddingGPT(
-                submit_text,
-            )
+        # ChatGPT has a un-tenable desire to finish sentences so we
+        # add a "." at the end of the prompt
+        submit_texts = [chunk + "." for chunk in list_chunk]
 
-            processed_chunks.append(result)
+        # All the chunks are sent in a few concurrent batched requests.
+        processed_chunks = embed_texts(
+            submit_texts, max_concurrent_calls=self.max_concurrent_calls)
 
         return processed_chunks, list_chunk
@@ -7,6 +7,18 @@ import os
 import logging
 from papers_extractor.openai_parsers import OpenaiLongParser
 from papers_extractor.database_parser import hash_file
+from papers_extractor.chunk_checkpoint import ChunkCheckpoint
+from papers_extractor.request_scheduler import DEFAULT_PRIORITY
+
+# This prompt is used to clean up the text extracted from the PDF.
+CLEANUP_PROMPT = "Clean up formatting, Remove author list, " + \
+    "Remove references & bibliography, Remove page number, " + \
+    "Remove headers and Remove footers from the following " + \
+    "text from a scientific publication. Don't change any " + \
+    "other words:"
+
+# The temperature of the clean up calls.
+CLEANUP_TEMPERATURE = 0.1
 
 
 class PdfParser:
@@ -94,11 +106,41 @@ class PdfParser:
 
         return updated_text
 
-    def get_clean_text(self, chunks_path=None):
+    def get_text_to_clean(self):
+        """Returns the text sent to the API to be cleaned up.
+        Returns:
+            str: The raw text, without the bibliography if cut_bibliography
+            is set.
+        """
+        if self.cut_bibliography:
+            return self.remove_bibliography(self.raw_text)
+        return self.raw_text
+
+    def get_cleanup_checkpoint(self):
+        """Returns the checkpoint of the clean up of the text.
+        Returns:
+            ChunkCheckpoint: The checkpoint or None if there is no database.
+        """
+        if self.database is None:
+            return None
+        return ChunkCheckpoint(self.database, "cleanup_" + self.database_id)
+
+    def get_clean_text(self, chunks_path=None, chunk_size=1400,
+                       chunk_unit="words", priority=DEFAULT_PRIORITY,
+                       keep_formatting=False):
         """Extracts the text from the PDF file and cleans it up.
         Args:
             chunks_path (str): The path to the folder where the chunks are
             saved. Defaults to None. Used only for debugging.
+            chunk_size (int): The size of the chunks sent to the API.
+            Defaults to 1400.
+            chunk_unit (str): The unit of chunk_size. Can be 'words' or
+            'model_tokens'. Defaults to 'words'.
+            priority (str): The priority class of the calls in the shared
+            scheduler. Defaults to DEFAULT_PRIORITY.
+            keep_formatting (bool): If True, the chunks sent to the API keep
+            the spacing and line breaks of the text, like the layout of
+            tables. Defaults to False.
         Returns:
             str: The cleaned up text.
         """
@@ -106,28 +148,33 @@ class PdfParser:
         if self.cleaned_text:
             return self.cleaned_text
         else:
-            if self.cut_bibliography:
-                text_cleaned = self.remove_bibliography(self.raw_text)
+            text_cleaned = self.get_text_to_clean()
 
             logging.debug("Cleaning up and compressing the text")
-            openai_prompt = "Clean up formatting, Remove author list, " + \
-                "Remove references & bibliography, Remove page number, " + \
-                "Remove headers and Remove footers from the following " + \
-                "text from a scientific publication. Don't change any " + \
-                "other words:"
 
-            AIParser = OpenaiLongParser(text_cleaned, chunk_size=1400)
+            # Chunks that were already cleaned up are not sent again if a
+            # previous attempt failed.
+            checkpoint = self.get_cleanup_checkpoint()
+
+            AIParser = OpenaiLongParser(text_cleaned, chunk_size=chunk_size,
+                                        chunk_unit=chunk_unit,
+                                        keep_formatting=keep_formatting,
+                                        checkpoint=checkpoint,
+                                        priority=priority)
 
             if chunks_path is not None:
                 if not os.path.exists(chunks_path):
                     os.mkdir(chunks_path)
 
             all_chunks = AIParser.process_chunks_through_prompt(
-                openai_prompt, save_path=chunks_path
+                CLEANUP_PROMPT, save_path=chunks_path,
+                temperature=CLEANUP_TEMPERATURE
             )
 
             self.cleaned_text = "\n".join(all_chunks)
 
             self.save_database()
+            if checkpoint is not None:
+                checkpoint.clear()
 
             return self.cleaned_text
@@ -0,0 +1,504 @@
+# This file contains a planner of the PDF to summary pipeline. It runs only
+# the local stages, text extraction and chunking, and replays the recursive
+# summarization of LongText to predict how many calls and tokens each stage
+# of the pipeline will send to the OpenAI API and how long they will take.
+# Work already saved in the local database is not counted. This is used to
+# budget batch jobs and to pick chunk sizes before launching them.
+import functools
+import logging
+import math
+from papers_extractor.completion_cache import get_completion_cache
+from papers_extractor.long_text import LongText, CLEANUP_CHUNK_SIZE, \
+    SUMMARY_PROMPT, SUMMARY_CLEANUP_PROMPT, SUMMARY_PARAMETERS
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL, \
+    EMBEDDING_MODEL, build_chunk_prompt, count_tokens, \
+    pack_texts_in_batches, EMBEDDING_MAX_INPUTS, EMBEDDING_TOKENS_PER_REQUEST
+from papers_extractor.pdf_parser import PdfParser, CLEANUP_PROMPT
+from papers_extractor.rate_limiter import get_rate_limiter
+from papers_extractor.summary_tree import SummaryTree, count_chunk_units, \
+    make_leaf_key, make_parent_key
+from papers_extractor.token_counter import get_token_counter
+
+# The summarization loop stops after this many levels in case the summaries
+# are expected not to shrink the text.
+MAX_SUMMARY_LEVELS = 20
+
+# Each message carries 4 tokens of overhead in the chat format.
+MESSAGE_TOKENS = 4
+
+
+def merge_stages(stages):
+    """Adds up the stages of several plans that have the same name.
+    Args:
+        stages (list): A list of stage dicts.
+    Returns:
+        list: One stage dict per name, in order of first appearance.
+    """
+    merged = {}
+    for stage in stages:
+        if stage["stage"] not in merged:
+            merged[stage["stage"]] = dict(stage)
+            continue
+        total = merged[stage["stage"]]
+        for key in ["calls", "cached_calls", "prompt_tokens",
+                    "completion_tokens", "seconds"]:
+            total[key] += stage[key]
+        total["estimated"] = total["estimated"] or stage["estimated"]
+    return list(merged.values())
+
+
+def format_plan(plan):
+    """Formats a plan as a table to print.
+    Args:
+        plan (dict): A plan returned by PipelinePlanner.
+    Returns:
+        str: The table.
+    """
+    lines = [f"{'stage':<16}{'calls':>8}{'cached':>8}{'prompt tok':>12}"
+             f"{'output tok':>12}{'minutes':>10}"]
+    for stage in plan["stages"]:
+        # Stages extrapolated beyond the known text are marked with a ~
+        marker = "~" if stage["estimated"] else ""
+        lines.append(f"{stage['stage'] + marker:<16}{stage['calls']:>8}"
+                     f"{stage['cached_calls']:>8}"
+                     f"{stage['prompt_tokens']:>12}"
+                     f"{stage['completion_tokens']:>12}"
+                     f"{stage['seconds'] / 60:>10.1f}")
+    lines.append(f"{'total':<16}{plan['calls']:>8}{'':>8}"
+                 f"{plan['prompt_tokens']:>12}{plan['completion_tokens']:>12}"
+                 f"{plan['seconds'] / 60:>10.1f}")
+    return "\n".join(lines)
+
+
+class PipelinePlanner:
+    """This class predicts the API calls, tokens and time needed to clean up,
+    summarize and embed PDF files without calling the API. The PDF files are
+    read and chunked like the pipeline would, and the cleaned texts,
+    summaries, embeddings and completions already in the local database are
+    treated as free.
+    """
+
+    def __init__(self, local_database=None, chunk_size=1400,
+                 chunk_unit="words", cut_bibliography=True,
+                 cleanup_concurrent_calls=8, summary_concurrent_calls=10,
+                 embedding_concurrent_calls=8, summary_ratio=0.3,
+                 call_latency=1.0, output_tokens_per_second=50):
+        """Initializes the planner with the settings of the pipeline.
+        Args:
+            local_database (LocalDatabase): The database the pipeline will
+            use. If None, nothing is cached. Defaults to None.
+            chunk_size (int): The chunk size of the pipeline. Defaults to
+            1400.
+            chunk_unit (str): The unit of chunk_size, 'words' or
+            'model_tokens'. Defaults to 'words'.
+            cut_bibliography (bool): If the bibliography is removed before
+            the clean up. Defaults to True.
+            cleanup_concurrent_calls (int): The concurrent calls of the
+            clean up. Defaults to 8.
+            summary_concurrent_calls (int): The concurrent calls of the
+            summaries. Defaults to 10.
+            embedding_concurrent_calls (int): The concurrent calls of the
+            embeddings. Defaults to 8.
+            summary_ratio (float): The expected length of a summary relative
+            to its chunk, used for the levels that are not cached. Defaults
+            to 0.3.
+            call_latency (float): The expected latency of a call in seconds
+            before the first generated token. Defaults to 1.
+            output_tokens_per_second (float): The expected speed at which a
+            call generates tokens. Defaults to 50.
+        Returns:
+            None
+        """
+        if not 0 < summary_ratio < 1:
+            raise ValueError("summary_ratio must be between 0 and 1")
+        self.database = local_database
+        self.chunk_size = chunk_size
+        self.chunk_unit = chunk_unit
+        self.cut_bibliography = cut_bibliography
+        self.cleanup_concurrent_calls = cleanup_concurrent_calls
+        self.summary_concurrent_calls = summary_concurrent_calls
+        self.embedding_concurrent_calls = embedding_concurrent_calls
+        self.summary_ratio = summary_ratio
+        self.call_latency = call_latency
+        self.output_tokens_per_second = output_tokens_per_second
+
+    def _new_stage(self, name, model):
+        return {"stage": name, "model": model, "calls": 0, "cached_calls": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0,
+                "estimated": False}
+
+    def _get_summary_lookup(self):
+        """Returns a function looking up the summaries cached in the
+        database, or None."""
+        if self.database is None:
+            return None
+        completion_cache = get_completion_cache(self.database)
+        return functools.partial(completion_cache.peek, CHAT_MODEL,
+                                 **SUMMARY_PARAMETERS)
+
+    def _count_units(self, text):
+        """Counts the size of a text in the unit of the chunks."""
+        return count_chunk_units(text, self.chunk_unit)
+
+    def _estimate_seconds(self, model, nb_calls, nb_tokens,
+                          completion_tokens, max_concurrent_calls):
+        """Estimates the time taken by a set of calls sent at once. The calls
+        are sent in waves of max_concurrent_calls unless the rate limits of
+        the model are reached first.
+        Args:
+            model (str): The model of the calls.
+            nb_calls (int): The number of calls.
+            nb_tokens (int): The number of prompt and completion tokens.
+            completion_tokens (int): The number of generated tokens.
+            max_concurrent_calls (int): The concurrency of the calls.
+        Returns:
+            float: The time in seconds.
+        """
+        if nb_calls == 0:
+            return 0.0
+        seconds_per_call = self.call_latency + \
+            completion_tokens / nb_calls / self.output_tokens_per_second
+        seconds = math.ceil(nb_calls / max_concurrent_calls) * \
+            seconds_per_call
+
+        limiter = get_rate_limiter(model)
+        if limiter.requests_per_minute:
+            seconds = max(seconds, 60 * nb_calls / limiter.requests_per_minute)
+        if limiter.tokens_per_minute:
+            seconds = max(seconds, 60 * nb_tokens / limiter.tokens_per_minute)
+        return seconds
+
+    def _plan_chat_calls(self, stage, prompts, lookup, max_concurrent_calls,
+                         completion_ratio):
+        """Adds a set of concurrent chat calls to a stage.
+        Args:
+            stage (dict): The stage to update.
+            prompts (list): The prompts of the calls.
+            lookup (callable): Returns the completion of a prompt saved by
+            the pipeline, or None. If None, nothing is saved.
+            max_concurrent_calls (int): The concurrency of the calls.
+            completion_ratio (float): The expected length of a completion
+            relative to its prompt.
+        Returns:
+            list: The cached completion of each prompt, or None.
+        """
+        completions = []
+        prompt_tokens = 0
+        completion_tokens = 0
+        for prompt in prompts:
+            completion = None
+            if lookup is not None:
+                completion = lookup(prompt)
+            completions.append(completion)
+            if completion is not None:
+                stage["cached_calls"] += 1
+                continue
+            nb_tokens = count_tokens([prompt])
+            prompt_tokens += nb_tokens
+            completion_tokens += int(completion_ratio * nb_tokens)
+
+        nb_calls = sum(1 for completion in completions if completion is None)
+        stage["calls"] += nb_calls
+        stage["prompt_tokens"] += prompt_tokens
+        stage["completion_tokens"] += completion_tokens
+        stage["seconds"] += self._estimate_seconds(
+            CHAT_MODEL, nb_calls, prompt_tokens + completion_tokens,
+            completion_tokens, max_concurrent_calls)
+        return completions
+
+    def plan_cleanup(self, pdf_parser):
+        """Plans the clean up of the text of a PDF file.
+        Args:
+            pdf_parser (PdfParser): The parser of the PDF file.
+        Returns:
+            tuple: The stage dict and the cleaned text, or None if it can only
+            be known after calling the API.
+        """
+        stage = self._new_stage("cleanup", CHAT_MODEL)
+        parser = OpenaiLongParser(pdf_parser.get_text_to_clean(),
+                                  chunk_size=self.chunk_size,
+                                  chunk_unit=self.chunk_unit)
+        if pdf_parser.cleaned_text:
+            stage["cached_calls"] = parser.num_chunks
+            return stage, pdf_parser.cleaned_text
+
+        # The clean up is expected to keep every word of the text
+        prompts = [build_chunk_prompt(CLEANUP_PROMPT, chunk)
+                   for chunk in parser.chunks]
+        checkpoint = pdf_parser.get_cleanup_checkpoint()
+        completions = self._plan_chat_calls(
+            stage, prompts, checkpoint.get if checkpoint else None,
+            self.cleanup_concurrent_calls, completion_ratio=1.0)
+        if any(completion is None for completion in completions):
+            return stage, None
+        return stage, "\n".join(completions)
+
+    def _plan_estimated_summary(self, stage, nb_units, nb_tokens, fill_factor,
+                                final_chunk_length, nb_nodes):
+        """Plans the levels of the summarization whose text is not known.
+        Args:
+            stage (dict): The stage to update.
+            nb_units (float): The length of the text in the chunk unit.
+            nb_tokens (float): The length of the text in model tokens.
+            fill_factor (float): The average fraction of chunk_size filled by
+            a chunk.
+            final_chunk_length (int): The final number of chunks.
+            nb_nodes (int): The number of nodes of the level summarized last.
+        Returns:
+            tuple: The expected length of the final text in the chunk unit
+            and in model tokens.
+        """
+        stage["estimated"] = True
+        prompt_overhead = count_tokens([SUMMARY_PROMPT]) + MESSAGE_TOKENS
+        for _ in range(MAX_SUMMARY_LEVELS):
+            nb_chunks = max(1, math.ceil(
+                nb_units / (self.chunk_size * fill_factor)))
+            if nb_chunks <= final_chunk_length:
+                break
+            # The tree stops when the summaries do not shorten the text, as
+            # in SummaryTree
+            if nb_chunks >= nb_nodes:
+                break
+            nb_nodes = nb_chunks
+            prompt_tokens = int(nb_tokens) + nb_chunks * prompt_overhead
+            completion_tokens = int(self.summary_ratio * nb_tokens)
+            stage["calls"] += nb_chunks
+            stage["prompt_tokens"] += prompt_tokens
+            stage["completion_tokens"] += completion_tokens
+            stage["seconds"] += self._estimate_seconds(
+                CHAT_MODEL, nb_chunks, prompt_tokens + completion_tokens,
+                completion_tokens, self.summary_concurrent_calls)
+            nb_units *= self.summary_ratio
+            nb_tokens *= self.summary_ratio
+        return nb_units, nb_tokens
+
+    def plan_summary(self, cleaned_text, final_chunk_length=1,
+                     use_database=True):
+        """Plans the summary tree of LongText. The levels saved in the pyramid
+        of the text are skipped and the levels whose summaries are all cached
+        are replayed exactly. The following levels are extrapolated with
+        summary_ratio.
+        Args:
+            cleaned_text (str): The text to summarize.
+            final_chunk_length (int): The final number of chunks. Defaults
+            to 1.
+            use_database (bool): If False, nothing is looked up in the
+            database. Defaults to True.
+        Returns:
+            dict: The stage dict.
+        """
+        stage = self._new_stage("summary", CHAT_MODEL)
+        summary_lookup = None
+        if use_database:
+            summary_lookup = self._get_summary_lookup()
+        if use_database and self.database is not None:
+            long_text = LongText(cleaned_text, chunk_size=self.chunk_size,
+                                 local_database=self.database,
+                                 chunk_unit=self.chunk_unit)
+            if long_text.get_saved_summary(final_chunk_length) is not None:
+                return stage
+
+        # The summary tree is replayed level by level. Its nodes are looked
+        # up in the database by the hash of their children.
+        summary_tree = SummaryTree(
+            SUMMARY_PROMPT, chunk_size=self.chunk_size,
+            chunk_unit=self.chunk_unit, final_chunk_length=final_chunk_length,
+            local_database=self.database if use_database else None,
+            **SUMMARY_PARAMETERS)
+        current_text = cleaned_text
+        pyramid = summary_tree.load_pyramid(cleaned_text)
+        if pyramid is None:
+            level_texts = OpenaiLongParser(cleaned_text,
+                                           chunk_size=self.chunk_size,
+                                           chunk_unit=self.chunk_unit).chunks
+            level_keys = [make_leaf_key(text) for text in level_texts]
+        else:
+            # The saved levels are not summarized again. The replay starts
+            # from the first one that is short enough, or from the top.
+            top = len(pyramid) - 1
+            for level, nodes in enumerate(pyramid):
+                if len(nodes) <= final_chunk_length:
+                    top = level
+                    break
+            stage["cached_calls"] += sum(len(nodes)
+                                         for nodes in pyramid[:top])
+            level_texts = [node.text for node in pyramid[top]]
+            level_keys = [node.key for node in pyramid[top]]
+            if top > 0:
+                current_text = "\n".join(level_texts)
+        for _ in range(MAX_SUMMARY_LEVELS):
+            if len(level_texts) <= final_chunk_length:
+                break
+            logging.debug(f"Planning summary of {len(level_texts)} nodes")
+            prompts = [build_chunk_prompt(SUMMARY_PROMPT, text)
+                       for text in level_texts]
+            node_keys = dict(zip(prompts, level_keys))
+
+            def lookup(prompt):
+                summary = summary_tree.load_summary(node_keys[prompt])
+                if summary is None and summary_lookup is not None:
+                    summary = summary_lookup(prompt)
+                return summary
+
+            completions = self._plan_chat_calls(
+                stage, prompts, lookup if use_database else None,
+                self.summary_concurrent_calls,
+                completion_ratio=self.summary_ratio)
+            if any(completion is None for completion in completions):
+                # We cannot know the next levels so we extrapolate from the
+                # length of this one
+                nb_units = 0
+                nb_tokens = 0
+                for text, completion in zip(level_texts, completions):
+                    if completion is None:
+                        nb_units += self.summary_ratio * \
+                            self._count_units(text)
+                        nb_tokens += self.summary_ratio * \
+                            get_token_counter().count(text)
+                    else:
+                        nb_units += self._count_units(completion)
+                        nb_tokens += get_token_counter().count(completion)
+                fill_factor = sum(self._count_units(text)
+                                  for text in level_texts) / \
+                    (len(level_texts) * self.chunk_size)
+                fill_factor = min(1.0, max(0.5, fill_factor))
+                nb_units, nb_tokens = self._plan_estimated_summary(
+                    stage, nb_units, nb_tokens, fill_factor,
+                    final_chunk_length, len(level_texts))
+                current_text = None
+                break
+            current_text = "\n".join(completions)
+            groups = summary_tree.group_children(
+                [self._count_units(completion) for completion in completions])
+            if len(groups) >= len(level_texts):
+                # The summaries do not shorten the text so the tree stops
+                # at this level, as in SummaryTree
+                break
+            level_texts = ["\n".join(completions[index] for index in group)
+                           for group in groups]
+            level_keys = [make_parent_key([level_keys[index]
+                                           for index in group])
+                          for group in groups]
+
+        # The final clean up is only done if the summary fits in one call
+        cleanup_size = CLEANUP_CHUNK_SIZE[self.chunk_unit]
+        if current_text is not None:
+            final_parser = OpenaiLongParser(current_text,
+                                            chunk_size=cleanup_size,
+                                            chunk_unit=self.chunk_unit)
+            if final_parser.num_chunks == 1:
+                prompts = [build_chunk_prompt(SUMMARY_CLEANUP_PROMPT,
+                                              final_parser.chunks[0])]
+                self._plan_chat_calls(
+                    stage, prompts, summary_lookup,
+                    self.summary_concurrent_calls, completion_ratio=1.0)
+        elif nb_units <= cleanup_size:
+            prompt_tokens = int(nb_tokens) + MESSAGE_TOKENS + \
+                count_tokens([SUMMARY_CLEANUP_PROMPT])
+            stage["calls"] += 1
+            stage["prompt_tokens"] += prompt_tokens
+            stage["completion_tokens"] += int(nb_tokens)
+            stage["seconds"] += self._estimate_seconds(
+                CHAT_MODEL, 1, prompt_tokens + int(nb_tokens),
+                int(nb_tokens), self.summary_concurrent_calls)
+        return stage
+
+    def plan_embedding(self, cleaned_text, use_database=True):
+        """Plans the embedding of the chunks of a text by LongText.
+        Args:
+            cleaned_text (str): The text to embed.
+            use_database (bool): If False, nothing is looked up in the
+            database. Defaults to True.
+        Returns:
+            dict: The stage dict.
+        """
+        stage = self._new_stage("embedding", EMBEDDING_MODEL)
+        parser = OpenaiLongParser(cleaned_text, chunk_size=self.chunk_size,
+                                  chunk_unit=self.chunk_unit)
+        if use_database and self.database is not None:
+            long_text = LongText(cleaned_text, chunk_size=self.chunk_size,
+                                 local_database=self.database,
+                                 chunk_unit=self.chunk_unit)
+            if long_text.embedding is not None:
+                stage["cached_calls"] = parser.num_chunks
+                return stage
+
+        token_counts = get_token_counter().count_batch(
+            [chunk + "." for chunk in parser.chunks])
+        batches = pack_texts_in_batches(token_counts,
+                                        EMBEDDING_TOKENS_PER_REQUEST,
+                                        EMBEDDING_MAX_INPUTS)
+        stage["calls"] = len(batches)
+        stage["prompt_tokens"] = sum(token_counts)
+        stage["seconds"] = self._estimate_seconds(
+            EMBEDDING_MODEL, len(batches), stage["prompt_tokens"], 0,
+            self.embedding_concurrent_calls)
+        return stage
+
+    def plan_pdf(self, pdf_path, final_chunk_length=1, summarize=True,
+                 embed=False, database_id="auto"):
+        """Plans the processing of a PDF file. The text of the file is
+        extracted unless it is in the database.
+        Args:
+            pdf_path (str): The path of the PDF file.
+            final_chunk_length (int): The final number of chunks of the
+            summary. Defaults to 1.
+            summarize (bool): If the text is summarized. Defaults to True.
+            embed (bool): If the text is embedded. Defaults to False.
+            database_id (str): The key of the PDF file in the database.
+            Defaults to auto.
+        Returns:
+            dict: The plan with the list of stages and the total calls, tokens
+            and seconds.
+        """
+        pdf_parser = PdfParser(pdf_path,
+                               cut_bibliography=self.cut_bibliography,
+                               local_database=self.database,
+                               database_id=database_id)
+        stages = []
+        stage, cleaned_text = self.plan_cleanup(pdf_parser)
+        stages.append(stage)
+
+        # If the clean up has to be called, the cleaned text is expected to
+        # be close to the text sent to it. Nothing after it can be cached.
+        estimated = cleaned_text is None
+        if estimated:
+            cleaned_text = pdf_parser.get_text_to_clean()
+
+        if summarize:
+            stages.append(self.plan_summary(cleaned_text, final_chunk_length,
+                                            use_database=not estimated))
+        if embed:
+            stages.append(self.plan_embedding(cleaned_text,
+                                              use_database=not estimated))
+        for stage in stages[1:]:
+            stage["estimated"] = stage["estimated"] or estimated
+
+        plan = self._total(stages)
+        plan["pdf_path"] = pdf_path
+        return plan
+
+    def plan_pdfs(self, pdf_paths, **kwargs):
+        """Plans the processing of several PDF files one after the other, like
+        the scripts do.
+        Args:
+            pdf_paths (list): The paths of the PDF files.
+            **kwargs: The arguments of plan_pdf, other than database_id.
+        Returns:
+            dict: The plan with the stages added up over the files, the totals
+            and the plan of each file in 'papers'.
+        """
+        papers = [self.plan_pdf(pdf_path, **kwargs) for pdf_path in pdf_paths]
+        plan = self._total(merge_stages(
+            [stage for paper in papers for stage in paper["stages"]]))
+        plan["papers"] = papers
+        return plan
+
+    def _total(self, stages):
+        return {"stages": stages,
+                "calls": sum(stage["calls"] for stage in stages),
+                "prompt_tokens": sum(stage["prompt_tokens"]
+                                     for stage in stages),
+                "completion_tokens": sum(stage["completion_tokens"]
+                                         for stage in stages),
+                "seconds": sum(stage["seconds"] for stage in stages)}
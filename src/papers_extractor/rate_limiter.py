@@ -0,0 +1,349 @@
+# This file contains a rate limiter shared by all the OpenAI parsers of the
+# process. The API limits requests and tokens per minute for each model so
+# every request goes through the limiter of its model. The limiter also
+# adapts how many requests can be in flight at once to the throttling the API
+# reports.
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+# Requests and tokens per minute allowed by default for each model. Models
+# that are not listed are only limited by their concurrency.
+DEFAULT_RATE_LIMITS = {
+    "gpt-3.5-turbo": {"requests_per_minute": 3500,
+                      "tokens_per_minute": 90000},
+    "text-embedding-ada-002": {"requests_per_minute": 3000,
+                               "tokens_per_minute": 1000000},
+}
+
+# Limiters are shared by every object of the process.
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(model):
+    """Returns the shared rate limiter of a model.
+    Args:
+        model (str): The model the requests are sent to.
+    Returns:
+        RateLimiter: The rate limiter of the model.
+    """
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _registry_lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                limiter = RateLimiter(model,
+                                      **DEFAULT_RATE_LIMITS.get(model, {}))
+                _limiters[model] = limiter
+    return limiter
+
+
+def configure_rate_limiter(model, **kwargs):
+    """Replaces the shared rate limiter of a model, for example to match the
+    limits of an account.
+    Args:
+        model (str): The model the requests are sent to.
+        **kwargs: The arguments of RateLimiter.
+    Returns:
+        RateLimiter: The new rate limiter of the model.
+    """
+    with _registry_lock:
+        limiter = RateLimiter(model, **kwargs)
+        _limiters[model] = limiter
+    return limiter
+
+
+def get_retry_after(error, default=None):
+    """Extracts the Retry-After delay of an API error.
+    Args:
+        error (Exception): The error raised by the openai library.
+        default (float): The delay to return if there is none.
+    Returns:
+        float: The number of seconds to wait before retrying.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return default
+
+
+class RequestPermit:
+    """This class is returned by RateLimiter.limit and is used to report what
+    happened to the request."""
+
+    def __init__(self, estimated_tokens):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+        self.throttled = False
+        self.failed = False
+        self.timed_out = False
+        self.retry_after = None
+
+    def record_usage(self, used_tokens):
+        """Records the number of tokens the request actually used."""
+        self.used_tokens = used_tokens
+
+    def record_throttle(self, retry_after=None):
+        """Records that the API refused the request with a 429 error."""
+        self.throttled = True
+        self.retry_after = retry_after
+
+    def record_failure(self, timed_out=False):
+        """Records that the request failed or timed out. The error is often
+        caught and retried within the limit, where the limiter cannot see
+        it."""
+        self.failed = True
+        self.timed_out = timed_out
+
+
+class RateLimiter:
+    """This class meters the requests sent to a model with two token buckets,
+    one for requests and one for tokens, and bounds the number of requests in
+    flight. The concurrency bound is halved when the API throttles requests
+    or when several requests in a row time out, and grows back by one after a
+    full round of successful requests.
+    The limiter is not bound to an event loop so it can be shared by parsers
+    running in different loops and threads.
+    """
+
+    def __init__(self, model, requests_per_minute=None,
+                 tokens_per_minute=None, max_concurrency=64,
+                 min_concurrency=1, default_retry_after=1.0,
+                 timeouts_before_decrease=3):
+        """Initializes the limiter.
+        Args:
+            model (str): The model the requests are sent to.
+            requests_per_minute (int): The number of requests allowed per
+            minute. If None, requests are not metered. Defaults to None.
+            tokens_per_minute (int): The number of tokens allowed per minute.
+            If None, tokens are not metered. Defaults to None.
+            max_concurrency (int): The largest number of requests in flight.
+            Defaults to 64.
+            min_concurrency (int): The smallest number of requests in flight
+            the limiter can fall back to. Defaults to 1.
+            default_retry_after (float): The pause in seconds after a
+            throttled request without a Retry-After header. Defaults to 1.
+            timeouts_before_decrease (int): The number of requests in a row
+            that time out before the concurrency bound is halved, as for a
+            throttled request. Defaults to 3.
+        Returns:
+            None
+        """
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.default_retry_after = default_retry_after
+        self.timeouts_before_decrease = timeouts_before_decrease
+
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.nb_requests = 0
+        self.nb_throttled = 0
+        self.nb_timeouts = 0
+
+        # The buckets start full
+        self._request_allowance = requests_per_minute
+        self._token_allowance = tokens_per_minute
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._success_streak = 0
+        self._timeout_streak = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute is not None:
+            self._request_allowance = min(
+                self.requests_per_minute,
+                self._request_allowance +
+                elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self._token_allowance = min(
+                self.tokens_per_minute,
+                self._token_allowance +
+                elapsed * self.tokens_per_minute / 60)
+
+    def _reserve(self, estimated_tokens):
+        """Takes a request and its tokens from the buckets if they are
+        available. Returns how long to wait otherwise."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait_time = self._blocked_until - now
+
+            if self.requests_per_minute is not None and \
+                    self._request_allowance < 1:
+                wait_time = max(wait_time, (1 - self._request_allowance) *
+                                60 / self.requests_per_minute)
+            if self.tokens_per_minute is not None:
+                # A request larger than the bucket waits for a full bucket
+                needed = min(estimated_tokens, self.tokens_per_minute)
+                if self._token_allowance < needed:
+                    wait_time = max(wait_time,
+                                    (needed - self._token_allowance) *
+                                    60 / self.tokens_per_minute)
+            if wait_time > 0:
+                return wait_time
+
+            if self.requests_per_minute is not None:
+                self._request_allowance -= 1
+            if self.tokens_per_minute is not None:
+                self._token_allowance -= estimated_tokens
+            self.nb_requests += 1
+            return 0
+
+    async def _acquire_slot(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_flight < self.concurrency_limit and \
+                    not self._waiters:
+                self.in_flight += 1
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+                    raise
+            # The slot was handed over just before the cancellation
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self):
+        # This must be called with the lock held. Slots are handed over to
+        # the waiters in their own event loop.
+        while self._waiters and self.in_flight < self.concurrency_limit:
+            loop, future = self._waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(_set_future_result, future)
+
+    def _report(self, permit):
+        with self._lock:
+            now = time.monotonic()
+            if permit.throttled:
+                self.nb_throttled += 1
+                self._success_streak = 0
+                retry_after = permit.retry_after
+                if retry_after is None:
+                    retry_after = self.default_retry_after
+                self._blocked_until = max(self._blocked_until,
+                                          now + retry_after)
+                # A burst of 429 only counts once per pause
+                if now - self._last_decrease > retry_after:
+                    self._last_decrease = now
+                    self.concurrency_limit = max(
+                        self.min_concurrency, self.concurrency_limit // 2)
+                    logging.warning(
+                        f"{self.model} throttled, concurrency lowered to "
+                        f"{self.concurrency_limit}")
+            elif permit.failed:
+                # A failed request does not count toward a larger bound
+                self._success_streak = 0
+                if permit.timed_out:
+                    self.nb_timeouts += 1
+                    self._timeout_streak += 1
+                    # A server that hangs is overloaded like one that
+                    # throttles
+                    if self._timeout_streak >= self.timeouts_before_decrease:
+                        self._timeout_streak = 0
+                        self._last_decrease = now
+                        self.concurrency_limit = max(
+                            self.min_concurrency,
+                            self.concurrency_limit // 2)
+                        logging.warning(
+                            f"{self.model} timing out, concurrency lowered "
+                            f"to {self.concurrency_limit}")
+            else:
+                self._timeout_streak = 0
+                self._success_streak += 1
+                if self._success_streak >= self.concurrency_limit and \
+                        self.concurrency_limit < self.max_concurrency:
+                    self._success_streak = 0
+                    self.concurrency_limit += 1
+                    self._wake_waiters()
+
+            if self.tokens_per_minute is not None:
+                if permit.used_tokens is not None:
+                    # The estimate is corrected once the usage is known
+                    self._token_allowance += (permit.estimated_tokens -
+                                              permit.used_tokens)
+                elif permit.throttled:
+                    # A request rejected with a 429 used no tokens
+                    self._token_allowance += permit.estimated_tokens
+
+    def limit(self, estimated_tokens=0):
+        """Returns an async context manager that waits until a request can be
+        sent and reports its outcome when it exits.
+        Args:
+            estimated_tokens (int): The number of tokens the request is
+            expected to use, prompt and response.
+        Returns:
+            _LimitedRequest: The async context manager. It gives a
+            RequestPermit to record the usage or the throttling.
+        """
+        return _LimitedRequest(self, estimated_tokens)
+
+    def stats(self):
+        """Returns statistics about the limiter.
+        Returns:
+            dict: The number of requests, throttled requests and timed out
+            requests, the requests in flight and the current concurrency
+            limit.
+        """
+        with self._lock:
+            return {"model": self.model,
+                    "nb_requests": self.nb_requests,
+                    "nb_throttled": self.nb_throttled,
+                    "nb_timeouts": self.nb_timeouts,
+                    "in_flight": self.in_flight,
+                    "concurrency_limit": self.concurrency_limit}
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _LimitedRequest:
+    """Async context manager returned by RateLimiter.limit."""
+
+    def __init__(self, limiter, estimated_tokens):
+        self.limiter = limiter
+        self.permit = RequestPermit(estimated_tokens)
+
+    async def __aenter__(self):
+        await self.limiter._acquire_slot()
+        try:
+            while True:
+                wait_time = self.limiter._reserve(
+                    self.permit.estimated_tokens)
+                if wait_time <= 0:
+                    return self.permit
+                await asyncio.sleep(wait_time)
+        except BaseException:
+            self.limiter._release_slot()
+            raise
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.permit.failed = True
+        self.limiter._report(self.permit)
+        self.limiter._release_slot()
+        return False
@@ -0,0 +1,242 @@
+# This file contains a scheduler shared by all the jobs of the process that
+# call the OpenAI API. The jobs share a global budget of requests in flight.
+# When the budget is used up, waiting requests are admitted by priority
+# class with weighted fair sharing, so interactive jobs keep a low latency
+# while bulk jobs use the remaining capacity. Within a class, requests with
+# the earliest deadline go first and requests past their deadline are
+# dropped instead of being sent.
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+# The share of the budget each priority class gets when all of them are
+# waiting. A class with nothing waiting leaves its share to the others.
+PRIORITY_WEIGHTS = {"interactive": 16, "normal": 4, "bulk": 1}
+
+# The priority of jobs that do not set one.
+DEFAULT_PRIORITY = "normal"
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a request could not be done before the deadline of its
+    job."""
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RequestScheduler:
+    """This class admits the requests of all the jobs of the process within a
+    global concurrency budget. It is not bound to an event loop so it can be
+    shared by jobs running in different loops and threads.
+    """
+
+    def __init__(self, max_concurrency=64, priority_weights=None):
+        """Initializes the scheduler.
+        Args:
+            max_concurrency (int): The largest number of requests in flight
+            over all the jobs. Defaults to 64.
+            priority_weights (dict): The weight of each priority class.
+            Defaults to PRIORITY_WEIGHTS.
+        Returns:
+            None
+        """
+        if priority_weights is None:
+            priority_weights = PRIORITY_WEIGHTS
+        self.max_concurrency = max_concurrency
+        self.priority_weights = dict(priority_weights)
+        self.in_flight = 0
+        self.nb_admitted = {priority: 0 for priority in priority_weights}
+        self.nb_expired = 0
+
+        # Each class has a heap of waiters ordered by deadline. The virtual
+        # time of a class grows by 1 / weight for each admitted request and
+        # the class with the lowest virtual time goes next.
+        self._waiters = {priority: [] for priority in priority_weights}
+        self._queued = set()
+        self._virtual_times = {priority: 0.0 for priority in priority_weights}
+        self._system_time = 0.0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _check_priority(self, priority):
+        if priority not in self.priority_weights:
+            raise ValueError(
+                f"priority must be one of {list(self.priority_weights)}")
+
+    def _has_waiters(self, priority):
+        # Waiters that were removed stay in the heaps until they are popped
+        heap = self._waiters[priority]
+        while heap and heap[0][1] not in self._queued:
+            heapq.heappop(heap)
+        return bool(heap)
+
+    def _charge(self, priority):
+        # A class that was idle does not get credit for the time it did not
+        # use the budget
+        virtual_time = max(self._virtual_times[priority], self._system_time)
+        self._system_time = virtual_time
+        self._virtual_times[priority] = virtual_time + \
+            1 / self.priority_weights[priority]
+        self.nb_admitted[priority] += 1
+        self.in_flight += 1
+
+    def _wake_waiters(self):
+        # This must be called with the lock held. Slots are handed over to
+        # the waiters in their own event loop.
+        while self.in_flight < self.max_concurrency:
+            active = [priority for priority in self.priority_weights
+                      if self._has_waiters(priority)]
+            if not active:
+                return
+            priority = min(active, key=lambda name: max(
+                self._virtual_times[name], self._system_time))
+            _, sequence, loop, future = heapq.heappop(
+                self._waiters[priority])
+            self._queued.discard(sequence)
+            self._charge(priority)
+            loop.call_soon_threadsafe(_set_future_result, future)
+
+    async def acquire(self, priority=DEFAULT_PRIORITY, deadline=None):
+        """Waits for a slot in the budget.
+        Args:
+            priority (str): The priority class of the request. Defaults to
+            DEFAULT_PRIORITY.
+            deadline (float): The time.monotonic() after which the request is
+            dropped. If None, it waits as long as needed. Defaults to None.
+        Returns:
+            None
+        Raises:
+            DeadlineExceededError: If no slot was free before the deadline.
+        """
+        self._check_priority(priority)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # A request retried after its deadline is not sent again
+            if deadline is not None and time.monotonic() >= deadline:
+                self.nb_expired += 1
+                raise DeadlineExceededError(
+                    "The deadline passed before the request was sent")
+            if self.in_flight < self.max_concurrency and \
+                    not any(self._has_waiters(name)
+                            for name in self.priority_weights):
+                self._charge(priority)
+                return
+            future = loop.create_future()
+            sequence = next(self._sequence)
+            heap_deadline = math.inf if deadline is None else deadline
+            heapq.heappush(self._waiters[priority],
+                           (heap_deadline, sequence, loop, future))
+            self._queued.add(sequence)
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            with self._lock:
+                if sequence in self._queued:
+                    self._queued.discard(sequence)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.nb_expired += 1
+                        logging.warning(
+                            "Request dropped at the deadline of its job")
+                        raise DeadlineExceededError(
+                            "No slot was free before the deadline") from e
+                    raise
+            # The slot was handed over just before the cancellation
+            self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise DeadlineExceededError(
+                    "No slot was free before the deadline") from e
+            raise
+
+    def release(self):
+        """Gives back a slot taken with acquire."""
+        with self._lock:
+            self.in_flight -= 1
+            self._wake_waiters()
+
+    def slot(self, priority=DEFAULT_PRIORITY, deadline=None):
+        """Returns an async context manager that holds a slot of the budget
+        while a request is sent.
+        Args:
+            priority (str): The priority class of the request. Defaults to
+            DEFAULT_PRIORITY.
+            deadline (float): The time.monotonic() after which the request is
+            dropped. Defaults to None.
+        Returns:
+            _ScheduledRequest: The async context manager.
+        """
+        return _ScheduledRequest(self, priority, deadline)
+
+    def stats(self):
+        """Returns statistics about the scheduler.
+        Returns:
+            dict: The requests in flight, the requests waiting and admitted
+            per priority class and the requests dropped at their deadline.
+        """
+        with self._lock:
+            return {"in_flight": self.in_flight,
+                    "max_concurrency": self.max_concurrency,
+                    "waiting": {priority: sum(
+                        1 for entry in self._waiters[priority]
+                        if entry[1] in self._queued)
+                        for priority in self.priority_weights},
+                    "nb_admitted": dict(self.nb_admitted),
+                    "nb_expired": self.nb_expired}
+
+
+class _ScheduledRequest:
+    """Async context manager returned by RequestScheduler.slot."""
+
+    def __init__(self, scheduler, priority, deadline):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.deadline = deadline
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.priority, self.deadline)
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.scheduler.release()
+        return False
+
+
+# The scheduler is shared by every job of the process.
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the scheduler shared by the process.
+    Returns:
+        RequestScheduler: The shared scheduler.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler()
+    return _scheduler
+
+
+def configure_scheduler(**kwargs):
+    """Replaces the shared scheduler, for example to change the global
+    budget or the weights of the priority classes.
+    Args:
+        **kwargs: The arguments of RequestScheduler.
+    Returns:
+        RequestScheduler: The new scheduler.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(**kwargs)
+    return _scheduler
@@ -0,0 +1,109 @@
+# This file contains a single-flight layer shared by all the OpenAI parsers
+# of the process. When identical requests are in flight at the same time, for
+# example the same abstract or license text in several papers, only the
+# first one is sent to the API and the others wait for its result. The
+# results are shared through concurrent.futures so requests made from
+# different event loops and threads can be coalesced.
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+
+class _LeaderCancelledError(Exception):
+    """Raised to the waiters of a request whose caller was cancelled or
+    stopped for a reason of its own, like its deadline."""
+
+
+class SingleFlight:
+    """This class makes sure that a single call is made for each key at a
+    time. Callers that ask for a key already in flight get the result of the
+    call in flight instead of making their own.
+    """
+
+    def __init__(self):
+        """Initializes the layer with no call in flight.
+        Returns:
+            None
+        """
+        self.nb_calls = 0
+        self.nb_shared = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    async def run(self, key, coroutine_function, own_errors=()):
+        """Runs a call unless an identical one is already in flight.
+        Args:
+            key (hashable): The key of the call. Calls with the same key must
+            give the same result.
+            coroutine_function (callable): Creates the coroutine of the call.
+            It is only called if no call with the same key is in flight.
+            own_errors (tuple): The exceptions that only concern the caller
+            that made the call, like its own deadline. The waiters of a call
+            that fails with one of them make the call again themselves.
+            Defaults to no exception.
+        Returns:
+            tuple: The result of the call and True if it was shared with a
+            call in flight.
+        """
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = concurrent.futures.Future()
+                    # A running future cannot be cancelled by its waiters
+                    future.set_running_or_notify_cancel()
+                    self._in_flight[key] = future
+                    self.nb_calls += 1
+                else:
+                    self.nb_shared += 1
+
+            if is_leader:
+                return await self._lead(key, future, coroutine_function,
+                                        own_errors), False
+            try:
+                return await asyncio.wrap_future(future), True
+            except _LeaderCancelledError:
+                # The caller that made the call went away so we make it
+                # again ourselves
+                logging.debug("Shared call was cancelled, calling again")
+
+    async def _lead(self, key, future, coroutine_function, own_errors):
+        """Makes a call and shares its outcome with the waiters."""
+        try:
+            result = await coroutine_function()
+        except (asyncio.CancelledError, *own_errors):
+            future.set_exception(_LeaderCancelledError())
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        """Returns the number of calls made and shared.
+        Returns:
+            dict: The number of calls made, of calls shared and of calls in
+            flight.
+        """
+        with self._lock:
+            return {"nb_calls": self.nb_calls, "nb_shared": self.nb_shared,
+                    "in_flight": len(self._in_flight)}
+
+
+# The layer is shared by every parser of the process.
+_single_flight = SingleFlight()
+
+
+def get_single_flight():
+    """Returns the single-flight layer shared by the process.
+    Returns:
+        SingleFlight: The shared layer.
+    """
+    return _single_flight
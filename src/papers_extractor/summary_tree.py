@@ -0,0 +1,452 @@
+# This file contains a map-reduce engine to summarize long texts. The chunks
+# of a text are the leaves of a tree. Consecutive summaries are joined into a
+# parent node as soon as they are done and fill a chunk, so a level starts
+# before the level below is finished. Each node is cached in the local
+# database by the hash of its children, so a subtree that was already
+# summarized is not sent again. The levels of a finished tree are also saved
+# as a pyramid, so a later request for fewer final chunks starts from the
+# top of the pyramid.
+import asyncio
+import logging
+import time
+from papers_extractor.async_runner import get_async_runner
+from papers_extractor.database_parser import hash_variable, \
+    run_in_database_thread
+from papers_extractor.openai_parsers import OpenaiLongParser, \
+    build_chunk_prompt, custom_word_tokenize
+from papers_extractor.request_scheduler import DEFAULT_PRIORITY
+from papers_extractor.token_counter import get_token_counter, \
+    run_in_counting_thread
+
+# All the keys of the summary nodes start with this prefix so they can be
+# told apart from the papers and texts saved in the same database.
+SUMMARY_NODE_KEY_PREFIX = "summary_node_"
+SUMMARY_PYRAMID_KEY_PREFIX = "summary_pyramid_"
+
+
+def make_leaf_key(text):
+    """Creates the key of a leaf of the tree.
+    Args:
+        text (str): The chunk of the leaf.
+    Returns:
+        str: The key of the leaf.
+    """
+    return hash_variable(text)
+
+
+def make_parent_key(child_keys):
+    """Creates the key of a node from the keys of its children.
+    Args:
+        child_keys (list): The keys of the children, in order.
+    Returns:
+        str: The key of the node.
+    """
+    return hash_variable("".join(child_keys))
+
+
+def count_chunk_units(text, chunk_unit="words"):
+    """Counts the size of a text in the unit of the chunks.
+    Args:
+        text (str): The text to count.
+        chunk_unit (str): 'words' or 'model_tokens'. Defaults to 'words'.
+    Returns:
+        int: The size of the text.
+    """
+    if chunk_unit == "model_tokens":
+        return get_token_counter().count(text)
+    return len(custom_word_tokenize(text))
+
+
+class SummaryNode:
+    """This class is a node of a summary tree. Leaves hold a chunk of the
+    text and the other nodes hold the joined summaries of their children."""
+
+    def __init__(self, level, key, text, children=()):
+        """Initializes the node.
+        Args:
+            level (int): The level of the node, 0 for the leaves.
+            key (str): The key of the node.
+            text (str): The text to summarize.
+            children (list): The indices of the children in the level below.
+            Defaults to no children.
+        Returns:
+            None
+        """
+        self.level = level
+        self.key = key
+        self.text = text
+        self.children = list(children)
+        self.summary = None
+        self.summary_length = None
+        self.cached = False
+        self.ready_time = None
+        self.done_time = None
+        self.critical_path = 0.0
+
+
+class SummaryTree:
+    """This class summarizes a long text with a tree of calls to the API.
+    Nodes are summarized as soon as their children are done and the tree
+    stops at the first level with at most final_chunk_length nodes. The
+    summaries are grouped in order so the tree is the same on every run,
+    which means a slow node also holds back the nodes after it in its
+    level."""
+
+    def __init__(self, prompt, chunk_size=1400, chunk_unit="words",
+                 final_chunk_length=2, max_concurrent_calls=10,
+                 local_database=None, completion_cache=None,
+                 priority=DEFAULT_PRIORITY, temperature=0,
+                 presence_penalty=0.0, frequency_penalty=0.0):
+        """Initializes the tree.
+        Args:
+            prompt (str): The prompt used to summarize each node.
+            chunk_size (int): The largest size of the text of a node.
+            Defaults to 1400.
+            chunk_unit (str): The unit of chunk_size, 'words' or
+            'model_tokens'. Defaults to 'words'.
+            final_chunk_length (int): The largest number of nodes of the top
+            level. Defaults to 2.
+            max_concurrent_calls (int): The maximum number of concurrent
+            calls to the OpenAI API. Defaults to 10.
+            local_database (LocalDatabase): If given, the summary of each
+            node is saved in it and nodes already saved are not sent again.
+            Defaults to None.
+            completion_cache (CompletionCache): If given, completions are
+            looked up in this cache before calling the API. Defaults to None.
+            priority (str): The priority class of the calls in the shared
+            scheduler. Defaults to DEFAULT_PRIORITY.
+            temperature (float): The temperature to use for the API call.
+            presence_penalty (float): The presence penalty to use for the
+            API call.
+            frequency_penalty (float): The frequency penalty to use for the
+            API call.
+        Returns:
+            None
+        """
+        self.prompt = prompt
+        self.chunk_size = chunk_size
+        self.chunk_unit = chunk_unit
+        self.final_chunk_length = final_chunk_length
+        self.max_concurrent_calls = max_concurrent_calls
+        self.database = local_database
+        self.completion_cache = completion_cache
+        self.priority = priority
+        self.temperature = temperature
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.levels = []
+        self.depth = 0
+        self.nb_calls = 0
+        self.seconds = 0.0
+
+    def make_database_key(self, node_key):
+        """Creates the database key of a node. It also depends on the prompt
+        and its parameters.
+        Args:
+            node_key (str): The key of the node.
+        Returns:
+            str: The database key.
+        """
+        return SUMMARY_NODE_KEY_PREFIX + hash_variable(
+            (self.prompt, self.temperature, self.presence_penalty,
+             self.frequency_penalty, node_key))
+
+    def load_summary(self, node_key):
+        """Returns the saved summary of a node.
+        Args:
+            node_key (str): The key of the node.
+        Returns:
+            str: The saved summary or None if the node was not summarized.
+        """
+        if self.database is None:
+            return None
+        database_key = self.make_database_key(node_key)
+        if self.database.check_in_database(database_key):
+            return self.database.load_from_database(database_key)
+        return None
+
+    def make_pyramid_key(self, text):
+        """Creates the database key of the pyramid of a text. It depends on
+        the prompt, its parameters and the chunks of the text.
+        Args:
+            text (str): The text summarized by the tree.
+        Returns:
+            str: The database key.
+        """
+        return SUMMARY_PYRAMID_KEY_PREFIX + hash_variable(
+            (self.prompt, self.temperature, self.presence_penalty,
+             self.frequency_penalty, self.chunk_size, self.chunk_unit,
+             hash_variable(text)))
+
+    def load_pyramid(self, text):
+        """Returns the levels of the pyramid saved for a text.
+        Args:
+            text (str): The text summarized by the tree.
+        Returns:
+            list: The levels of the pyramid, each a list of SummaryNode, or
+            None if no pyramid was saved.
+        """
+        if self.database is None:
+            return None
+        pyramid_key = self.make_pyramid_key(text)
+        if not self.database.check_in_database(pyramid_key):
+            return None
+        levels = []
+        for level, saved_nodes in enumerate(
+                self.database.load_from_database(pyramid_key)):
+            nodes = []
+            for saved_node in saved_nodes:
+                node = SummaryNode(level, saved_node["key"],
+                                   saved_node["text"],
+                                   saved_node["children"])
+                if saved_node["summary"] is not None:
+                    node.summary = saved_node["summary"]
+                    node.summary_length = saved_node["summary_length"]
+                    node.cached = True
+                nodes.append(node)
+            levels.append(nodes)
+        return levels
+
+    def save_pyramid(self, text, levels):
+        """Saves the levels of a tree as the pyramid of a text. All the
+        levels but the top one must be summarized.
+        Args:
+            text (str): The text summarized by the tree.
+            levels (list): The levels of the tree, each a list of
+            SummaryNode.
+        Returns:
+            None
+        """
+        self.database.save_to_database(
+            self.make_pyramid_key(text),
+            [[{"key": node.key, "text": node.text,
+               "children": node.children, "summary": node.summary,
+               "summary_length": node.summary_length}
+              for node in nodes] for nodes in levels])
+
+    def group_children(self, lengths):
+        """Groups consecutive nodes of a level into the nodes of the next
+        level. The summaries are added to a node while they fit in
+        chunk_size. This is what the engine does as the summaries arrive.
+        Args:
+            lengths (list): The length of each summary in the chunk unit.
+        Returns:
+            list: A list of groups, each a list of indices of summaries.
+        """
+        groups = []
+        members = []
+        total = 0
+        for index, length in enumerate(lengths):
+            if members and total + length > self.chunk_size:
+                groups.append(members)
+                members = []
+                total = 0
+            members.append(index)
+            total += length
+        if members:
+            groups.append(members)
+        return groups
+
+    def summarize(self, text):
+        """Summarizes a long text. If a pyramid was saved for the text, only
+        the levels above its top are built.
+        Args:
+            text (str): The text to summarize.
+        Returns:
+            list: The texts of the nodes of the top level. At level 0, these
+            are the chunks of the text.
+        """
+        pyramid = self.load_pyramid(text)
+        if pyramid is None:
+            chunks = OpenaiLongParser(text, chunk_size=self.chunk_size,
+                                      chunk_unit=self.chunk_unit).chunks
+            pyramid = [[SummaryNode(0, make_leaf_key(chunk), chunk)
+                        for chunk in chunks]]
+            saved_depth = None
+        else:
+            saved_depth = len(pyramid) - 1
+            # The first level that is short enough is the top of the tree
+            for level, nodes in enumerate(pyramid):
+                if len(nodes) <= self.final_chunk_length:
+                    logging.debug(f"Summary found at level {level} of the "
+                                  "saved pyramid")
+                    self.levels = pyramid[:level + 1]
+                    self.depth = level
+                    self.nb_calls = 0
+                    self.seconds = 0.0
+                    return [node.text for node in self.levels[level]]
+
+        top_texts = get_async_runner().run(self.async_summarize(pyramid))
+        if self.database is not None and \
+                (saved_depth is None or self.depth > saved_depth):
+            self.save_pyramid(text, self.levels)
+        return top_texts
+
+    async def async_summarize(self, levels):
+        """Builds and summarizes the tree from its first levels.
+        Args:
+            levels (list): The first levels of the tree, each a list of
+            SummaryNode. It can be the leaves alone or a saved pyramid. All
+            the levels but the last one must be summarized.
+        Returns:
+            list: The texts of the nodes of the top level.
+        """
+        start_time = time.perf_counter()
+        levels = [list(nodes) for nodes in levels]
+        # The given levels are complete and only the last one is left to
+        # summarize
+        complete = [True] * len(levels)
+        consumed = [len(nodes) for nodes in levels[:-1]] + [0]
+        submitted = list(consumed)
+        top = None
+        queue = asyncio.Queue()
+        stream_nodes = []
+
+        def set_top(level):
+            nonlocal top
+            top = level
+            queue.put_nowait(None)
+
+        # The database reads and the counts run in threads so the loop
+        # keeps serving the calls in flight.
+        async def schedule(level):
+            # A level is only summarized once it has too many nodes to be
+            # the top of the tree
+            nodes = levels[level]
+            if len(nodes) <= self.final_chunk_length:
+                return
+            while submitted[level] < len(nodes):
+                node = nodes[submitted[level]]
+                submitted[level] += 1
+                node.ready_time = time.perf_counter()
+                summary = await run_in_database_thread(self.load_summary,
+                                                       node.key)
+                if summary is not None:
+                    node.cached = True
+                    await finish(node, summary)
+                else:
+                    stream_nodes.append(node)
+                    queue.put_nowait(node)
+
+        async def finish(node, summary):
+            node.summary = summary
+            node.summary_length = await run_in_counting_thread(
+                count_chunk_units, summary, self.chunk_unit)
+            node.done_time = time.perf_counter()
+            child_path = max((levels[node.level - 1][index].critical_path
+                              for index in node.children), default=0.0)
+            own_time = 0.0 if node.cached else \
+                node.done_time - node.ready_time
+            node.critical_path = child_path + own_time
+            if top is None:
+                await form_groups(node.level)
+
+        def add_parent(level, children_nodes, indices):
+            key = make_parent_key([child.key for child in children_nodes])
+            text = "\n".join(child.summary for child in children_nodes)
+            levels[level].append(SummaryNode(level, key, text, indices))
+
+        async def form_groups(level):
+            if len(levels) == level + 1:
+                levels.append([])
+                complete.append(False)
+                consumed.append(0)
+                submitted.append(0)
+            children = levels[level]
+            members = []
+            total = 0
+            reached_end = True
+            for index in range(consumed[level], len(children)):
+                child = children[index]
+                if child.summary is None:
+                    reached_end = False
+                    break
+                if members and total + child.summary_length > \
+                        self.chunk_size:
+                    add_parent(level + 1, [children[i] for i in members],
+                               members)
+                    consumed[level] = index
+                    members = []
+                    total = 0
+                members.append(index)
+                total += child.summary_length
+            if reached_end and complete[level] and members:
+                add_parent(level + 1, [children[i] for i in members],
+                           members)
+                consumed[level] = len(children)
+            if complete[level] and consumed[level] == len(children):
+                complete[level + 1] = True
+
+            parents = levels[level + 1]
+            if complete[level + 1]:
+                if len(parents) <= self.final_chunk_length:
+                    set_top(level + 1)
+                    return
+                if len(parents) >= len(children):
+                    logging.warning("The summaries do not shorten the text, "
+                                    "we stop the tree at this level")
+                    set_top(level + 1)
+                    return
+            await schedule(level + 1)
+
+        async def node_prompts():
+            while True:
+                node = await queue.get()
+                if node is None:
+                    return
+                yield build_chunk_prompt(self.prompt, node.text)
+
+        last_level = len(levels) - 1
+        if len(levels[last_level]) <= self.final_chunk_length:
+            set_top(last_level)
+        else:
+            await schedule(last_level)
+
+        if top is None or stream_nodes:
+            parser = OpenaiLongParser(
+                "", max_concurrent_calls=self.max_concurrent_calls,
+                completion_cache=self.completion_cache,
+                priority=self.priority)
+            async for position, summary in parser.iter_chat_stream(
+                    node_prompts(), self.temperature, self.presence_penalty,
+                    self.frequency_penalty):
+                node = stream_nodes[position]
+                if self.database is not None:
+                    # The loop keeps serving the other calls while the
+                    # summary is written
+                    await run_in_database_thread(
+                        self.database.save_to_database,
+                        self.make_database_key(node.key), summary)
+                await finish(node, summary)
+
+        self.levels = levels[:top + 1]
+        self.depth = top
+        self.nb_calls = len(stream_nodes)
+        self.seconds = time.perf_counter() - start_time
+        logging.info(f"Summary tree of depth {self.depth} built with "
+                     f"{self.nb_calls} calls in {self.seconds:.1f} seconds")
+        return [node.text for node in self.levels[top]]
+
+    def stats(self):
+        """Returns statistics about the last tree that was built.
+        Returns:
+            dict: The depth of the tree, the number of nodes per level, the
+            average and largest number of children of a node, the number of
+            calls and of cached nodes, the latency of the longest chain of
+            calls from a leaf to the top and the total time in seconds.
+        """
+        parents = [node for level in self.levels[1:] for node in level]
+        fan_ins = [len(node.children) for node in parents]
+        critical_path = 0.0
+        if self.depth > 0:
+            critical_path = max(node.critical_path
+                                for node in self.levels[self.depth - 1])
+        return {"depth": self.depth,
+                "nodes_per_level": [len(level) for level in self.levels],
+                "fan_in": sum(fan_ins) / len(fan_ins) if fan_ins else 0.0,
+                "max_fan_in": max(fan_ins, default=0),
+                "nb_calls": self.nb_calls,
+                "nb_cached": sum(node.cached for level in self.levels
+                                 for node in level),
+                "critical_path_seconds": critical_path,
+                "seconds": self.seconds}
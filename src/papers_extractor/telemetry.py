@@ -0,0 +1,236 @@
+# This file contains the telemetry of the calls to the OpenAI API. Each
+# attempt and each request is recorded as a structured event and sent to the
+# metrics sinks registered in the process. An in-memory sink aggregates the
+# latencies and throughput per model and another one exports the events as
+# JSON lines. This is used to size max_concurrent_calls and to spot tail
+# latency in production runs.
+import json
+import logging
+import math
+import threading
+import time
+
+# Events are sent to every registered sink. Nothing is recorded when there
+# is no sink.
+_sinks = []
+_sinks_lock = threading.Lock()
+
+
+def add_metrics_sink(sink):
+    """Registers a sink that receives all the events of the process.
+    Args:
+        sink (object): An object with a record(event) method, like
+        InMemoryMetrics or JsonLinesExporter.
+    Returns:
+        object: The sink, so it can be created and registered at once.
+    """
+    with _sinks_lock:
+        _sinks.append(sink)
+    return sink
+
+
+def remove_metrics_sink(sink):
+    """Unregisters a sink.
+    Args:
+        sink (object): The sink to remove.
+    Returns:
+        None
+    """
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+def telemetry_enabled():
+    """Checks if any sink is registered."""
+    return bool(_sinks)
+
+
+def emit_event(event):
+    """Sends an event to all the registered sinks. A failing sink does not
+    stop the calls to the API.
+    Args:
+        event (dict): The event. It must have an 'event' key, 'attempt' or
+        'request', and a 'model' key.
+    Returns:
+        None
+    """
+    if not _sinks:
+        return
+    event.setdefault("timestamp", time.time())
+    for sink in list(_sinks):
+        try:
+            sink.record(event)
+        except Exception as e:
+            logging.warning(f"Metrics sink {sink} failed: {e}")
+
+
+def percentile(sorted_values, fraction):
+    """Returns a percentile of sorted values with linear interpolation.
+    Args:
+        sorted_values (list): The values, sorted.
+        fraction (float): The percentile between 0 and 1.
+    Returns:
+        float: The percentile or None if there is no value.
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] -
+                                   sorted_values[lower]) * (position - lower)
+
+
+class InMemoryMetrics:
+    """This class aggregates the events in memory per model. It keeps the
+    latencies of the last max_samples attempts and requests of each model.
+    """
+
+    def __init__(self, max_samples=100000):
+        """Initializes the aggregation.
+        Args:
+            max_samples (int): The number of latencies kept per model.
+            Defaults to 100000.
+        Returns:
+            None
+        """
+        self.max_samples = max_samples
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _new_model_stats(self):
+        return {"attempt_latencies": [], "request_latencies": [],
+                "queue_waits": [], "nb_requests": 0, "nb_attempts": 0,
+                "statuses": {}, "retry_reasons": {}, "tokens_in": 0,
+                "tokens_out": 0, "nb_hedged": 0, "nb_hedge_wins": 0,
+                "first_start": None, "last_end": None}
+
+    def _append_sample(self, samples, value):
+        if value is None:
+            return
+        samples.append(value)
+        if len(samples) > self.max_samples:
+            del samples[:len(samples) - self.max_samples]
+
+    def record(self, event):
+        """Adds an event to the aggregation.
+        Args:
+            event (dict): The event.
+        Returns:
+            None
+        """
+        with self._lock:
+            stats = self._models.setdefault(event["model"],
+                                            self._new_model_stats())
+            if event["event"] == "attempt":
+                stats["nb_attempts"] += 1
+                self._append_sample(stats["attempt_latencies"],
+                                    event.get("latency"))
+                reason = event.get("retry_reason")
+                if reason is not None:
+                    stats["retry_reasons"][reason] = \
+                        stats["retry_reasons"].get(reason, 0) + 1
+            elif event["event"] == "request":
+                stats["nb_requests"] += 1
+                status = event.get("status")
+                stats["statuses"][status] = \
+                    stats["statuses"].get(status, 0) + 1
+                self._append_sample(stats["request_latencies"],
+                                    event.get("latency"))
+                self._append_sample(stats["queue_waits"],
+                                    event.get("queue_wait"))
+                stats["tokens_in"] += event.get("tokens_in") or 0
+                stats["tokens_out"] += event.get("tokens_out") or 0
+                if event.get("hedged"):
+                    stats["nb_hedged"] += 1
+                if event.get("hedge_won"):
+                    stats["nb_hedge_wins"] += 1
+                end_time = event["timestamp"]
+                start_time = end_time - (event.get("latency") or 0)
+                if stats["first_start"] is None or \
+                        start_time < stats["first_start"]:
+                    stats["first_start"] = start_time
+                if stats["last_end"] is None or end_time > stats["last_end"]:
+                    stats["last_end"] = end_time
+
+    def summary(self):
+        """Returns the aggregated metrics of each model.
+        Returns:
+            dict: For each model, the number of requests and attempts, the
+            p50, p95 and p99 latencies of attempts and requests in seconds,
+            the p95 queue wait, the count of each final status and retry
+            reason, the number of hedged requests and of hedges that won
+            and the number of tokens per second.
+        """
+        with self._lock:
+            summaries = {}
+            for model, stats in self._models.items():
+                attempt_latencies = sorted(stats["attempt_latencies"])
+                request_latencies = sorted(stats["request_latencies"])
+                queue_waits = sorted(stats["queue_waits"])
+                duration = None
+                if stats["first_start"] is not None:
+                    duration = stats["last_end"] - stats["first_start"]
+                total_tokens = stats["tokens_in"] + stats["tokens_out"]
+                summaries[model] = {
+                    "nb_requests": stats["nb_requests"],
+                    "nb_attempts": stats["nb_attempts"],
+                    "statuses": dict(stats["statuses"]),
+                    "retry_reasons": dict(stats["retry_reasons"]),
+                    "attempt_latency_p50": percentile(attempt_latencies, 0.5),
+                    "attempt_latency_p95": percentile(attempt_latencies,
+                                                      0.95),
+                    "attempt_latency_p99": percentile(attempt_latencies,
+                                                      0.99),
+                    "request_latency_p50": percentile(request_latencies, 0.5),
+                    "request_latency_p95": percentile(request_latencies,
+                                                      0.95),
+                    "request_latency_p99": percentile(request_latencies,
+                                                      0.99),
+                    "queue_wait_p95": percentile(queue_waits, 0.95),
+                    "tokens_in": stats["tokens_in"],
+                    "tokens_out": stats["tokens_out"],
+                    "nb_hedged": stats["nb_hedged"],
+                    "nb_hedge_wins": stats["nb_hedge_wins"],
+                    "tokens_per_second": (total_tokens / duration
+                                          if duration else None),
+                }
+            return summaries
+
+    def reset(self):
+        """Removes all the aggregated events."""
+        with self._lock:
+            self._models.clear()
+
+
+class JsonLinesExporter:
+    """This class writes each event as a line of JSON in a file."""
+
+    def __init__(self, path):
+        """Initializes the exporter. Events are appended to the file.
+        Args:
+            path (str): The path of the file.
+        Returns:
+            None
+        """
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        """Writes an event to the file.
+        Args:
+            event (dict): The event.
+        Returns:
+            None
+        """
+        line = json.dumps(event)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        """Closes the file."""
+        with self._lock:
+            self._file.close()
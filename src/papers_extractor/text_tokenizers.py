@@ -0,0 +1,296 @@
+# This file contains the word tokenizers used to cut long texts in chunks.
+# The default backend is a pure-regex word and sentence splitter that loads
+# nothing at import. nltk is kept as an optional backend that is only
+# imported, and its punkt model downloaded, when it is first used.
+import logging
+import re
+
+# These words are followed by a period that does not end a sentence.
+ABBREVIATIONS = frozenset({
+    "al", "approx", "ca", "cf", "dept", "dr", "e.g", "eq", "eqs", "etc",
+    "fig", "figs", "i.e", "inc", "jr", "ltd", "mr", "mrs", "prof", "ref",
+    "refs", "sr", "st", "suppl", "vol", "vs",
+})
+
+# Candidate sentence ends: terminal punctuation, closing quotes or brackets
+# and the white spaces up to the next sentence.
+_SENTENCE_END = re.compile(
+    r"[.!?]+[\"'\u00bb\u201d\u2019)\]}>]*\s+(?=\S)")
+
+# Characters that are never part of a word token.
+_DELIMITERS = (r"\s\[\](){}<>;@#$%&?!*:,.`\"\u00ab\u201c\u2018\u201e"
+               r"\u00bb\u201d\u2019\u2012-\u2015\-")
+
+# Tokens are matched from left to right, the first alternative wins.
+_WORD_TOKEN = re.compile(
+    r"\.{2,}"                                   # ellipsis
+    r"|--"                                      # double dashes
+    r"|``|''|`+"                                # latex-style quotes
+    r"|[\"\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019]"  # other quotes
+    r"|[\u2012-\u2015]"                          # long dashes
+    r"|[\[\](){}<>;@#$%&?!*]"                   # always their own token
+    r"|[:,](?!\d)"                              # except inside numbers
+    r"|(?:[^" + _DELIMITERS + r"]|[:,](?=\d)|\.(?!\.)|-(?!-))+"
+)
+
+# Clitics that are split from the word they are attached to.
+_CLITIC = re.compile(r"(?i)(?<=[^' ])(?:n't|'ll|'re|'ve|'s|'m|'d|')$")
+_LEADING_QUOTE = re.compile(r"(?i)'(?!(?:re|ve|ll|m|t|s|d|n)$)(?=\w)")
+_SPLIT_WORDS = {"cannot": 3, "gimme": 3, "gonna": 3, "gotta": 3,
+                "lemme": 3, "wanna": 3}
+_CLOSING = frozenset({"''", "'", ")", "]", "}", ">",
+                      "\u00bb", "\u201d", "\u2019"})
+
+
+def _is_sentence_end(text, end_match):
+    """Checks if a candidate sentence end is a true sentence boundary."""
+    punctuation = end_match.group(0).rstrip()
+    next_char = text[end_match.end()]
+    if "!" in punctuation or "?" in punctuation:
+        return True
+    if punctuation.startswith(".."):
+        return not next_char.islower()
+    # The word right before the period
+    word_start = text.rfind(" ", 0, end_match.start()) + 1
+    word = text[word_start:end_match.start()].lstrip("([{\"'").lower()
+    if word in ABBREVIATIONS:
+        return False
+    # Initials like J. Smith
+    if len(word) == 1 and word.isalpha():
+        return False
+    return not next_char.islower()
+
+
+class RegexTokenizer:
+    """A word and sentence tokenizer built on regular expressions. It follows
+    the rules of the nltk word tokenizer closely enough to be used in its
+    place and records the character offsets of each token.
+    """
+
+    name = "regex"
+
+    def split_sentences(self, text):
+        """Splits a text in sentences.
+        Args:
+            text (str): The text to split.
+        Returns:
+            list: The (start, end) character offsets of each sentence.
+        """
+        spans = []
+        start = 0
+        for end_match in _SENTENCE_END.finditer(text):
+            if _is_sentence_end(text, end_match):
+                end = end_match.start() + len(end_match.group(0).rstrip())
+                spans.append((start, end))
+                start = end_match.end()
+        if start < len(text.rstrip()) or not spans:
+            spans.append((start, len(text.rstrip())))
+        return spans
+
+    def tokenize_with_spans(self, text):
+        """Tokenizes a text and records where each token is.
+        Args:
+            text (str): The text to tokenize.
+        Returns:
+            tuple: A list of tokens and a list of their (start, end) character
+            offsets in the text.
+        """
+        tokens = []
+        spans = []
+        for sentence_start, sentence_end in self.split_sentences(text):
+            sentence_tokens = []
+            for match in _WORD_TOKEN.finditer(text, sentence_start,
+                                              sentence_end):
+                if match.start() > sentence_start:
+                    previous_char = text[match.start() - 1]
+                else:
+                    previous_char = " "
+                sentence_tokens.extend(
+                    self._split_token(match.group(0), match.start(),
+                                      previous_char))
+            self._split_final_period(sentence_tokens)
+            for token, start, end in sentence_tokens:
+                tokens.append(token)
+                spans.append((start, end))
+        return tokens, spans
+
+    def tokenize(self, text):
+        """Tokenizes a text.
+        Args:
+            text (str): The text to tokenize.
+        Returns:
+            list: A list of tokens.
+        """
+        return self.tokenize_with_spans(text)[0]
+
+    @staticmethod
+    def _split_token(token, start, previous_char):
+        """Splits clitics and quotes from a matched token."""
+        end = start + len(token)
+        if token == '"':
+            # Like nltk, double quotes become `` when they open and ''
+            # when they close.
+            if previous_char.isspace() or previous_char in "([{<":
+                return [("``", start, end)]
+            return [("''", start, end)]
+
+        pieces = []
+        if _LEADING_QUOTE.match(token):
+            pieces.append(("'", start, start + 1))
+            token = token[1:]
+            start += 1
+
+        split_length = _SPLIT_WORDS.get(token.lower())
+        clitic = _CLITIC.search(token)
+        if split_length is not None:
+            pieces.append((token[:split_length], start, start + split_length))
+            pieces.append((token[split_length:], start + split_length, end))
+        elif clitic is not None and clitic.start() > 0:
+            split_idx = start + clitic.start()
+            pieces.append((token[:clitic.start()], start, split_idx))
+            pieces.append((clitic.group(0), split_idx, end))
+        else:
+            pieces.append((token, start, end))
+        return pieces
+
+    @staticmethod
+    def _split_final_period(sentence_tokens):
+        """Splits the period that ends a sentence from its last word."""
+        idx = len(sentence_tokens) - 1
+        while idx >= 0 and sentence_tokens[idx][0] in _CLOSING:
+            idx -= 1
+        if idx < 0:
+            return
+        token, start, end = sentence_tokens[idx]
+        if len(token) > 1 and token.endswith(".") and token[-2] != ".":
+            sentence_tokens[idx:idx + 1] = [(token[:-1], start, end - 1),
+                                            (".", end - 1, end)]
+
+
+class NltkTokenizer:
+    """A word tokenizer that uses nltk. nltk is only imported, and the punkt
+    model downloaded if needed, the first time a text is tokenized.
+    """
+
+    name = "nltk"
+
+    def __init__(self):
+        self._word_tokenize = None
+
+    def _load(self):
+        if self._word_tokenize is None:
+            import nltk
+            from nltk.tokenize import word_tokenize
+
+            try:
+                word_tokenize("Loading the punkt model.")
+            except LookupError:
+                # Recent versions of nltk use punkt_tab instead of punkt
+                logging.info("Downloading the nltk punkt model")
+                for resource in ("punkt", "punkt_tab"):
+                    nltk.download(resource, quiet=True)
+            self._word_tokenize = word_tokenize
+        return self._word_tokenize
+
+    def tokenize(self, text):
+        """Tokenizes a text.
+        Args:
+            text (str): The text to tokenize.
+        Returns:
+            list: A list of tokens.
+        """
+        return self._load()(text)
+
+    def tokenize_with_spans(self, text):
+        """Tokenizes a text and records where each token is. nltk rewrites
+        some tokens so they are aligned back on the text.
+        Args:
+            text (str): The text to tokenize.
+        Returns:
+            tuple: A list of tokens and a list of their (start, end) character
+            offsets in the text.
+        """
+        tokens = self.tokenize(text)
+        spans = []
+        position = 0
+        for token in tokens:
+            span = find_token_span(text, token, position, len(text))
+            spans.append(span)
+            position = span[1]
+        return tokens, spans
+
+
+def find_token_span(text, token, position, end):
+    """Finds where a token produced by a tokenizer is in the text.
+    Args:
+        text (str): The text that was tokenized.
+        token (str): The token to find.
+        position (int): The offset where the search starts.
+        end (int): The offset where the search ends.
+    Returns:
+        tuple: The (start, end) offsets of the token in the text.
+    """
+    # nltk converts double quotes to `` and '' so we look for both.
+    candidates = [token]
+    if token in ("``", "''"):
+        candidates.append('"')
+
+    best_span = None
+    for candidate in candidates:
+        start = text.find(candidate, position, end)
+        if start >= 0 and (best_span is None or start < best_span[0]):
+            best_span = (start, start + len(candidate))
+
+    # A token that was rewritten by the tokenizer gets an empty span
+    if best_span is None:
+        best_span = (position, position)
+    return best_span
+
+
+# Backends are created on first use and shared.
+_backend_classes = {"regex": RegexTokenizer, "nltk": NltkTokenizer}
+_backends = {}
+_default_backend = "regex"
+
+
+def register_tokenizer_backend(name, backend_class):
+    """Registers a new tokenizer backend. The class must provide tokenize and
+    tokenize_with_spans methods like RegexTokenizer.
+    Args:
+        name (str): The name of the backend.
+        backend_class (type): The class of the backend.
+    Returns:
+        None
+    """
+    _backend_classes[name] = backend_class
+    _backends.pop(name, None)
+
+
+def set_default_tokenizer_backend(name):
+    """Sets the tokenizer backend used when none is requested.
+    Args:
+        name (str): The name of the backend, 'regex' or 'nltk'.
+    Returns:
+        None
+    """
+    global _default_backend
+    if name not in _backend_classes:
+        raise ValueError(f"Unknown tokenizer backend {name}")
+    _default_backend = name
+
+
+def get_tokenizer_backend(name=None):
+    """Returns a tokenizer backend.
+    Args:
+        name (str): The name of the backend. If None, the default backend is
+        returned. Defaults to None.
+    Returns:
+        object: The tokenizer backend.
+    """
+    if name is None:
+        name = _default_backend
+    if name not in _backends:
+        if name not in _backend_classes:
+            raise ValueError(f"Unknown tokenizer backend {name}")
+        _backends[name] = _backend_classes[name]()
+    return _backends[name]
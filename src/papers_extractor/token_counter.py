@@ -0,0 +1,234 @@
+# This file contains a process-wide service to count tokens with tiktoken.
+# Building a tiktoken encoder is expensive so encoders are created once per
+# model and shared. Token counts of texts that were already seen are kept in a
+# bounded cache so repeated prompts are not encoded again. Coroutines count
+# tokens in a thread pool so encoding long texts does not block the event
+# loop.
+import asyncio
+import functools
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+
+# This is the model used throughout the package to count tokens.
+DEFAULT_TOKEN_MODEL = "gpt-3.5-turbo-0301"
+
+# The number of threads that count tokens for coroutines. tiktoken releases
+# the GIL while it encodes so the counts run in parallel with the loop.
+COUNTING_THREADS = 4
+
+# Encoders, counters and the thread pool are shared by every object of the
+# process.
+_encoders = {}
+_counters = {}
+_executor = None
+_registry_lock = threading.Lock()
+
+
+def get_encoder(model=DEFAULT_TOKEN_MODEL):
+    """Returns the tiktoken encoder of a model. The encoder is only built
+    once per process.
+    Args:
+        model (str): The model to get the encoder for.
+    Returns:
+        tiktoken.Encoding: The encoder of the model.
+    """
+    encoder = _encoders.get(model)
+    if encoder is None:
+        with _registry_lock:
+            encoder = _encoders.get(model)
+            if encoder is None:
+                logging.debug(f"Loading tiktoken encoder for {model}")
+                encoder = tiktoken.encoding_for_model(model)
+                _encoders[model] = encoder
+    return encoder
+
+
+def get_token_counter(model=DEFAULT_TOKEN_MODEL):
+    """Returns the shared TokenCounter of a model.
+    Args:
+        model (str): The model to count tokens for.
+    Returns:
+        TokenCounter: The token counter of the model.
+    """
+    counter = _counters.get(model)
+    if counter is None:
+        with _registry_lock:
+            counter = _counters.get(model)
+            if counter is None:
+                counter = TokenCounter(model)
+                _counters[model] = counter
+    return counter
+
+
+def count_tokens_batch(texts, model=DEFAULT_TOKEN_MODEL):
+    """Counts the number of tokens of each text in a list.
+    Args:
+        texts (list): A list of texts.
+        model (str): The model to use.
+    Returns:
+        list: The number of tokens of each text.
+    """
+    return get_token_counter(model).count_batch(texts)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _registry_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=COUNTING_THREADS,
+                    thread_name_prefix="token_counter")
+    return _executor
+
+
+async def run_in_counting_thread(function, *args, **kwargs):
+    """Runs a function that counts or tokenizes text in the thread pool of
+    the counters, so the event loop is not blocked while it runs.
+    Args:
+        function (callable): The function to run.
+        *args: The arguments of the function.
+        **kwargs: The keyword arguments of the function.
+    Returns:
+        object: What the function returns.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(function, *args, **kwargs))
+
+
+async def async_count_tokens_batch(texts, model=DEFAULT_TOKEN_MODEL):
+    """Counts the number of tokens of each text in a list in a thread pool,
+    so the event loop keeps serving other requests in the meantime.
+    Args:
+        texts (list): A list of texts.
+        model (str): The model to use.
+    Returns:
+        list: The number of tokens of each text.
+    """
+    return await run_in_counting_thread(
+        get_token_counter(model).count_batch, texts)
+
+
+class TokenCounter:
+    """This class counts tokens for a given model. It keeps a bounded LRU
+    cache of counts keyed by the hash of the texts and uses the
+    multi-threaded batch encoder of tiktoken for lists of texts.
+    """
+
+    def __init__(self, model=DEFAULT_TOKEN_MODEL, cache_size=4096,
+                 num_threads=8):
+        """Initializes the counter.
+        Args:
+            model (str): The model to count tokens for.
+            cache_size (int): The maximum number of counts kept in the cache.
+            Set to 0 to disable the cache. Defaults to 4096.
+            num_threads (int): The number of threads used by tiktoken to
+            encode batches of texts. Defaults to 8.
+        Returns:
+            None
+        """
+        self.model = model
+        self.cache_size = cache_size
+        self.num_threads = num_threads
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def encoder(self):
+        """The shared tiktoken encoder of the model."""
+        return get_encoder(self.model)
+
+    @staticmethod
+    def _hash_text(text):
+        # Texts can be very long so we only keep a digest in the cache.
+        return hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest()
+
+    def _get_cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            return None
+
+    def _set_cached(self, key, value):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count(self, text):
+        """Counts the number of tokens in a text.
+        Args:
+            text (str): The text to count.
+        Returns:
+            int: The number of tokens.
+        """
+        key = self._hash_text(text)
+        num_tokens = self._get_cached(key)
+        if num_tokens is None:
+            num_tokens = len(self.encoder.encode_ordinary(text))
+            self._set_cached(key, num_tokens)
+        return num_tokens
+
+    def count_batch(self, texts):
+        """Counts the number of tokens of each text in a list. Texts that are
+        not in the cache are encoded together in multiple threads.
+        Args:
+            texts (list): A list of texts.
+        Returns:
+            list: The number of tokens of each text.
+        """
+        keys = [self._hash_text(text) for text in texts]
+        counts = [self._get_cached(key) for key in keys]
+
+        # We only encode each missing text once, even if it is repeated.
+        missing = {}
+        for index, num_tokens in enumerate(counts):
+            if num_tokens is None:
+                missing.setdefault(keys[index], index)
+
+        if len(missing) == 1:
+            index = next(iter(missing.values()))
+            encoded_lengths = [len(self.encoder.encode_ordinary(texts[index]))]
+        elif missing:
+            encoded = self.encoder.encode_ordinary_batch(
+                [texts[index] for index in missing.values()],
+                num_threads=self.num_threads)
+            encoded_lengths = [len(tokens) for tokens in encoded]
+        else:
+            encoded_lengths = []
+
+        new_counts = dict(zip(missing.keys(), encoded_lengths))
+        for key, num_tokens in new_counts.items():
+            self._set_cached(key, num_tokens)
+
+        return [num_tokens if num_tokens is not None else new_counts[key]
+                for key, num_tokens in zip(keys, counts)]
+
+    def cache_info(self):
+        """Returns statistics about the cache.
+        Returns:
+            dict: The number of hits, misses and cached entries.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._cache), "max_size": self.cache_size}
+
+    def clear_cache(self):
+        """Empties the cache and resets its statistics."""
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
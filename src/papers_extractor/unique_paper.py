@@ -446,17 +446,14 @@ publication identifier.".format(identifier))
         local_embedding = self.calculate_embedding(field=field)
         return np.mean(local_embedding, axis=0)
 
-    def calculate_embedding(self, parser="ada2", field="abstract"):
-        """This function extracts semantic embeddings in chunks
-        from the long text.
+    def get_field_text(self, field="abstract"):
+        """This function returns the text of a field to extract embeddings
+        from.
         Args:
-            parser (str): The parser to use to extract the embeddings.
-            Defaults to ada2.
-            field (str): The field to extract the embeddings from. Can be
-            'abstract', 'title', 'fulltext', 'longsummary'. Defaults to
-            'abstract'.
+            field (str): The field to get. Can be 'abstract', 'title',
+            'fulltext', 'longsummary'. Defaults to 'abstract'.
         Returns:
-            embedding (list): The list of embeddings for each chunk.
+            str: The text of the field.
         """
         if field == "abstract":
             local_text = self.get_abstract()
@@ -472,6 +469,21 @@ publication identifier.".format(identifier))
         if local_text is None:
             raise ValueError(f"The field {field} is not available for this \
 paper.")
+        return local_text
+
+    def calculate_embedding(self, parser="ada2", field="abstract"):
+        """This function extracts semantic embeddings in chunks
+        from the long text.
+        Args:
+            parser (str): The parser to use to extract the embeddings.
+            Defaults to ada2.
+            field (str): The field to extract the embeddings from. Can be
+            'abstract', 'title', 'fulltext', 'longsummary'. Defaults to
+            'abstract'.
+        Returns:
+            embedding (list): The list of embeddings for each chunk.
+        """
+        local_text = self.get_field_text(field)
 
         # We check if the embedding of that field is already available
         local_embedding = getattr(self, f"{field}_embedding")
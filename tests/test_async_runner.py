@@ -0,0 +1,106 @@
+from papers_extractor.async_runner import AsyncRunner, get_async_runner, \
+    shutdown_async_runner
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser
+import asyncio
+import logging
+import openai
+import pytest
+import sys
+
+
+async def get_loop_and_session():
+    return asyncio.get_running_loop(), openai.aiosession.get()
+
+
+def test_runner_reuses_loop_and_session():
+    runner = AsyncRunner()
+    first_loop, first_session = runner.run(get_loop_and_session())
+    second_loop, second_session = runner.run(get_loop_and_session())
+    assert first_loop is second_loop
+    assert first_session is not None
+    assert first_session is second_session
+    # The session is only set in the coroutines of the runner
+    assert openai.aiosession.get() is None
+    runner.shutdown()
+    assert first_session.closed
+    assert not runner.is_running
+
+
+def test_runner_from_other_loop():
+    runner = AsyncRunner()
+
+    async def call_from_other_loop():
+        runner_loop, _ = await runner.run_async(get_loop_and_session())
+        return runner_loop is not asyncio.get_running_loop()
+
+    assert asyncio.run(call_from_other_loop())
+    runner.shutdown()
+
+
+def test_runner_refuses_nested_run():
+    runner = AsyncRunner()
+
+    async def nested_run():
+        runner.run(get_loop_and_session())
+
+    with pytest.raises(RuntimeError):
+        runner.run(nested_run())
+    runner.shutdown()
+
+
+def test_runner_shutdown_cancels_pending_calls():
+    runner = AsyncRunner()
+    future = runner.submit(asyncio.sleep(60))
+    runner.shutdown()
+    assert future.cancelled()
+    assert not runner.is_running
+
+
+def test_nested_calls_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    results = {}
+
+    def result_callback(index, content):
+        # The callback makes its own blocking call to the API
+        results[index] = openai_long_parser.multi_call_chatGPT(
+            [f"Repeat:\n\n{content} again."], temperature=0)[0]
+
+    async def nested_call():
+        openai_long_parser.multi_call_chatGPT(["Repeat:\n\nHello World."])
+
+    with MockOpenaiServer():
+        nb_results = openai_long_parser.stream_call_chatGPT(
+            ["Repeat:\n\nHello World.", "Repeat:\n\nGoodbye World."],
+            result_callback, temperature=0)
+        # A blocking call from the loop of the runner is refused
+        with pytest.raises(RuntimeError, match="async_call_chatGPT"):
+            get_async_runner().run(nested_call())
+    assert nb_results == 2
+    assert results == {0: "Hello", 1: "Goodbye"}
+
+
+def test_shared_runner_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    with MockOpenaiServer() as server:
+        for _ in range(3):
+            openai_long_parser.multi_call_chatGPT(
+                ["Repeat:\n\nHello World."], temperature=0)
+        # Async callers go through the same runner
+        results = asyncio.run(openai_long_parser.async_call_chatGPT(
+            ["Repeat:\n\nHello World."], 0, 0, 0))
+    assert results == ["Hello"]
+    assert server.nb_requests == 4
+    assert get_async_runner().is_running
+    shutdown_async_runner()
+    assert not get_async_runner().is_running
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_runner_reuses_loop_and_session()
+    test_runner_from_other_loop()
+    test_runner_refuses_nested_run()
+    test_runner_shutdown_cancels_pending_calls()
+    test_nested_calls_mock()
+    test_shared_runner_mock()
@@ -0,0 +1,80 @@
+from papers_extractor.chunk_checkpoint import ChunkCheckpoint
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser
+from papers_extractor.pdf_parser import PdfParser
+import logging
+import pytest
+import sys
+
+
+def test_checkpoint_save_and_clear():
+    local_database = LocalDatabase()
+    checkpoint = ChunkCheckpoint(local_database, "job")
+    other_checkpoint = ChunkCheckpoint(local_database, "other_job")
+    assert checkpoint.get("Hello") is None
+    checkpoint.save("Hello", "World")
+    other_checkpoint.save("Hello", "Other World")
+    assert checkpoint.get("Hello") == "World"
+    assert other_checkpoint.get("Hello") == "Other World"
+
+    checkpoint.clear()
+    assert checkpoint.get("Hello") is None
+    assert other_checkpoint.get("Hello") == "Other World"
+
+
+def test_partial_results_and_resume_mock():
+    checkpoint = ChunkCheckpoint(LocalDatabase(), "job")
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          checkpoint=checkpoint)
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(20)]
+
+    # Some responses are truncated, which fails their prompt
+    with MockOpenaiServer(length_rate=0.3, seed=0):
+        results, errors = openai_long_parser.multi_call_chatGPT(
+            prompts, temperature=0, on_error="partial")
+    assert 0 < len(errors) < len(prompts)
+    assert all(results[index] is None for index in errors)
+    assert all(result == "Hello" for index, result in enumerate(results)
+               if index not in errors)
+    assert len(checkpoint.get_saved_keys()) == len(prompts) - len(errors)
+
+    # Only the failed prompts are sent again
+    with MockOpenaiServer() as server:
+        results = openai_long_parser.multi_call_chatGPT(prompts,
+                                                        temperature=0)
+    assert server.nb_requests == len(errors)
+    assert results == ["Hello"] * len(prompts)
+
+
+def test_raise_policy_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    with MockOpenaiServer(length_rate=1.0):
+        with pytest.raises(Exception, match="didn't reach"):
+            openai_long_parser.multi_call_chatGPT(
+                ["Repeat:\n\nHello World."], temperature=0)
+        with pytest.raises(ValueError):
+            openai_long_parser.multi_call_chatGPT(
+                ["Repeat:\n\nHello World."], temperature=0, on_error="skip")
+
+
+def test_pdf_cleanup_checkpoint_mock():
+    # The raw text is saved in the database so no PDF file is needed
+    local_database = LocalDatabase()
+    local_database.save_to_database(
+        "example_pdf", {"raw_text": "Hello World. " * 1000})
+    pdf_parser = PdfParser("example.pdf", local_database=local_database,
+                           database_id="example_pdf")
+    with MockOpenaiServer():
+        cleaned_text = pdf_parser.get_clean_text(chunk_size=400)
+    assert cleaned_text
+    # The checkpoint is not needed once the cleaned text is saved
+    assert pdf_parser.get_cleanup_checkpoint().get_saved_keys() == []
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_checkpoint_save_and_clear()
+    test_partial_results_and_resume_mock()
+    test_raise_policy_mock()
+    test_pdf_cleanup_checkpoint_mock()
@@ -0,0 +1,116 @@
+from papers_extractor.completion_cache import CompletionCache, \
+    get_completion_cache, CACHE_LOG_SIZE_KEY
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL
+import logging
+import sys
+import tempfile
+
+
+def test_cache_hits_and_misses():
+    cache = CompletionCache()
+    assert cache.get(CHAT_MODEL, "Hello") is None
+    cache.set(CHAT_MODEL, "Hello", "World")
+    assert cache.get(CHAT_MODEL, "Hello", temperature=0.0) == "World"
+    # Other parameters give another key
+    assert cache.get(CHAT_MODEL, "Hello", presence_penalty=-0.5) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_cache_temperature_policy():
+    cache = CompletionCache()
+    cache.set(CHAT_MODEL, "Hello", "World", temperature=0.7)
+    assert cache.stats()["size"] == 0
+    assert cache.get(CHAT_MODEL, "Hello", temperature=0.7) is None
+
+    cache = CompletionCache(cache_all_temperatures=True)
+    cache.set(CHAT_MODEL, "Hello", "World", temperature=0.7)
+    assert cache.get(CHAT_MODEL, "Hello", temperature=0.7) == "World"
+
+
+def test_cache_eviction():
+    cache = CompletionCache(max_entries=2)
+    cache.set(CHAT_MODEL, "first", "1")
+    cache.set(CHAT_MODEL, "second", "2")
+    # The first prompt becomes the most recently used
+    assert cache.get(CHAT_MODEL, "first") == "1"
+    cache.set(CHAT_MODEL, "third", "3")
+    assert cache.stats()["size"] == 2
+    assert cache.get(CHAT_MODEL, "second") is None
+    assert cache.get(CHAT_MODEL, "first") == "1"
+    assert cache.get(CHAT_MODEL, "third") == "3"
+
+
+def test_cache_log_compaction():
+    local_database = LocalDatabase()
+    cache = CompletionCache(local_database, max_entries=3)
+    cache.set(CHAT_MODEL, "first", "1")
+    cache.set(CHAT_MODEL, "second", "2")
+    cache.set(CHAT_MODEL, "third", "3")
+    # The many uses of the second prompt do not grow the log without bound
+    for _ in range(20):
+        assert cache.get(CHAT_MODEL, "second") == "2"
+    assert local_database.load_from_database(CACHE_LOG_SIZE_KEY) <= 6
+
+    # Eviction only reads the front of the log, not every key
+    local_database.get_list_keys = None
+    cache.set(CHAT_MODEL, "fourth", "4")
+    assert cache.stats()["size"] == 3
+    assert cache.get(CHAT_MODEL, "first") is None
+    assert cache.get(CHAT_MODEL, "third") == "3"
+    assert cache.get(CHAT_MODEL, "second") == "2"
+
+
+def test_cache_persistence():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = CompletionCache(LocalDatabase(database_path=tmpdir))
+        cache.set(CHAT_MODEL, "Hello", "World")
+        new_cache = CompletionCache(LocalDatabase(database_path=tmpdir))
+        assert new_cache.get(CHAT_MODEL, "Hello") == "World"
+        assert new_cache.stats()["size"] == 1
+
+
+def test_caches_sharing_a_database():
+    local_database = LocalDatabase()
+    first_cache = CompletionCache(local_database, max_entries=3)
+    second_cache = CompletionCache(local_database, max_entries=3)
+    first_cache.set(CHAT_MODEL, "first", "1")
+    second_cache.set(CHAT_MODEL, "second", "2")
+    # Each cache sees the completions saved by the other one
+    assert first_cache.get(CHAT_MODEL, "second") == "2"
+    assert second_cache.get(CHAT_MODEL, "first") == "1"
+    first_cache.set(CHAT_MODEL, "third", "3")
+    second_cache.set(CHAT_MODEL, "fourth", "4")
+    # The second prompt was used before the first one
+    assert second_cache.stats()["size"] == 3
+    assert first_cache.get(CHAT_MODEL, "second") is None
+    assert first_cache.get(CHAT_MODEL, "first") == "1"
+    assert get_completion_cache(local_database) is \
+        get_completion_cache(local_database)
+
+
+def test_parser_with_cache_mock():
+    cache = CompletionCache()
+    prompts = ["Say:\n\nHello World, I am a test.", "Say:\n\nGoodbye."]
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          completion_cache=cache)
+    with MockOpenaiServer() as server:
+        first = openai_long_parser.multi_call_chatGPT(prompts, temperature=0)
+        second = openai_long_parser.multi_call_chatGPT(prompts,
+                                                       temperature=0)
+    assert first == second
+    assert server.nb_requests == 2
+    assert cache.stats()["hits"] == 2
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_cache_hits_and_misses()
+    test_cache_temperature_policy()
+    test_cache_eviction()
+    test_cache_log_compaction()
+    test_cache_persistence()
+    test_caches_sharing_a_database()
+    test_parser_with_cache_mock()
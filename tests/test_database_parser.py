@@ -1,7 +1,10 @@
 from papers_extractor.long_text import LongText
-from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.database_parser import LocalDatabase, \
+    run_in_database_thread
+import asyncio
 import logging
 import sys
+import threading
 
 
 def test_database_start():
@@ -65,6 +68,21 @@ def test_list_keys():
     assert key in local_database.get_list_keys()
 
 
+def test_write_in_database_thread():
+    local_database = LocalDatabase()
+
+    def save(key, value):
+        local_database.save_to_database(key, value)
+        return threading.current_thread()
+
+    async def save_from_loop():
+        return await run_in_database_thread(save, "test_key", "value")
+
+    # The write does not run in the thread of the event loop
+    assert asyncio.run(save_from_loop()) is not threading.current_thread()
+    assert local_database.load_from_database("test_key") == "value"
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_database_start()
@@ -72,3 +90,4 @@ if __name__ == "__main__":
     test_class_loading_from_database()
     test_reset_key()
     test_list_keys()
+    test_write_in_database_thread()
@@ -0,0 +1,82 @@
+from papers_extractor.hedging import HedgingPolicy
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL
+from papers_extractor.request_scheduler import configure_scheduler
+from papers_extractor.telemetry import InMemoryMetrics, add_metrics_sink, \
+    remove_metrics_sink
+import itertools
+import logging
+import sys
+import time
+
+
+def test_hedge_delay_and_budget():
+    policy = HedgingPolicy(min_samples=10, min_delay=0.1,
+                           max_extra_fraction=0.1)
+    assert policy.get_hedge_delay() is None
+    for index in range(100):
+        policy.record_latency(index / 100)
+    assert abs(policy.get_hedge_delay() - 0.9405) < 1e-6
+
+    # 2 requests were counted so far, which is not enough for a hedge
+    assert not policy.try_hedge()
+    for _ in range(8):
+        policy.get_hedge_delay()
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    assert policy.stats()["nb_hedges"] == 1
+    assert policy.stats()["nb_skipped"] == 2
+
+
+def test_timeouts_raise_hedge_delay():
+    policy = HedgingPolicy(min_samples=10, min_delay=0.1)
+    for _ in range(10):
+        policy.record_latency(0.1)
+    assert policy.get_hedge_delay() == 0.1
+    # The requests that timed out count as at least the timeout
+    for _ in range(10):
+        policy.record_timeout(2.0)
+    assert policy.get_hedge_delay() == 2.0
+
+
+def test_hedged_requests_cut_tail_mock():
+    # One request out of 10 is stuck for 3 seconds
+    counter = itertools.count()
+
+    def latency():
+        return 3.0 if next(counter) % 10 == 9 else 0.01
+
+    policy = HedgingPolicy(min_samples=5, min_delay=0.05,
+                           max_extra_fraction=0.5)
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=1,
+                                          hedging_policy=policy)
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(30)]
+    metrics = add_metrics_sink(InMemoryMetrics())
+    scheduler = configure_scheduler()
+    start_time = time.perf_counter()
+    try:
+        with MockOpenaiServer(latency=latency):
+            results = openai_long_parser.multi_call_chatGPT(prompts,
+                                                            temperature=0)
+    finally:
+        remove_metrics_sink(metrics)
+    elapsed_time = time.perf_counter() - start_time
+
+    assert results == ["Hello"] * len(prompts)
+    assert policy.stats()["nb_hedge_wins"] >= 2
+    summary = metrics.summary()[CHAT_MODEL]
+    assert summary["nb_hedge_wins"] == policy.stats()["nb_hedge_wins"]
+    assert summary["nb_hedged"] == policy.stats()["nb_hedges"]
+    # The duplicates took their own slots of the scheduler
+    assert sum(scheduler.stats()["nb_admitted"].values()) == \
+        len(prompts) + policy.stats()["nb_hedges"]
+    # Without hedges the stuck requests alone would take 9 seconds
+    assert elapsed_time < 3
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_hedge_delay_and_budget()
+    test_timeouts_raise_hedge_delay()
+    test_hedged_requests_cut_tail_mock()
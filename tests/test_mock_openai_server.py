@@ -0,0 +1,69 @@
+from papers_extractor.mock_openai_server import MockOpenaiServer, \
+    lognormal_latency
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL
+from papers_extractor.rate_limiter import DEFAULT_RATE_LIMITS, \
+    configure_rate_limiter
+import asyncio
+import logging
+import pytest
+import statistics
+import sys
+import time
+
+
+def collect_results(parser, prompts, **kwargs):
+    async def collect():
+        return [result async for result in
+                parser.iter_chat_results(prompts, temperature=0, **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_lognormal_latency():
+    sampler = lognormal_latency(0.1, sigma=0.5, seed=1)
+    latencies = [sampler() for _ in range(2000)]
+    assert abs(statistics.median(latencies) - 0.1) < 0.01
+    assert max(latencies) > 0.3
+
+
+def test_injected_length():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    with MockOpenaiServer(length_rate=1.0) as server:
+        with pytest.raises(Exception, match="didn't reach"):
+            collect_results(openai_long_parser, ["Repeat:\n\nHello World."])
+    assert server.nb_truncated == 1
+
+
+def test_injected_timeout():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    start_time = time.perf_counter()
+    with MockOpenaiServer(timeout_rate=1.0) as server:
+        with pytest.raises(asyncio.TimeoutError):
+            collect_results(openai_long_parser, ["Repeat:\n\nHello World."],
+                            timeout=0.1, max_retries=1)
+    # The hanging requests do not block the shutdown of the server
+    assert time.perf_counter() - start_time < 5
+    assert server.nb_hung == 2
+
+
+def test_injected_throttling():
+    configure_rate_limiter(CHAT_MODEL, default_retry_after=0.05,
+                           **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(20)]
+    try:
+        with MockOpenaiServer(throttle_rate=0.3, injected_retry_after=0.01,
+                              seed=0) as server:
+            results = openai_long_parser.multi_call_chatGPT(prompts,
+                                                            temperature=0)
+    finally:
+        configure_rate_limiter(CHAT_MODEL, **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+    assert results == [f"Hello World {index}."[:5] for index in range(20)]
+    assert server.nb_throttled > 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_lognormal_latency()
+    test_injected_length()
+    test_injected_timeout()
+    test_injected_throttling()
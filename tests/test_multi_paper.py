@@ -1,5 +1,8 @@
 from papers_extractor.multi_paper import MultiPaper
 from papers_extractor.unique_paper import UniquePaper
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.mock_openai_server import MockOpenaiServer, \
+    make_mock_embedding
 import logging
 import sys
 import os
@@ -35,6 +38,54 @@ def test_multi_paper_embedding():
     assert len(multi_paper.papers_embedding[0][0]) == 1536
 
 
+def test_multi_paper_bulk_embedding_mock():
+    dois = ["10.1101/2020.03.03.972133", "10.1016/j.celrep.2023.112434",
+            "10.1038/s41586-020-2907-3"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_database = LocalDatabase(database_path=tmpdir)
+        papers = [UniquePaper(doi, local_database=local_database)
+                  for doi in dois]
+        for index, indiv_paper in enumerate(papers):
+            indiv_paper.set_abstract(f"This is the abstract number {index}.")
+        # The first paper already has its embedding
+        papers[0].abstract_embedding = [[0.0] * 1536]
+
+        multi_paper = MultiPaper(papers)
+        with MockOpenaiServer() as server:
+            multi_paper.get_embedding_all_papers()
+
+        # Both missing papers were embedded in a single request
+        assert server.nb_requests == 1
+        assert server.nb_embedded_inputs == 2
+        assert multi_paper.papers_embedding[0] == [[0.0] * 1536]
+        assert multi_paper.papers_embedding[2] == [
+            make_mock_embedding("This is the abstract number 2..")]
+
+        # The embeddings were saved to the database
+        reloaded_paper = UniquePaper(dois[2], local_database=local_database)
+        assert reloaded_paper.abstract_embedding == \
+            multi_paper.papers_embedding[2]
+
+
+def test_multi_paper_prompt_mock():
+    dois = ["10.1101/2020.03.03.972133", "10.1016/j.celrep.2023.112434"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_database = LocalDatabase(database_path=tmpdir)
+        papers = [UniquePaper(doi, local_database=local_database)
+                  for doi in dois]
+        for index, indiv_paper in enumerate(papers):
+            indiv_paper.set_abstract(f"This is the abstract number {index}.")
+
+        multi_paper = MultiPaper(papers)
+        with MockOpenaiServer() as server:
+            results = multi_paper.process_papers_through_prompt(
+                "Summarize:")
+
+    # Both abstracts were sent in a single request
+    assert server.nb_requests == 1
+    assert results == ["This is the"] * 2
+
+
 def test_multi_paper_plot():
     first_paper = UniquePaper("10.1101/2020.03.03.972133")
     second_paper = UniquePaper("10.1016/j.celrep.2023.112434")
@@ -55,4 +106,6 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_multi_paper_creation()
     test_multi_paper_embedding()
+    test_multi_paper_bulk_embedding_mock()
+    test_multi_paper_prompt_mock()
     test_multi_paper_plot()
@@ -1,6 +1,9 @@
 
 
-from papers_extractor.openai_parsers import OpenaiLongParser
+from papers_extractor.openai_parsers import OpenaiLongParser, \
+    embed_texts, pack_texts_in_batches
+from papers_extractor.mock_openai_server import MockOpenaiServer, \
+    make_mock_embedding
 import os
 import openai
 import logging
@@ -31,7 +34,40 @@ def test_api_chunk_embedding_call():
     assert len(response) == 2
 
 
+def test_pack_texts_in_batches():
+    batches = pack_texts_in_batches([5, 5, 5, 20, 1, 1, 1],
+                                    max_tokens=10, max_inputs=2)
+    assert batches == [[0, 1], [2], [3], [4, 5], [6]]
+
+
+def test_batched_chunk_embedding_mock():
+    test_str = 'Hello World. ' * 200
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=30,
+                                          max_concurrent_calls=4)
+    with MockOpenaiServer(latency=0.01) as server:
+        embeddings, chunks = \
+            openai_long_parser.process_chunks_through_embedding()
+    assert len(embeddings) == len(chunks) == openai_long_parser.num_chunks
+    # All the chunks fit in a single request
+    assert server.nb_requests == 1
+    for embedding, chunk in zip(embeddings, chunks):
+        assert embedding == make_mock_embedding(chunk + ".")
+
+
+def test_concurrent_embedding_order_mock():
+    texts = [f"Text number {index}." for index in range(50)]
+    with MockOpenaiServer(latency=0.01) as server:
+        embeddings = embed_texts(texts, max_concurrent_calls=4,
+                                 max_tokens_per_request=20)
+    assert server.nb_requests > 4
+    assert server.nb_embedded_inputs == len(texts)
+    assert embeddings == [make_mock_embedding(text) for text in texts]
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_api_embedding_call()
     test_api_chunk_embedding_call()
+    test_pack_texts_in_batches()
+    test_batched_chunk_embedding_mock()
+    test_concurrent_embedding_order_mock()
@@ -1,6 +1,11 @@
 
 
-from papers_extractor.openai_parsers import OpenaiLongParser
+from papers_extractor.openai_parsers import \
+    OpenaiLongParser, find_chunk_boundaries, parse_packed_reply, \
+    process_items_through_prompt
+from papers_extractor.mock_openai_server import MockOpenaiServer
+import asyncio
+import pytest
 import os
 import openai
 import logging
@@ -25,6 +30,158 @@ def test_api_call():
     assert response == ['Hello World, I am a test.']
 
 
+def test_iter_chat_results_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    prompts = ["Repeat:\n\nHello World, I am a test.",
+               "Repeat:\n\nGoodbye World."]
+
+    async def collect():
+        return [result async for result in
+                openai_long_parser.iter_chat_results(prompts, temperature=0)]
+
+    with MockOpenaiServer():
+        results = asyncio.run(collect())
+    assert sorted(index for index, _ in results) == [0, 1]
+    assert dict(results) == {0: 'Hello World, I', 1: 'Goodbye'}
+
+
+def test_streaming_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    prompts = ["Repeat:\n\nHello World, I am a test.",
+               "Repeat:\n\nGoodbye World, see you soon."]
+    partial_texts = {0: [], 1: []}
+
+    def on_partial(index, text):
+        partial_texts[index].append(text)
+
+    with MockOpenaiServer(token_latency=0.01):
+        streamed = openai_long_parser.multi_call_chatGPT(
+            prompts, temperature=0, stream=True, partial_callback=on_partial)
+        not_streamed = openai_long_parser.multi_call_chatGPT(
+            prompts, temperature=0)
+    assert streamed == not_streamed
+    for index, texts in partial_texts.items():
+        # The text grows with each delta and ends with the full reply
+        assert len(texts) > 1
+        assert texts[-1] == streamed[index]
+        assert all(texts[i + 1].startswith(texts[i])
+                   for i in range(len(texts) - 1))
+
+
+def test_streaming_first_token_timeout_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    with MockOpenaiServer(latency=1):
+        with pytest.raises(asyncio.TimeoutError):
+            openai_long_parser.multi_call_chatGPT(
+                ["Repeat:\n\nHello World."], stream=True,
+                first_token_timeout=0.1)
+
+
+def test_longest_first_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=1)
+    prompts = ["Repeat:\n\nHi.",
+               "Repeat:\n\nHello World, I am a much longer test.",
+               "Repeat:\n\nHello World."]
+
+    async def collect(longest_first):
+        return [result async for result in
+                openai_long_parser.iter_chat_results(
+                    prompts, temperature=0, longest_first=longest_first)]
+
+    with MockOpenaiServer():
+        results = asyncio.run(collect(True))
+        in_order = asyncio.run(collect(False))
+    # A single worker sends the prompts from the longest to the shortest
+    assert [index for index, _ in results] == [1, 2, 0]
+    assert [index for index, _ in in_order] == [0, 1, 2]
+    assert dict(results) == dict(in_order)
+
+
+def test_stream_call_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=4)
+    nb_read = 0
+    results = {}
+    max_held = 0
+
+    def generate_prompts():
+        nonlocal nb_read
+        for index in range(100):
+            nb_read += 1
+            yield f"Repeat:\n\n{index} Hello."
+
+    def on_result(index, content):
+        nonlocal max_held
+        max_held = max(max_held, nb_read - len(results))
+        results[index] = content
+
+    with MockOpenaiServer(latency=0.01):
+        nb_results = openai_long_parser.stream_call_chatGPT(
+            generate_prompts(), on_result, temperature=0, max_pending=8)
+    assert nb_results == 100
+    assert results == {index: str(index) for index in range(100)}
+    # The prompts are read as the results come back
+    assert max_held <= 9
+
+
+def test_stream_call_async_iterable_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+
+    async def generate_prompts():
+        yield "Repeat:\n\nHello World."
+        yield "Repeat:\n\nGoodbye World."
+
+    async def collect():
+        return [result async for result in
+                openai_long_parser.iter_chat_stream(generate_prompts(),
+                                                    temperature=0)]
+
+    with MockOpenaiServer():
+        results = asyncio.run(collect())
+    assert dict(results) == {0: "Hello", 1: "Goodbye"}
+
+
+def test_stream_source_fails_late_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+
+    async def generate_prompts():
+        yield "Repeat:\n\nHello World."
+        await asyncio.sleep(0.1)
+        raise ValueError("Broken source")
+
+    async def collect():
+        results = []
+        async for result in openai_long_parser.iter_chat_stream(
+                generate_prompts(), temperature=0):
+            # The source fails while we hold the first result
+            await asyncio.sleep(0.3)
+            results.append(result)
+        return results
+
+    with MockOpenaiServer():
+        with pytest.raises(ValueError):
+            asyncio.run(collect())
+
+
+def test_parse_packed_reply():
+    reply = 'Here you go:\n```json\n{"1": "First", "3": ["a", "b"]}\n```'
+    assert parse_packed_reply(reply, 3) == ["First", None, '["a", "b"]']
+    assert parse_packed_reply("Sorry, I cannot do that.", 2) == [None, None]
+    assert parse_packed_reply('{"1": "First", ', 1) == [None]
+
+
+def test_process_items_through_prompt_mock():
+    items = [f"Abstract number {index} about neurons." for index in range(50)]
+    with MockOpenaiServer() as server:
+        results = process_items_through_prompt(
+            items, "Summarize:", max_items_per_request=20,
+            max_concurrent_calls=4)
+    # The 50 items fit in 3 requests instead of 50
+    assert server.nb_requests == 3
+    assert results == ["Abstract number"] * 50
+
+
 def test_break_up_veryshortsentence_to_chunks():
     test_str = 'Hello World'
 
@@ -115,6 +272,61 @@ def test_break_up_unfinishedgroupsentences_to_chunks():
     assert openai_long_parser.chunks == response
 
 
+def test_find_chunk_boundaries():
+    tokens = ['Hello', 'World', '.', 'Goodbye', 'World', '.']
+    assert find_chunk_boundaries(tokens, 4) == [(0, 3), (3, 6)]
+    assert find_chunk_boundaries(tokens, 10) == [(0, 6)]
+    assert find_chunk_boundaries([], 4) == [(0, 0)]
+
+
+def test_break_up_manysentences_to_chunks():
+    # This used to exceed the recursion limit
+    test_str = 'Hello world in a sentence. ' * 20000
+
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=6)
+    assert openai_long_parser.num_chunks == 20000
+    assert openai_long_parser.chunks[-1] == 'Hello world in a sentence.'
+
+
+def test_break_up_model_tokens_to_chunks():
+    test_str = 'Hello World. Goodbye World.'
+
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=5,
+                                          chunk_unit="model_tokens")
+    assert openai_long_parser.chunks == ['Hello World.', 'Goodbye World.']
+
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=100,
+                                          chunk_unit="model_tokens")
+    assert openai_long_parser.chunks == [test_str]
+
+
+def test_weighted_chunk_boundaries():
+    tokens = ['A', 'b', '.', 'C', 'd', '.', 'E', '.']
+    weights = [1, 5, 1, 1, 1, 1, 3, 1]
+    assert find_chunk_boundaries(tokens, 8, token_weights=weights) == \
+        [(0, 3), (3, 8)]
+    assert find_chunk_boundaries(tokens, 100, token_weights=weights) == \
+        [(0, 8)]
+
+
+def test_break_up_keep_formatting_to_chunks():
+    test_str = 'Test prompt (for the first sentence).\n\n' + \
+        'Hello  world in the second sentence. Goodbye'
+
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=12,
+                                          keep_formatting=True)
+    response = ['Test prompt (for the first sentence).',
+                'Hello  world in the second sentence. Goodbye']
+    assert openai_long_parser.chunks == response
+    for chunk, (start, end) in zip(openai_long_parser.chunks,
+                                   openai_long_parser.chunk_spans):
+        assert test_str[start:end] == chunk
+
+    # The offsets are only computed to keep the formatting
+    openai_long_parser = OpenaiLongParser(test_str, chunk_size=12)
+    assert openai_long_parser.chunk_spans is None
+
+
 def test_process_chunks_through_prompt():
     test_str = 'Hello World! \
         Hello World!'
@@ -130,6 +342,15 @@ def test_process_chunks_through_prompt():
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_api_call()
+    test_iter_chat_results_mock()
+    test_streaming_mock()
+    test_streaming_first_token_timeout_mock()
+    test_longest_first_mock()
+    test_stream_call_mock()
+    test_stream_call_async_iterable_mock()
+    test_stream_source_fails_late_mock()
+    test_parse_packed_reply()
+    test_process_items_through_prompt_mock()
     test_break_up_veryshortsentence_to_chunks()
     test_break_up_veryshortendedsentence_to_chunks()
     test_break_up_shortsentences_to_chunks()
@@ -138,4 +359,9 @@ if __name__ == "__main__":
     test_break_up_groupsentences_to_chunks()
     test_break_up_unfinishedsentences_to_chunks()
     test_break_up_unfinishedgroupsentences_to_chunks()
+    test_find_chunk_boundaries()
+    test_break_up_manysentences_to_chunks()
+    test_break_up_model_tokens_to_chunks()
+    test_weighted_chunk_boundaries()
+    test_break_up_keep_formatting_to_chunks()
     test_process_chunks_through_prompt()
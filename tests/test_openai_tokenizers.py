@@ -1,7 +1,8 @@
 
 
 from papers_extractor.openai_parsers import \
-    count_tokens, custom_word_tokenize, custom_word_detokenize
+    count_tokens, custom_word_tokenize, custom_word_detokenize, \
+    custom_word_tokenize_with_spans
 import os
 import openai
 import logging
@@ -30,6 +31,17 @@ def test_custom_word_tokenize():
     assert question == response
 
 
+def test_custom_word_tokenize_with_spans():
+    test_str = "Test prompt.\n  He said \"hello\", didn't he?"
+    tokens, spans = custom_word_tokenize_with_spans(test_str)
+    assert tokens == custom_word_tokenize(test_str)
+    for token, (start, end) in zip(tokens, spans):
+        if token in ("``", "''"):
+            assert test_str[start:end] == '"'
+        else:
+            assert test_str[start:end] == token
+
+
 def test_custom_word_tokenize_detokenize():
     # We create multiple sentences that explore the different cases
     # With many different characters.
@@ -70,5 +82,6 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_counter()
     test_custom_word_tokenize()
+    test_custom_word_tokenize_with_spans()
     test_custom_word_tokenize_detokenize()
     # We know there is a problem with sentences that contains quotes like "
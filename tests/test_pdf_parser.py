@@ -1,7 +1,12 @@
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.mock_openai_server import MockOpenaiServer
 from papers_extractor.pdf_parser import PdfParser
 import os
 import logging
 import sys
+import tempfile
+
+TABLE_TEXT = "Title of the table\n\nName   Value   Unit\nA   1   s"
 
 # We first test that the pdf parser can read one of the example pdf file
 # and extract the text from it.
@@ -17,6 +22,38 @@ def test_read_pdf():
     assert pdf_parser.raw_text[0:16] == 'bioRxiv preprint'
 
 
+def clean_table_text(keep_formatting):
+    # The raw text is saved in the database so no PDF file is needed
+    local_database = LocalDatabase()
+    local_database.save_to_database("example_pdf", {"raw_text": TABLE_TEXT})
+    pdf_parser = PdfParser("example.pdf", local_database=local_database,
+                           database_id="example_pdf")
+    # The prompts sent are saved in the chunks folder
+    with tempfile.TemporaryDirectory() as chunks_dir:
+        chunks_path = os.path.join(chunks_dir, "chunks")
+        with MockOpenaiServer():
+            cleaned_text = pdf_parser.get_clean_text(
+                chunks_path=chunks_path, keep_formatting=keep_formatting)
+        with open(os.path.join(chunks_path, "input_chunk_0.txt")) as f:
+            sent_prompt = f.read()
+    return cleaned_text, sent_prompt
+
+
+def test_clean_text_keep_formatting_mock():
+    cleaned_text, sent_prompt = clean_table_text(keep_formatting=True)
+    # The paragraphs, line breaks and columns of the table reach the API
+    assert TABLE_TEXT in sent_prompt
+    # The mock server only answers the last paragraph of the chunk, which
+    # is the table alone since the paragraphs are kept
+    assert cleaned_text == "Name Value Unit"
+
+    cleaned_text, sent_prompt = clean_table_text(keep_formatting=False)
+    assert "Name   Value   Unit\nA   1   s" not in sent_prompt
+    assert "\n\nName" not in sent_prompt
+    assert cleaned_text != "Name Value Unit"
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
     test_read_pdf()
+    test_clean_text_keep_formatting_mock()
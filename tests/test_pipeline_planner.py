@@ -0,0 +1,162 @@
+from papers_extractor.completion_cache import CompletionCache, \
+    get_completion_cache
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.long_text import LongText, SUMMARY_PROMPT, \
+    SUMMARY_PARAMETERS
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL, \
+    build_chunk_prompt
+from papers_extractor.pdf_parser import PdfParser, CLEANUP_PROMPT
+from papers_extractor.pipeline_planner import PipelinePlanner, format_plan
+from papers_extractor.summary_tree import SUMMARY_NODE_KEY_PREFIX
+import logging
+import os
+import sys
+
+example_dir = os.path.join(os.path.dirname(__file__), '..', 'example')
+
+
+def get_example_database():
+    # The raw text is saved in the database so no PDF file is needed
+    with open(os.path.join(example_dir,
+                           '2020.12.15.422967v4.full_raw.txt')) as f:
+        raw_text = f.read()
+    local_database = LocalDatabase()
+    local_database.save_to_database("example_pdf", {"raw_text": raw_text})
+    return local_database
+
+
+def get_example_text():
+    # A part of the text keeps the calls within the rate limits
+    with open(os.path.join(example_dir,
+                           '2020.12.15.422967v4.full_raw.txt')) as f:
+        return f.read()[:20000]
+
+
+def get_stage(plan, name):
+    return [stage for stage in plan["stages"] if stage["stage"] == name][0]
+
+
+def test_plan_without_cache():
+    local_database = get_example_database()
+    planner = PipelinePlanner(local_database, chunk_size=400)
+    plan = planner.plan_pdf("example.pdf", database_id="example_pdf",
+                            embed=True)
+
+    pdf_parser = PdfParser("example.pdf", local_database=local_database,
+                           database_id="example_pdf")
+    nb_chunks = OpenaiLongParser(pdf_parser.get_text_to_clean(),
+                                 chunk_size=400).num_chunks
+    cleanup = get_stage(plan, "cleanup")
+    assert cleanup["calls"] == nb_chunks
+    assert cleanup["cached_calls"] == 0
+    assert cleanup["prompt_tokens"] > 0
+    summary = get_stage(plan, "summary")
+    # At least one level of summaries and the final clean up
+    assert summary["calls"] > nb_chunks * planner.summary_ratio
+    assert summary["estimated"]
+    assert get_stage(plan, "embedding")["calls"] >= 1
+    assert plan["calls"] == sum(stage["calls"] for stage in plan["stages"])
+    assert plan["seconds"] > 0
+    assert "cleanup" in format_plan(plan)
+
+
+def test_plan_skips_cached_work():
+    local_database = get_example_database()
+    pdf_parser = PdfParser("example.pdf", local_database=local_database,
+                           database_id="example_pdf")
+    planner = PipelinePlanner(local_database, chunk_size=400)
+
+    # We checkpoint the clean up of every chunk as if a run was interrupted
+    checkpoint = pdf_parser.get_cleanup_checkpoint()
+    parser = OpenaiLongParser(pdf_parser.get_text_to_clean(), chunk_size=400)
+    for chunk in parser.chunks:
+        checkpoint.save(build_chunk_prompt(CLEANUP_PROMPT, chunk), chunk)
+    plan = planner.plan_pdf("example.pdf", database_id="example_pdf")
+    cleanup = get_stage(plan, "cleanup")
+    assert cleanup["calls"] == 0
+    assert cleanup["cached_calls"] == parser.num_chunks
+
+    # The first level of summaries is cached too so it is replayed
+    cleaned_text = "\n".join(parser.chunks)
+    completion_cache = CompletionCache(local_database)
+    summary_parser = OpenaiLongParser(cleaned_text, chunk_size=400)
+    for chunk in summary_parser.chunks:
+        completion_cache.set(CHAT_MODEL,
+                             build_chunk_prompt(SUMMARY_PROMPT, chunk),
+                             "This publication is short.",
+                             **SUMMARY_PARAMETERS)
+    plan = planner.plan_pdf("example.pdf", database_id="example_pdf")
+    summary = get_stage(plan, "summary")
+    assert completion_cache.stats()["hits"] == 0
+    assert summary["cached_calls"] == summary_parser.num_chunks
+    # Only the final clean up of the cached summaries is left
+    assert summary["calls"] == 1
+    assert not summary["estimated"]
+
+    # Nothing is left once the summary is saved
+    long_text = LongText(cleaned_text, chunk_size=400,
+                         local_database=local_database)
+    long_text.summary = ["This publication is short."]
+    long_text.save_database()
+    plan = planner.plan_pdf("example.pdf", database_id="example_pdf")
+    assert plan["calls"] == 0
+
+
+def test_plan_stops_when_summaries_do_not_shrink():
+    local_database = LocalDatabase()
+    text = get_example_text()
+    # Each chunk is cached as its own summary so the text never shrinks
+    completion_cache = CompletionCache(local_database)
+    chunks = OpenaiLongParser(text, chunk_size=200).chunks
+    for chunk in chunks:
+        completion_cache.set(CHAT_MODEL,
+                             build_chunk_prompt(SUMMARY_PROMPT, chunk),
+                             chunk, **SUMMARY_PARAMETERS)
+    planner = PipelinePlanner(local_database, chunk_size=200)
+    summary = planner.plan_summary(text)
+    assert summary["cached_calls"] == len(chunks)
+    assert summary["calls"] == 0
+
+
+def test_plan_skips_summary_pyramid_mock():
+    local_database = LocalDatabase()
+    text = get_example_text()
+    long_text = LongText(text, chunk_size=200, local_database=local_database)
+    planner = PipelinePlanner(local_database, chunk_size=200)
+    with MockOpenaiServer() as server:
+        long_text.summarize_longtext_into_chunks(final_chunk_length=2)
+        nb_calls = server.nb_requests
+        # Only the pyramid keeps the summaries of the levels
+        get_completion_cache(local_database).clear()
+        for key in local_database.get_list_keys():
+            if key.startswith(SUMMARY_NODE_KEY_PREFIX):
+                local_database.reset_key(key)
+        # Only the levels above the saved pyramid are left
+        summary = planner.plan_summary(text, final_chunk_length=1)
+        long_text.summarize_longtext_into_chunks(final_chunk_length=1)
+    assert summary["calls"] == server.nb_requests - nb_calls
+    assert summary["cached_calls"] >= nb_calls - 1
+
+
+def test_plan_latency_follows_concurrency():
+    local_database = get_example_database()
+    slow_planner = PipelinePlanner(local_database, chunk_size=200,
+                                   cleanup_concurrent_calls=1)
+    fast_planner = PipelinePlanner(local_database, chunk_size=200,
+                                   cleanup_concurrent_calls=100)
+    slow_plan = slow_planner.plan_pdf("example.pdf", summarize=False,
+                                      database_id="example_pdf")
+    fast_plan = fast_planner.plan_pdf("example.pdf", summarize=False,
+                                      database_id="example_pdf")
+    assert slow_plan["calls"] == fast_plan["calls"]
+    assert slow_plan["seconds"] > fast_plan["seconds"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_plan_without_cache()
+    test_plan_skips_cached_work()
+    test_plan_stops_when_summaries_do_not_shrink()
+    test_plan_skips_summary_pyramid_mock()
+    test_plan_latency_follows_concurrency()
@@ -0,0 +1,170 @@
+from papers_extractor.rate_limiter import \
+    RateLimiter, configure_rate_limiter, get_rate_limiter, DEFAULT_RATE_LIMITS
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL
+from papers_extractor.mock_openai_server import MockOpenaiServer
+import asyncio
+import logging
+import sys
+import time
+
+
+def test_shared_limiter():
+    assert get_rate_limiter("test-model") is get_rate_limiter("test-model")
+
+
+def test_request_bucket():
+    # 120 requests per minute with a bucket of 2 requests to start with
+    limiter = RateLimiter("test-model", requests_per_minute=120)
+    limiter._request_allowance = 2
+
+    async def send_requests():
+        for _ in range(4):
+            async with limiter.limit():
+                pass
+
+    start_time = time.perf_counter()
+    asyncio.run(send_requests())
+    elapsed_time = time.perf_counter() - start_time
+    # The two last requests wait for the bucket to refill
+    assert 0.9 < elapsed_time < 2
+    assert limiter.stats()["nb_requests"] == 4
+
+
+def test_token_bucket_refund():
+    limiter = RateLimiter("test-model", tokens_per_minute=1000)
+
+    async def send_request():
+        async with limiter.limit(estimated_tokens=800) as permit:
+            permit.record_usage(100)
+
+    asyncio.run(send_request())
+    assert limiter._token_allowance > 850
+
+    # A throttled request gives back all the tokens it reserved
+    limiter = RateLimiter("test-model", tokens_per_minute=1000,
+                          default_retry_after=0.01)
+
+    async def send_throttled_request():
+        async with limiter.limit(estimated_tokens=800) as permit:
+            permit.record_throttle()
+
+    asyncio.run(send_throttled_request())
+    assert limiter._token_allowance > 950
+
+
+def test_adaptive_concurrency():
+    limiter = RateLimiter("test-model", max_concurrency=8,
+                          default_retry_after=0.01)
+
+    async def send_request(throttled):
+        async with limiter.limit() as permit:
+            if throttled:
+                permit.record_throttle()
+
+    asyncio.run(send_request(True))
+    assert limiter.concurrency_limit == 4
+
+    async def send_requests():
+        for _ in range(4):
+            await send_request(False)
+
+    asyncio.run(send_requests())
+    assert limiter.concurrency_limit == 5
+
+
+def test_timeouts_lower_concurrency():
+    limiter = RateLimiter("test-model", max_concurrency=8,
+                          timeouts_before_decrease=2)
+
+    async def send_request(timed_out):
+        async with limiter.limit() as permit:
+            permit.record_failure(timed_out=timed_out)
+
+    async def send_requests():
+        for timed_out in [True, False, True, True]:
+            await send_request(timed_out)
+
+    asyncio.run(send_requests())
+    # Only the two timeouts in a row halve the bound
+    assert limiter.concurrency_limit == 4
+    assert limiter.stats()["nb_timeouts"] == 3
+    assert limiter._success_streak == 0
+
+
+def test_concurrency_bound():
+    limiter = RateLimiter("test-model", max_concurrency=2)
+    max_in_flight = 0
+
+    async def send_request():
+        nonlocal max_in_flight
+        async with limiter.limit():
+            max_in_flight = max(max_in_flight, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def send_requests():
+        await asyncio.gather(*[send_request() for _ in range(10)])
+
+    asyncio.run(send_requests())
+    assert max_in_flight == 2
+    assert limiter.in_flight == 0
+
+
+def test_parsers_share_limiter_on_throttling_server():
+    limiter = configure_rate_limiter(CHAT_MODEL, max_concurrency=16)
+    try:
+        # The server accepts 10 requests per second and answers 429 above
+        with MockOpenaiServer(latency=0.01, requests_per_window=10,
+                              rate_window=1.0) as server:
+            # The chunks are all different so no request is coalesced
+            texts = [" ".join(f"Hello there. Hi {index}{chunk}."
+                              for chunk in range(5)) for index in range(3)]
+            parsers = [OpenaiLongParser(text, chunk_size=6)
+                       for text in texts]
+
+            async def run_parsers():
+                return await asyncio.gather(*[
+                    parser.async_call_chatGPT(parser.chunks, 0, 0, 0)
+                    for parser in parsers])
+
+            results = asyncio.run(run_parsers())
+        assert [len(result) for result in results] == [5, 5, 5]
+        assert results[0][0] == 'Hello there.'
+        assert server.nb_throttled == limiter.stats()["nb_throttled"]
+        assert limiter.stats()["nb_throttled"] > 0
+    finally:
+        configure_rate_limiter(CHAT_MODEL, **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+
+
+def test_hanging_server_does_not_raise_concurrency():
+    limiter = configure_rate_limiter(CHAT_MODEL, max_concurrency=16)
+    limiter.concurrency_limit = 4
+    try:
+        # Every request hangs past the timeout of the client
+        with MockOpenaiServer(timeout_rate=1.0, hang_time=0.3) as server:
+            openai_long_parser = OpenaiLongParser("Test prompt")
+            prompts = [f"Repeat:\n\nHello World {index}."
+                       for index in range(8)]
+            results, errors = openai_long_parser.multi_call_chatGPT(
+                prompts, temperature=0, on_error="partial", timeout=0.1,
+                max_retries=1)
+            # We let the hung requests end before the server stops
+            time.sleep(0.3)
+        assert results == [None] * len(prompts)
+        assert len(errors) == len(prompts)
+        assert limiter.stats()["nb_timeouts"] == server.nb_hung
+        # The timed out attempts lowered the bound instead of raising it
+        assert limiter.stats()["concurrency_limit"] < 4
+    finally:
+        configure_rate_limiter(CHAT_MODEL, **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_shared_limiter()
+    test_request_bucket()
+    test_token_bucket_refund()
+    test_adaptive_concurrency()
+    test_timeouts_lower_concurrency()
+    test_concurrency_bound()
+    test_parsers_share_limiter_on_throttling_server()
+    test_hanging_server_does_not_raise_concurrency()
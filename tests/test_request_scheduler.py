@@ -0,0 +1,166 @@
+from papers_extractor.async_runner import get_async_runner
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, \
+    async_embed_texts, EMBEDDING_MODEL
+from papers_extractor.rate_limiter import configure_rate_limiter, \
+    get_rate_limiter, DEFAULT_RATE_LIMITS
+from papers_extractor.request_scheduler import RequestScheduler, \
+    DeadlineExceededError, configure_scheduler
+import asyncio
+import logging
+import pytest
+import sys
+import time
+
+
+def admission_order(scheduler, priorities):
+    """Queues a request of each priority behind a held slot and returns the
+    order in which they are admitted."""
+    order = []
+
+    async def request(index, priority):
+        async with scheduler.slot(priority):
+            order.append(index)
+            await asyncio.sleep(0)
+
+    async def run_all():
+        await scheduler.acquire(priorities[0])
+        tasks = [asyncio.create_task(request(index, priority))
+                 for index, priority in enumerate(priorities)]
+        await asyncio.sleep(0.01)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run_all())
+    return order
+
+
+def test_priority_goes_first():
+    scheduler = RequestScheduler(max_concurrency=1)
+    order = admission_order(scheduler, ["bulk", "bulk", "bulk",
+                                        "interactive"])
+    assert order[0] == 3
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_weighted_fair_sharing():
+    scheduler = RequestScheduler(max_concurrency=1,
+                                 priority_weights={"interactive": 3,
+                                                   "bulk": 1})
+    priorities = ["bulk"] * 20 + ["interactive"] * 20
+    order = admission_order(scheduler, priorities)
+    # Interactive requests get about 3 slots out of 4 while both wait
+    first_admitted = [priorities[index] for index in order[:16]]
+    assert 11 <= first_admitted.count("interactive") <= 13
+
+
+def test_deadline_expires():
+    scheduler = RequestScheduler(max_concurrency=1)
+
+    async def run_all():
+        await scheduler.acquire()
+        with pytest.raises(DeadlineExceededError):
+            await scheduler.acquire(deadline=time.monotonic() + 0.05)
+        scheduler.release()
+
+    asyncio.run(run_all())
+    assert scheduler.stats()["nb_expired"] == 1
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_unknown_priority():
+    scheduler = RequestScheduler()
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.acquire("urgent"))
+
+
+def test_batch_deadline_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(3)]
+    with MockOpenaiServer(latency=1.0):
+        results, errors = openai_long_parser.multi_call_chatGPT(
+            prompts, temperature=0, on_error="partial", deadline=0.1)
+    assert results == [None] * 3
+    assert all(isinstance(error, DeadlineExceededError)
+               for error in errors.values())
+
+
+def test_interactive_job_overtakes_bulk_mock():
+    configure_scheduler(max_concurrency=2)
+    bulk_parser = OpenaiLongParser("Test prompt", priority="bulk")
+    interactive_parser = OpenaiLongParser("Test prompt",
+                                          priority="interactive")
+    bulk_prompts = [f"Repeat:\n\nBulk {index}." for index in range(20)]
+    finish_times = {}
+
+    async def run_job(name, parser, prompts, delay):
+        await asyncio.sleep(delay)
+        await parser.async_call_chatGPT(prompts, 0, 0, 0)
+        finish_times[name] = time.perf_counter()
+
+    async def run_all():
+        await asyncio.gather(
+            run_job("bulk", bulk_parser, bulk_prompts, 0),
+            run_job("interactive", interactive_parser,
+                    ["Repeat:\n\nInteractive."], 0.05))
+
+    try:
+        with MockOpenaiServer(latency=0.05):
+            start_time = time.perf_counter()
+            get_async_runner().run(run_all())
+    finally:
+        configure_scheduler()
+    # The interactive prompt waits for one slot instead of the bulk queue
+    assert finish_times["interactive"] - start_time < 0.3
+    assert finish_times["bulk"] - start_time > 0.4
+
+
+def test_throttled_bulk_job_frees_slots_mock():
+    configure_scheduler(max_concurrency=2)
+    interactive_parser = OpenaiLongParser("Test prompt",
+                                          priority="interactive")
+    finish_times = {}
+
+    async def throttle_embeddings():
+        # The embeddings are paused for a second as after a 429 error
+        async with get_rate_limiter(EMBEDDING_MODEL).limit() as permit:
+            permit.record_throttle(retry_after=1.0)
+
+    async def embed_bulk():
+        await async_embed_texts([f"Bulk {index}." for index in range(4)],
+                                max_concurrent_calls=4,
+                                max_inputs_per_request=1, priority="bulk")
+        finish_times["bulk"] = time.perf_counter()
+
+    async def run_interactive():
+        await asyncio.sleep(0.05)
+        await interactive_parser.async_call_chatGPT(
+            ["Repeat:\n\nInteractive."], 0, 0, 0)
+        finish_times["interactive"] = time.perf_counter()
+
+    async def run_all():
+        await throttle_embeddings()
+        await asyncio.gather(embed_bulk(), run_interactive())
+
+    try:
+        with MockOpenaiServer(latency=0.01):
+            start_time = time.perf_counter()
+            get_async_runner().run(run_all())
+    finally:
+        configure_scheduler()
+        configure_rate_limiter(EMBEDDING_MODEL,
+                               **DEFAULT_RATE_LIMITS[EMBEDDING_MODEL])
+    # The paused bulk requests do not hold the two slots of the budget
+    assert finish_times["interactive"] - start_time < 0.5
+    assert finish_times["bulk"] - start_time > 0.9
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_priority_goes_first()
+    test_weighted_fair_sharing()
+    test_deadline_expires()
+    test_unknown_priority()
+    test_batch_deadline_mock()
+    test_interactive_job_overtakes_bulk_mock()
+    test_throttled_bulk_job_frees_slots_mock()
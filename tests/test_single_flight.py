@@ -0,0 +1,175 @@
+from papers_extractor.async_runner import get_async_runner
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser
+from papers_extractor.request_scheduler import DeadlineExceededError, \
+    configure_scheduler, get_scheduler
+from papers_extractor.single_flight import SingleFlight
+import asyncio
+import logging
+import pytest
+import sys
+import time
+
+
+def test_single_flight_shares_calls():
+    single_flight = SingleFlight()
+    nb_calls = []
+
+    async def call():
+        nb_calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run_all():
+        return await asyncio.gather(
+            *[single_flight.run("key", call) for _ in range(5)])
+
+    results = asyncio.run(run_all())
+    assert len(nb_calls) == 1
+    assert [result for result, _ in results] == ["result"] * 5
+    assert sum(shared for _, shared in results) == 4
+    assert single_flight.stats() == {"nb_calls": 1, "nb_shared": 4,
+                                     "in_flight": 0}
+
+
+def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.05)
+        raise ValueError("failed")
+
+    async def run_all():
+        return await asyncio.gather(
+            *[single_flight.run("key", call) for _ in range(3)],
+            return_exceptions=True)
+
+    results = asyncio.run(run_all())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_single_flight_leader_cancelled():
+    single_flight = SingleFlight()
+    nb_calls = []
+
+    async def call():
+        nb_calls.append(1)
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def run_all():
+        leader = asyncio.create_task(single_flight.run("key", call))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(single_flight.run("key", call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    # The waiter makes the call again instead of failing
+    assert asyncio.run(run_all()) == ("result", False)
+    assert len(nb_calls) == 2
+
+
+def test_single_flight_leader_deadline():
+    single_flight = SingleFlight()
+
+    async def leader_call():
+        await asyncio.sleep(0.05)
+        raise DeadlineExceededError("No slot was free before the deadline")
+
+    async def waiter_call():
+        return "result"
+
+    async def run_all():
+        leader = asyncio.create_task(single_flight.run(
+            "key", leader_call, own_errors=(DeadlineExceededError,)))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(single_flight.run("key", waiter_call))
+        with pytest.raises(DeadlineExceededError):
+            await leader
+        return await waiter
+
+    # The deadline of the leader is not shared with the waiter
+    assert asyncio.run(run_all()) == ("result", False)
+
+
+def test_interactive_call_behind_bulk_call_mock():
+    scheduler = configure_scheduler(max_concurrency=1)
+    bulk_parser = OpenaiLongParser("Test prompt", priority="bulk")
+    interactive_parser = OpenaiLongParser("Test prompt",
+                                          priority="interactive")
+    prompt = "Repeat:\n\nHello World."
+    finish_times = {}
+
+    async def run_bulk():
+        results, errors = await bulk_parser.async_call_chatGPT(
+            [prompt], 0, 0, 0, on_error="partial", deadline=0.2)
+        finish_times["bulk"] = time.perf_counter()
+        return errors
+
+    async def run_interactive():
+        await asyncio.sleep(0.05)
+        results = await interactive_parser.async_call_chatGPT(
+            [prompt], 0, 0, 0)
+        finish_times["interactive"] = time.perf_counter()
+        return results
+
+    async def run_all():
+        # The only slot is taken until after the deadline of the bulk call
+        await get_scheduler().acquire()
+        tasks = asyncio.gather(run_bulk(), run_interactive())
+        await asyncio.sleep(0.3)
+        get_scheduler().release()
+        return await tasks
+
+    try:
+        with MockOpenaiServer() as server:
+            bulk_errors, interactive_results = \
+                get_async_runner().run(run_all())
+    finally:
+        configure_scheduler()
+    # The interactive call sent its own request instead of sharing the
+    # deadline of the bulk call
+    assert isinstance(bulk_errors[0], DeadlineExceededError)
+    assert interactive_results == ["Hello"]
+    assert server.nb_requests == 1
+    assert scheduler.stats()["nb_admitted"]["interactive"] == 1
+
+
+def test_coalescing_across_parsers_mock():
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(5)]
+    parsers = [OpenaiLongParser("Test prompt") for _ in range(3)]
+
+    async def run_all():
+        return await asyncio.gather(
+            *[parser.async_call_chatGPT(prompts, 0, 0, 0)
+              for parser in parsers])
+
+    with MockOpenaiServer(latency=0.2) as server:
+        results = get_async_runner().run(run_all())
+    assert server.nb_requests == len(prompts)
+    assert results == [["Hello"] * len(prompts)] * len(parsers)
+
+
+def test_batch_deduplication_mock():
+    openai_long_parser = OpenaiLongParser("Test prompt")
+    prompts = ["Repeat:\n\nHello World.", "Repeat:\n\nHi there.",
+               "Repeat:\n\nHello World."]
+    with MockOpenaiServer() as server:
+        results = openai_long_parser.multi_call_chatGPT(prompts,
+                                                        temperature=0)
+    assert server.nb_requests == 2
+    assert results == ["Hello", "Hi", "Hello"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_single_flight_shares_calls()
+    test_single_flight_shares_errors()
+    test_single_flight_leader_cancelled()
+    test_single_flight_leader_deadline()
+    test_interactive_call_behind_bulk_call_mock()
+    test_coalescing_across_parsers_mock()
+    test_batch_deduplication_mock()
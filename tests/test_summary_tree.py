@@ -0,0 +1,141 @@
+from papers_extractor.completion_cache import get_completion_cache
+from papers_extractor.database_parser import LocalDatabase
+from papers_extractor.long_text import LongText, SUMMARY_PROMPT
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.summary_tree import SummaryTree, make_leaf_key, \
+    make_parent_key, SUMMARY_NODE_KEY_PREFIX
+import logging
+import os
+import sys
+
+example_dir = os.path.join(os.path.dirname(__file__), '..', 'example')
+
+
+def get_example_text():
+    with open(os.path.join(example_dir,
+                           '2020.12.15.422967v4.full_raw.txt')) as f:
+        return f.read()
+
+
+def test_group_children():
+    summary_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=10)
+    assert summary_tree.group_children([4, 4, 4, 12, 3]) == \
+        [[0, 1], [2], [3], [4]]
+    assert make_parent_key([make_leaf_key("a"), make_leaf_key("b")]) != \
+        make_parent_key([make_leaf_key("b"), make_leaf_key("a")])
+
+
+def test_summary_tree_mock():
+    local_database = LocalDatabase()
+    text = get_example_text()
+    summary_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                               final_chunk_length=1,
+                               local_database=local_database)
+    with MockOpenaiServer() as server:
+        top_texts = summary_tree.summarize(text)
+        stats = summary_tree.stats()
+        assert len(top_texts) == 1
+        assert stats["depth"] >= 2
+        assert stats["nodes_per_level"][-1] == 1
+        assert stats["fan_in"] >= 2
+        assert stats["nb_calls"] == server.nb_requests
+        assert stats["critical_path_seconds"] <= stats["seconds"]
+
+        # Every node is cached by the hash of its children
+        cached_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                                  final_chunk_length=1,
+                                  local_database=local_database)
+        assert cached_tree.summarize(text) == top_texts
+        assert cached_tree.stats()["nb_calls"] == 0
+        assert server.nb_requests == stats["nb_calls"]
+
+
+def test_summary_tree_does_not_wait_for_level_mock():
+    # A leaf near the end of the text is much slower than the others
+    def latency():
+        latency.nb_calls += 1
+        return 1.0 if latency.nb_calls == 30 else 0.01
+    latency.nb_calls = 0
+
+    summary_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                               final_chunk_length=1, max_concurrent_calls=4)
+    with MockOpenaiServer(latency=latency):
+        summary_tree.summarize(get_example_text())
+    leaves, parents = summary_tree.levels[0], summary_tree.levels[1]
+    last_leaf_time = max(node.done_time for node in leaves)
+    # Nodes of the next level were done before the slow leaf
+    assert any(node.done_time < last_leaf_time for node in parents)
+
+
+def test_summary_pyramid_mock():
+    local_database = LocalDatabase()
+    text = get_example_text()
+    with MockOpenaiServer() as server:
+        first_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                                 final_chunk_length=4,
+                                 local_database=local_database)
+        first_tree.summarize(text)
+        nb_first_calls = server.nb_requests
+
+        # Without the nodes, only the levels above the pyramid are sent
+        for key in local_database.get_list_keys():
+            if key.startswith(SUMMARY_NODE_KEY_PREFIX):
+                local_database.reset_key(key)
+        deeper_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                                  final_chunk_length=1,
+                                  local_database=local_database)
+        top_texts = deeper_tree.summarize(text)
+        assert len(top_texts) == 1
+        assert deeper_tree.depth > first_tree.depth
+        new_levels = deeper_tree.levels[first_tree.depth:deeper_tree.depth]
+        assert server.nb_requests - nb_first_calls == \
+            sum(len(nodes) for nodes in new_levels)
+
+        # A level inside the pyramid is returned without any call
+        nb_calls = server.nb_requests
+        shallow_tree = SummaryTree(SUMMARY_PROMPT, chunk_size=400,
+                                   final_chunk_length=2,
+                                   local_database=local_database)
+        shallow_tree.summarize(text)
+        assert server.nb_requests == nb_calls
+        assert len(shallow_tree.levels[-1]) <= 2
+
+
+def test_long_text_final_lengths_mock():
+    local_database = LocalDatabase()
+    # A part of the text keeps the calls within the rate limits
+    long_text = LongText(get_example_text()[:20000], chunk_size=200,
+                         local_database=local_database)
+    with MockOpenaiServer() as server:
+        two_chunks = long_text.summarize_longtext_into_chunks(
+            final_chunk_length=2)
+        nb_calls = server.nb_requests
+        one_chunk = long_text.summarize_longtext_into_chunks(
+            final_chunk_length=1)
+        # Only the top of the tree and the clean up were sent again
+        assert 0 < server.nb_requests - nb_calls < nb_calls / 4
+        nb_calls = server.nb_requests
+        assert long_text.summarize_longtext_into_chunks(
+            final_chunk_length=2) == two_chunks
+        assert server.nb_requests == nb_calls
+    assert long_text.summaries == {2: two_chunks, 1: one_chunk}
+    # The summaries looked up completions in the cache of the database
+    assert get_completion_cache(local_database).stats()["misses"] > 0
+
+
+def test_legacy_summary_final_length():
+    long_text = LongText("A short text.", chunk_size=200)
+    # A summary saved before the summaries were kept per final length
+    long_text.summary = ["First part.", "Second part."]
+    assert long_text.get_saved_summary(2) == long_text.summary
+    assert long_text.get_saved_summary(1) is None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_group_children()
+    test_summary_tree_mock()
+    test_summary_tree_does_not_wait_for_level_mock()
+    test_summary_pyramid_mock()
+    test_long_text_final_lengths_mock()
+    test_legacy_summary_final_length()
@@ -0,0 +1,116 @@
+from papers_extractor.telemetry import InMemoryMetrics, JsonLinesExporter, \
+    add_metrics_sink, remove_metrics_sink, emit_event, percentile
+from papers_extractor.mock_openai_server import MockOpenaiServer
+from papers_extractor.openai_parsers import OpenaiLongParser, CHAT_MODEL, \
+    EMBEDDING_MODEL, embed_texts
+from papers_extractor.rate_limiter import DEFAULT_RATE_LIMITS, \
+    configure_rate_limiter
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+def test_percentile():
+    values = list(range(101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([1, 2], 0.5) == 1.5
+    assert percentile([], 0.5) is None
+
+
+def test_in_memory_metrics():
+    metrics = InMemoryMetrics()
+    for index in range(100):
+        metrics.record({"event": "attempt", "model": "model",
+                        "latency": index / 100, "retry_reason": None})
+        metrics.record({"event": "request", "model": "model",
+                        "status": "success", "latency": 1.0,
+                        "queue_wait": 0.0, "tokens_in": 10,
+                        "tokens_out": 10, "timestamp": 1 + index / 10})
+    metrics.record({"event": "attempt", "model": "model", "latency": 2.0,
+                    "retry_reason": "timeout"})
+    summary = metrics.summary()["model"]
+    assert summary["nb_requests"] == 100
+    assert summary["nb_attempts"] == 101
+    assert summary["retry_reasons"] == {"timeout": 1}
+    assert summary["statuses"] == {"success": 100}
+    assert abs(summary["attempt_latency_p50"] - 0.5) < 1e-9
+    assert summary["attempt_latency_p99"] > 0.9
+    # 2000 tokens between 0 and 10.9 seconds
+    assert abs(summary["tokens_per_second"] - 2000 / 10.9) < 1e-6
+
+
+def test_json_lines_exporter():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "events.jsonl")
+        exporter = add_metrics_sink(JsonLinesExporter(path))
+        try:
+            emit_event({"event": "request", "model": "model"})
+        finally:
+            remove_metrics_sink(exporter)
+            exporter.close()
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+    assert len(events) == 1
+    assert events[0]["model"] == "model"
+    assert "timestamp" in events[0]
+
+
+def test_events_of_calls_mock():
+    configure_rate_limiter(CHAT_MODEL, default_retry_after=0.05,
+                           **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+    sink = add_metrics_sink(ListSink())
+    metrics = add_metrics_sink(InMemoryMetrics())
+    openai_long_parser = OpenaiLongParser("Test prompt",
+                                          max_concurrent_calls=2)
+    prompts = [f"Repeat:\n\nHello World {index}." for index in range(10)]
+    try:
+        with MockOpenaiServer(throttle_rate=0.3, injected_retry_after=0.01,
+                              seed=0) as server:
+            openai_long_parser.multi_call_chatGPT(prompts, temperature=0)
+            embed_texts(["Hello World."])
+    finally:
+        remove_metrics_sink(sink)
+        remove_metrics_sink(metrics)
+        configure_rate_limiter(CHAT_MODEL, **DEFAULT_RATE_LIMITS[CHAT_MODEL])
+
+    requests = [event for event in sink.events
+                if event["event"] == "request" and
+                event["model"] == CHAT_MODEL]
+    attempts = [event for event in sink.events
+                if event["event"] == "attempt" and
+                event["model"] == CHAT_MODEL]
+    assert len(requests) == 10
+    assert all(event["status"] == "success" for event in requests)
+    assert all(event["tokens_out"] > 0 for event in requests)
+    # Only 2 workers so some prompts waited in the queue
+    assert max(event["queue_wait"] for event in requests) > 0
+    throttled = [event for event in attempts
+                 if event["retry_reason"] == "rate_limit"]
+    assert len(throttled) == server.nb_throttled - \
+        sum(1 for event in sink.events if event["model"] == EMBEDDING_MODEL
+            and event.get("retry_reason") == "rate_limit")
+    assert len(attempts) == 10 + len(throttled)
+
+    summary = metrics.summary()
+    assert summary[CHAT_MODEL]["nb_requests"] == 10
+    assert summary[CHAT_MODEL]["tokens_per_second"] > 0
+    assert summary[EMBEDDING_MODEL]["nb_requests"] == 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_percentile()
+    test_in_memory_metrics()
+    test_json_lines_exporter()
+    test_events_of_calls_mock()
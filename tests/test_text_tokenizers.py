@@ -0,0 +1,65 @@
+from papers_extractor.text_tokenizers import \
+    RegexTokenizer, get_tokenizer_backend
+from papers_extractor.openai_parsers import custom_word_tokenize
+import difflib
+import glob
+import logging
+import os
+import subprocess
+import sys
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_load_nltk():
+    code = ("import sys, papers_extractor.openai_parsers; " +
+            "print('nltk' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", code],
+                            capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "False"
+
+
+def test_regex_sentences():
+    tokenizer = RegexTokenizer()
+    test_str = "We used mice (Fig. 1). Dr. Smith et al. agree! Do you?"
+    spans = tokenizer.split_sentences(test_str)
+    assert [test_str[start:end] for start, end in spans] == [
+        "We used mice (Fig. 1).", "Dr. Smith et al. agree!", "Do you?"]
+
+
+def test_regex_tokens():
+    tokenizer = RegexTokenizer()
+    test_str = 'He said "it\'s 3,000 mice" (about 5%) -- cannot stop.'
+    tokens, spans = tokenizer.tokenize_with_spans(test_str)
+    assert tokens == ['He', 'said', '``', 'it', "'s", '3,000', 'mice', "''",
+                      '(', 'about', '5', '%', ')', '--', 'can', 'not',
+                      'stop', '.']
+    assert [test_str[start:end] for start, end in spans][2] == '"'
+
+
+def test_backends_parity():
+    # The regex backend should cut the example texts like nltk does
+    regex_backend = get_tokenizer_backend("regex")
+    nltk_backend = get_tokenizer_backend("nltk")
+    for path in sorted(glob.glob(f"{parent_dir}/example/*.txt")):
+        with open(path, "r") as f:
+            text = f.read()
+        regex_tokens = custom_word_tokenize(text, backend="regex")
+        nltk_tokens = custom_word_tokenize(text, backend="nltk")
+        matcher = difflib.SequenceMatcher(None, regex_tokens, nltk_tokens,
+                                          autojunk=False)
+        assert matcher.ratio() > 0.97
+
+        # Each backend is also consistent with its own spans
+        first_line = text.splitlines()[0].strip()
+        for backend in [regex_backend, nltk_backend]:
+            tokens, spans = backend.tokenize_with_spans(first_line)
+            assert len(tokens) == len(spans)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_import_does_not_load_nltk()
+    test_regex_sentences()
+    test_regex_tokens()
+    test_backends_parity()
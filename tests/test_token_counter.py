@@ -0,0 +1,63 @@
+from papers_extractor.token_counter import \
+    TokenCounter, get_encoder, get_token_counter, count_tokens_batch, \
+    async_count_tokens_batch
+import asyncio
+import logging
+import threading
+import sys
+
+
+def test_encoder_is_shared():
+    assert get_encoder() is get_encoder()
+    assert get_token_counter() is get_token_counter()
+
+
+def test_count_batch_matches_count():
+    texts = ["Test prompt", "Hello world, this is a longer sentence.",
+             "Test prompt", ""]
+    counter = TokenCounter()
+    assert counter.count_batch(texts) == [counter.count(text)
+                                          for text in texts]
+    assert count_tokens_batch(["Test prompt"]) == [2]
+
+
+def test_cache_hits_and_eviction():
+    counter = TokenCounter(cache_size=2)
+    counter.count("first text")
+    counter.count("first text")
+    assert counter.cache_info()["hits"] == 1
+    counter.count_batch(["second text", "third text"])
+    info = counter.cache_info()
+    assert info["size"] == 2
+    assert info["misses"] == 3
+
+    # The first text was the least recently used and was evicted
+    counter.count("first text")
+    assert counter.cache_info()["misses"] == 4
+
+
+def test_async_count_runs_off_the_loop():
+    texts = ["Test prompt", "Hello world, this is a longer sentence."]
+    counter = get_token_counter()
+    count_batch = counter.count_batch
+    threads = []
+
+    def record_thread(texts):
+        threads.append(threading.current_thread())
+        return count_batch(texts)
+
+    counter.count_batch = record_thread
+    try:
+        counts = asyncio.run(async_count_tokens_batch(texts))
+    finally:
+        del counter.count_batch
+    assert counts == count_tokens_batch(texts)
+    assert threads and threads[0] is not threading.main_thread()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
+    test_encoder_is_shared()
+    test_count_batch_matches_count()
+    test_cache_hits_and_eviction()
+    test_async_count_runs_off_the_loop()